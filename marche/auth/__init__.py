@@ -56,7 +56,7 @@ class AuthHandler(object):
 
     def authenticate(self, user, passwd):
         for auth in self.auths:
-            info = auth.authenticate(user, passwd)
+            info = auth.check(user, passwd)
             if info:
                 return info
         raise AuthFailed('credentials not accepted')
@@ -24,14 +24,114 @@
 
 """Basic authenticator class."""
 
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from marche.permission import ClientInfo
+
+
+class CredentialCache(object):
+    """Bounded cache of authentication results.
+
+    Credentials are only kept as a salted hash.  Successful results are kept
+    for *ttl* seconds, failed ones for *fail_ttl* seconds.  A user with
+    *max_failures* failed attempts within *fail_ttl* seconds is rejected
+    without asking the authenticator until the oldest failure expires.
+    Failures are tracked for at most *size* users.
+    """
+
+    def __init__(self, ttl, size, fail_ttl, max_failures):
+        self.ttl = ttl
+        self.size = size
+        self.fail_ttl = fail_ttl
+        self.max_failures = max_failures
+        self._salt = os.urandom(16)
+        self._lock = threading.Lock()
+        self._results = OrderedDict()  # hash -> (expiry, level or None)
+        self._failures = OrderedDict()  # user -> list of failure timestamps
+
+    def _key(self, user, password):
+        data = ('%s\0%s' % (user, password)).encode('utf-8')
+        return hashlib.sha256(self._salt + data).hexdigest()
+
+    def get(self, user, password):
+        """Return ``(found, level)``; *level* is None for failures."""
+        now = time.time()
+        key = self._key(user, password)
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None:
+                if now < entry[0]:
+                    return True, entry[1]
+                del self._results[key]
+            failures = self._failures.get(user)
+            if failures:
+                failures[:] = self._recent(failures, now)
+                if len(failures) >= self.max_failures > 0:
+                    return True, None
+        return False, None
+
+    def _recent(self, failures, now):
+        return [t for t in failures if now < t + self.fail_ttl]
+
+    def put(self, user, password, level):
+        now = time.time()
+        key = self._key(user, password)
+        with self._lock:
+            if level is None:
+                failures = self._recent(self._failures.pop(user, []), now)
+                failures.append(now)
+                self._failures[user] = failures
+                while len(self._failures) > self.size:
+                    self._failures.popitem(last=False)
+                ttl = self.fail_ttl
+            else:
+                self._failures.pop(user, None)
+                ttl = self.ttl
+            if ttl <= 0:
+                return
+            self._results.pop(key, None)
+            self._results[key] = (now + ttl, level)
+            while len(self._results) > self.size:
+                self._results.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self._failures.clear()
+
 
 class Authenticator(object):
 
+    # Defaults for the credential cache settings; no caching by default.
+    cache_ttl = 0
+    fail_ttl = 0
+
     def __init__(self, config, log):
         self.config = config
         self.log = log
+        self.cache = None
+        ttl = self._parse_number('cachettl', self.cache_ttl, float)
+        fail_ttl = self._parse_number('failttl', self.fail_ttl, float)
+        if ttl > 0 or fail_ttl > 0:
+            self.cache = CredentialCache(
+                ttl, self._parse_number('cachesize', 256, int), fail_ttl,
+                self._parse_number('maxfailures', 5, int))
         self.init()
 
+    def _parse_number(self, key, default, convert):
+        if key not in self.config:
+            return default
+        try:
+            return convert(self.config[key])
+        except ValueError:
+            self.log.warning('could not parse %s: %r, using %s' %
+                             (key, self.config[key], default))
+            return default
+
     def init(self):
         """Implement to do something on init.
 
@@ -45,3 +145,14 @@ class Authenticator(object):
 
         Otherwise, return None to give other authenticators a chance.
         """
+
+    def check(self, user, password):
+        """Like `authenticate`, but use the credential cache if configured."""
+        if self.cache is None:
+            return self.authenticate(user, password)
+        found, level = self.cache.get(user, password)
+        if found:
+            return None if level is None else ClientInfo(level)
+        info = self.authenticate(user, password)
+        self.cache.put(user, password, None if info is None else info.level)
+        return info
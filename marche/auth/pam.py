@@ -67,6 +67,15 @@ This authenticator checks credentials against Linux' PAM.
 
       The permission level to return for any user no in one of the above lists.
       Can be "none" to deny any other users.
+
+   .. describe:: cachettl
+                 failttl
+
+      **Default:** 60 and 10
+
+      Since PAM can be slow, results are cached by default.  See
+      :ref:`credential caching <auth-cache>` for these and the other cache
+      settings.
 """
 
 import pamela
@@ -78,6 +87,10 @@ from marche.permission import ClientInfo, STRING_LEVELS, DISPLAY, \
 
 class Authenticator(BaseAuthenticator):
 
+    # PAM can be slow (e.g. with LDAP), so cache results by default.
+    cache_ttl = 60
+    fail_ttl = 10
+
     def __init__(self, config, log):
         BaseAuthenticator.__init__(self, config, log)
         self.service = config.get('service', 'login')
@@ -0,0 +1,178 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# Marche - A server control daemon
+# Copyright (c) 2015-2016 by the authors, see LICENSE
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <g.brandl@fz-juelich.de>
+#
+# *****************************************************************************
+
+"""Compact binary encoding for protocol messages.
+
+This encodes the same values as JSON (None, bools, numbers, strings, lists
+and dicts), but in a more compact form: integers and lengths are encoded as
+variable-length integers, and short strings (which includes all dict keys in
+the protocol messages) are only sent once per message and referenced by index
+afterwards.
+"""
+
+import struct
+
+from marche.six import integer_types, string_types, binary_type, iteritems
+
+# Strings up to this length are interned.
+MAX_INTERNED = 64
+
+(NONE, TRUE, FALSE, INT, NEGINT, FLOAT, STR, NEWSTR, STRREF,
+ LIST, DICT) = range(11)
+
+DOUBLE = struct.Struct('>d')
+
+
+def _write_uint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _encode(out, table, value):
+    if value is None:
+        out.append(NONE)
+    elif value is True:
+        out.append(TRUE)
+    elif value is False:
+        out.append(FALSE)
+    elif isinstance(value, integer_types):
+        if value >= 0:
+            out.append(INT)
+            _write_uint(out, value)
+        else:
+            out.append(NEGINT)
+            _write_uint(out, -value)
+    elif isinstance(value, float):
+        out.append(FLOAT)
+        out.extend(DOUBLE.pack(value))
+    elif isinstance(value, string_types):
+        if len(value) <= MAX_INTERNED:
+            index = table.get(value)
+            if index is not None:
+                out.append(STRREF)
+                _write_uint(out, index)
+                return
+            table[value] = len(table)
+            out.append(NEWSTR)
+        else:
+            out.append(STR)
+        if not isinstance(value, binary_type):
+            value = value.encode('utf-8')
+        _write_uint(out, len(value))
+        out.extend(value)
+    elif isinstance(value, (list, tuple)):
+        out.append(LIST)
+        _write_uint(out, len(value))
+        for item in value:
+            _encode(out, table, item)
+    elif isinstance(value, dict):
+        out.append(DICT)
+        _write_uint(out, len(value))
+        for key, item in iteritems(value):
+            _encode(out, table, key)
+            _encode(out, table, item)
+    else:
+        raise TypeError('cannot encode %r' % (value,))
+
+
+def encode(value):
+    """Encode *value* to bytes."""
+    out = bytearray()
+    _encode(out, {}, value)
+    return bytes(out)
+
+
+class Decoder(object):
+
+    def __init__(self, data):
+        self.data = bytearray(data)
+        self.pos = 0
+        self.table = []
+
+    def read_uint(self):
+        n = shift = 0
+        while True:
+            byte = self.data[self.pos]
+            self.pos += 1
+            n |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return n
+            shift += 7
+
+    def read_str(self):
+        size = self.read_uint()
+        if self.pos + size > len(self.data):
+            raise ValueError('truncated data')
+        value = bytes(self.data[self.pos:self.pos + size]).decode('utf-8')
+        self.pos += size
+        return value
+
+    def decode(self):
+        tag = self.data[self.pos]
+        self.pos += 1
+        if tag == NONE:
+            return None
+        elif tag == TRUE:
+            return True
+        elif tag == FALSE:
+            return False
+        elif tag == INT:
+            return self.read_uint()
+        elif tag == NEGINT:
+            return -self.read_uint()
+        elif tag == FLOAT:
+            value = DOUBLE.unpack_from(self.data, self.pos)[0]
+            self.pos += DOUBLE.size
+            return value
+        elif tag == STR:
+            return self.read_str()
+        elif tag == NEWSTR:
+            value = self.read_str()
+            self.table.append(value)
+            return value
+        elif tag == STRREF:
+            return self.table[self.read_uint()]
+        elif tag == LIST:
+            return [self.decode() for _ in range(self.read_uint())]
+        elif tag == DICT:
+            result = {}
+            for _ in range(self.read_uint()):
+                key = self.decode()
+                result[key] = self.decode()
+            return result
+        raise ValueError('invalid tag %d at position %d' % (tag, self.pos - 1))
+
+
+def decode(data):
+    """Decode a value from bytes created by `encode`."""
+    decoder = Decoder(data)
+    try:
+        value = decoder.decode()
+    except (IndexError, struct.error):
+        raise ValueError('truncated data')
+    if decoder.pos != len(decoder.data):
+        raise ValueError('trailing data')
+    return value
@@ -51,6 +51,9 @@ class Config(object):
     iface_config = {}
     interfaces = ['xmlrpc', 'udp']
     unauth_level = DISPLAY
+    poll_workers = 4
+    max_commands = 16
+    init_workers = 8
 
     def __init__(self, confdir=None):
         self.confdir = confdir
@@ -63,6 +66,8 @@ class Config(object):
         self.job_config = {}
         self.auth_config = {}
         self.iface_config = {}
+        # Problems found while reading, to be logged by the caller.
+        self.warnings = []
         if confdir is None or not path.isdir(self.confdir):
             return
 
@@ -70,6 +75,15 @@ class Config(object):
             if fn.endswith('.conf'):
                 self._read_one(path.join(self.confdir, fn))
 
+    def _parse_int(self, parser, option, default):
+        value = parser.get('general', option)
+        try:
+            return int(value)
+        except ValueError:
+            self.warnings.append('could not parse %s: %r, using %s' %
+                                 (option, value, default))
+            return default
+
     def _read_one(self, fname):
         parser = CasePreservingConfigParser()
         parser.read(fname)
@@ -92,6 +106,15 @@ class Config(object):
                     perm = parser.get('general', 'unauth_level')
                     self.unauth_level = STRING_LEVELS.get(perm.lower().strip(),
                                                           DISPLAY)
+                if parser.has_option('general', 'pollworkers'):
+                    self.poll_workers = self._parse_int(
+                        parser, 'pollworkers', self.poll_workers)
+                if parser.has_option('general', 'maxcommands'):
+                    self.max_commands = self._parse_int(
+                        parser, 'maxcommands', self.max_commands)
+                if parser.has_option('general', 'initworkers'):
+                    self.init_workers = self._parse_int(
+                        parser, 'initworkers', self.init_workers)
             elif section.startswith('job.'):
                 self.job_config[section[4:]] = dict(parser.items(section))
             elif section.startswith('auth.'):
@@ -94,6 +94,9 @@ class Daemon(object):
                 self.log.exception('cannot open logfile: %s', err)
             return False
 
+        for warning in self.config.warnings:
+            self.log.warning(warning)
+
         if not self.config.interfaces:
             self.log.error('no interfaces configured, the daemon will not do '
                            'anything useful!')
@@ -120,7 +123,9 @@ class Daemon(object):
 
         self.log.info('Starting marche %s ...', __version__)
 
-        jobhandler = JobHandler(self.config, self.log)
+        # Jobs are initialized in the background, so that the interfaces are
+        # available right away.
+        jobhandler = JobHandler(self.config, self.log, wait=False)
         authhandler = AuthHandler(self.config, self.log)
 
         for interface in self.config.interfaces:
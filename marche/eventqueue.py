@@ -0,0 +1,117 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# Marche - A server control daemon
+# Copyright (c) 2015-2016 by the authors, see LICENSE
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <g.brandl@fz-juelich.de>
+#
+# *****************************************************************************
+
+"""Queued delivery of events to subscribers.
+
+Events are produced by the pollers and job handler in many threads.  To keep
+slow consumers (e.g. network clients) from blocking the producers, every
+subscriber gets its own bounded queue and a thread that delivers the events.
+
+Status events for the same service instance are coalesced: if a newer one
+arrives while an older one is still queued, only the newer one is delivered.
+"""
+
+import itertools
+import threading
+from collections import OrderedDict
+
+from marche.protocol import StatusEvent
+
+
+class EventQueue(object):
+    """Bounded queue of events that coalesces status events.
+
+    If the queue is full, the oldest event is dropped.
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._events = OrderedDict()
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def __len__(self):
+        return len(self._events)
+
+    def put(self, event):
+        if isinstance(event, StatusEvent):
+            key = ('status', event.service, event.instance)
+        else:
+            key = next(self._counter)
+        with self._cond:
+            # Replacing an existing key keeps its position in the queue.
+            self._events[key] = event
+            while len(self._events) > self.maxsize:
+                self._events.popitem(last=False)
+                self.dropped += 1
+            self._cond.notify()
+
+    def get(self):
+        """Return the next event, or None if the queue is closed."""
+        with self._cond:
+            while not self._events and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                return None
+            return self._events.popitem(last=False)[1]
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class Subscriber(object):
+    """Delivers events to *callback* from a dedicated thread."""
+
+    def __init__(self, callback, log, maxsize=1000):
+        self.callback = callback
+        self.log = log
+        self.queue = EventQueue(maxsize)
+        self._reported = 0
+        self._thread = threading.Thread(target=self._deliver)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def put(self, event):
+        self.queue.put(event)
+
+    def stop(self):
+        self.queue.close()
+
+    def _deliver(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                return
+            if self.queue.dropped != self._reported:
+                self.log.warning('event queue overflow, %d events dropped' %
+                                 (self.queue.dropped - self._reported))
+                self._reported = self.queue.dropped
+            try:
+                self.callback(event)
+            except Exception:
+                self.log.exception('error delivering event %r' % event)
@@ -0,0 +1,314 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# Marche - A server control daemon
+# Copyright (c) 2015-2016 by the authors, see LICENSE
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <g.brandl@fz-juelich.de>
+#
+# *****************************************************************************
+
+"""Execution of commands for all jobs.
+
+All commands run by jobs are submitted to the daemon-wide `executor`, which
+collects the output of all running commands in a single thread, and limits
+the number of commands running at the same time.
+"""
+
+import os
+import time
+import signal
+import threading
+import collections
+from subprocess import Popen, PIPE
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # Windows, where the executor thread is not used
+
+from marche.utils import AsyncProcess, Poller, POLLIN, output_pipes, \
+    read_output, close_output, signal_process, stop_timed_out
+
+
+class Command(object):
+    """A command to be run by the executor.
+
+    Once started, it acts as a future for the command's result: `join` waits
+    until it is done, after which the ``retcode``, ``stdout`` and ``stderr``
+    attributes are filled.  If given, *callback* is called with the command
+    as its argument when it is done.
+    """
+
+    def __init__(self, status, log, cmd, sh=True, stdout=None, stderr=None,
+                 timeout=None, callback=None, env=None):
+        self.status = status
+        self.log = log
+        self.cmd = cmd
+        self.use_sh = sh
+        self.timeout = timeout
+        self.env = env
+        self.callback = callback
+
+        self.done = False
+        self.timed_out = False
+        self.retcode = None
+        self.stdout = stdout if stdout is not None else []
+        self.stderr = stderr if stderr is not None else []
+
+        self._event = threading.Event()
+        # Only used by the executor thread.
+        self._proc = None
+        self._pipes = {}
+        self._deadline = None
+        self._kill_time = None
+        # Poll interval once the output is closed, increased while the
+        # process keeps running.
+        self._exit_poll = None
+
+    def start(self):
+        """Submit the command to the executor."""
+        executor.submit(self)
+
+    def join(self, timeout=None):
+        """Wait until the command is done."""
+        self._event.wait(timeout)
+
+    def _finish(self, retcode):
+        self.retcode = retcode
+        self.done = True
+        self._event.set()
+        if self.callback is not None:
+            try:
+                self.callback(self)
+            except Exception:
+                self.log.exception('error in command callback')
+
+
+class Executor(object):
+    """Runs commands, and collects their output in a single thread."""
+
+    #: Maximum seconds to wait for output before checking the processes.
+    POLL_INTERVAL = 0.5
+    #: Initial seconds between checks of processes that closed their output.
+    EXIT_POLL_INTERVAL = 0.01
+    #: Seconds between terminating and killing a command that timed out.
+    KILL_DELAY = 5.0
+
+    def __init__(self, max_running=16):
+        self.max_running = max_running
+        self._lock = threading.Lock()
+        self._queue = collections.deque()
+        self._running = []
+        self._fds = {}
+        self._thread = None
+        self._poller = None
+        self._wakeup_fds = None
+
+    def set_max_running(self, max_running):
+        """Set the maximum number of commands that run at the same time."""
+        with self._lock:
+            self.max_running = max(1, max_running)
+        self._wakeup()
+
+    def submit(self, command):
+        """Queue a command to be run as soon as possible."""
+        if os.name == 'nt':  # pragma: no cover
+            # no poll() for pipes on Windows
+            return self._run_in_thread(command)
+        with self._lock:
+            self._queue.append(command)
+            if self._thread is None:
+                self._poller = Poller()
+                self._wakeup_fds = os.pipe()
+                fcntl.fcntl(self._wakeup_fds[1], fcntl.F_SETFL, os.O_NONBLOCK)
+                self._poller.register(self._wakeup_fds[0], POLLIN)
+                self._thread = threading.Thread(target=self._loop)
+                self._thread.setDaemon(True)
+                self._thread.start()
+        self._wakeup()
+
+    def _run_in_thread(self, command):  # pragma: no cover
+        proc = AsyncProcess(command.status, command.log, command.cmd,
+                            command.use_sh, command.stdout, command.stderr,
+                            command.timeout, command.env)
+
+        def run():
+            proc.run()
+            command.timed_out = proc.timed_out
+            command._finish(proc.retcode)
+        thread = threading.Thread(target=run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _wakeup(self):
+        # Under the lock, since _abort closes the pipe.
+        with self._lock:
+            if self._wakeup_fds is None:
+                return
+            try:
+                os.write(self._wakeup_fds[1], b'x')
+            except OSError:
+                # The pipe is full, so the loop wakes up anyway.
+                pass
+
+    def _loop(self):
+        try:
+            while True:
+                self._start_queued()
+                for (fd, _) in self._poller.poll(self._poll_timeout() * 1000):
+                    if fd == self._wakeup_fds[0]:
+                        os.read(fd, 4096)
+                    else:
+                        self._read(fd)
+                self._check_processes()
+        except Exception:
+            self._abort()
+
+    def _abort(self):
+        """Fail all commands after an unexpected error in the loop, so that
+        nobody waits for them forever.  The loop is restarted by the next
+        submitted command.
+        """
+        with self._lock:
+            commands = self._running + list(self._queue)
+            self._running = []
+            self._queue.clear()
+            self._fds = {}
+            self._thread = None
+            os.close(self._wakeup_fds[0])
+            os.close(self._wakeup_fds[1])
+            self._wakeup_fds = None
+        for command in commands:
+            command.log.exception('error in executor, command aborted: %s' %
+                                  command.cmd)
+            if command._proc is not None:
+                signal_process(command._proc, signal.SIGKILL)
+                command._proc.stdout.close()
+                command._proc.stderr.close()
+                command._proc = None
+            command._finish(-1)
+
+    def _start_queued(self):
+        while True:
+            with self._lock:
+                if not self._queue or len(self._running) >= self.max_running:
+                    return
+                command = self._queue.popleft()
+            self._start(command)
+
+    def _start(self, command):
+        command.log.debug('call [sh:%s]: %s' % (command.use_sh, command.cmd))
+        try:
+            # Start a new process group, so that we can kill the command
+            # together with its children (e.g. when run via the shell).
+            proc = Popen(command.cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                         shell=command.use_sh, env=command.env,
+                         preexec_fn=os.setsid)
+        except Exception as err:
+            command.log.error('could not run %s: %s' % (command.cmd, err))
+            command._finish(127)
+            return
+        proc.stdin.close()
+        command._proc = proc
+        command._pipes = output_pipes(proc, command.log, command.stdout,
+                                      command.stderr)
+        for fd in command._pipes:
+            self._fds[fd] = command
+            self._poller.register(fd, POLLIN)
+        if command.timeout:
+            command._deadline = time.time() + command.timeout
+        self._running.append(command)
+
+    def _poll_timeout(self):
+        timeout = self.POLL_INTERVAL
+        now = time.time()
+        for command in self._running:
+            if command._exit_poll is not None:
+                # Output is closed, but the process has not exited yet.
+                timeout = min(timeout, command._exit_poll)
+            for deadline in (command._deadline, command._kill_time):
+                if deadline is not None:
+                    timeout = min(timeout, max(0, deadline - now))
+        return timeout
+
+    def _read(self, fd):
+        """Read, log and store output from one of the pipes."""
+        if read_output(self._fds[fd]._pipes, fd):
+            return True
+        # EOF: the pipe is not polled anymore
+        self._poller.unregister(fd)
+        del self._fds[fd]
+        return False
+
+    def _close(self, command, fd):
+        close_output(command._pipes, fd)
+        self._poller.unregister(fd)
+        del self._fds[fd]
+
+    def _check_processes(self):
+        now = time.time()
+        for command in self._running[:]:
+            proc = command._proc
+            if proc.poll() is not None:
+                self._collect(command)
+                self._running.remove(command)
+                proc.stdout.close()
+                proc.stderr.close()
+                command._proc = None
+                command._finish(proc.returncode)
+            elif command._deadline is not None and now > command._deadline:
+                command.timed_out = True
+                stop_timed_out(command.log, command.cmd, proc)
+                command._deadline = None
+                command._kill_time = now + self.KILL_DELAY
+            elif command._kill_time is not None and now > command._kill_time:
+                stop_timed_out(command.log, command.cmd, proc, kill=True)
+                command._kill_time = None
+            if command._proc is not None and not command._pipes:
+                # Check often at first, since the process will usually exit
+                # right after closing its output, but back off for processes
+                # that keep running (e.g. daemons started by init scripts).
+                if command._exit_poll is None:
+                    command._exit_poll = self.EXIT_POLL_INTERVAL
+                else:
+                    command._exit_poll = min(2 * command._exit_poll,
+                                             self.POLL_INTERVAL)
+
+    def _collect(self, command):
+        """Collect the remaining output of an exited process, but don't wait
+        for pipes that are kept open by children started in the background.
+        """
+        poller = Poller()
+        for fd in command._pipes:
+            poller.register(fd, POLLIN)
+        # Limit the number of reads in case children keep writing.
+        for _ in range(100):
+            if not command._pipes:
+                break
+            events = poller.poll(0)
+            if not events:
+                break
+            for (fd, _) in events:
+                if not self._read(fd):
+                    poller.unregister(fd)
+        for fd in list(command._pipes):
+            self._close(command, fd)
+
+
+#: The executor shared by all jobs.
+executor = Executor()
@@ -49,6 +49,11 @@ class PollThread(QThread):
 
     def run(self):
         while self.running:
+            if self._client.version >= 3:
+                self.pollAll()
+                time.sleep(self._loopDelay)
+                continue
+
             try:
                 services = self._client.getServices()
             except Exception:
@@ -71,6 +76,14 @@ class PollThread(QThread):
             status, info = NOT_AVAILABLE, str(err)
         self.newData.emit(service, instance, status, info)
 
+    def pollAll(self):
+        try:
+            states = self._client.getAllServiceStatus()
+        except Exception:
+            return
+        for (service, instance), status in iteritems(states):
+            self.newData.emit(service, instance, status, None)
+
 
 class ClientError(Exception):
     def __init__(self, code, string):
@@ -152,6 +165,18 @@ class Client(object):
         return result
 
     def getServiceDescriptions(self, services):
+        if self.version >= 3:
+            result = {}
+            with self._lock:
+                descs = self._proxy.GetAllDescriptions()
+            for name, desc in iteritems(descs):
+                service, instance = self.splitServicePath(name)
+                if instance:
+                    result[service, instance] = desc
+                else:
+                    result[service] = desc
+            return result
+
         result = {}
         with self._lock:
             for service, instances in iteritems(services):
@@ -168,6 +193,10 @@ class Client(object):
     def getServicePath(self, service, instance):
         return '%s.%s' % (service, instance) if instance else service
 
+    def splitServicePath(self, path):
+        parts = path.split('.', 1)
+        return parts[0], parts[1] if len(parts) > 1 else None
+
     def startService(self, service, instance=None):
         servicePath = self.getServicePath(service, instance)
         try:
@@ -198,6 +227,30 @@ class Client(object):
         if self._pollThread:
             self._pollThread.poll(service, instance)
 
+    def _bulkAction(self, method, services):
+        paths = [self.getServicePath(service, instance)
+                 for (service, instance) in services]
+        try:
+            with self._lock:
+                getattr(self._proxy, method)(paths)
+        except xmlrpc.Fault as f:
+            raise ClientError(f.faultCode, f.faultString)
+        if self._pollThread:
+            for service, instance in services:
+                self._pollThread.poll(service, instance)
+
+    def startServices(self, services):
+        """Start a list of (service, instance), in dependency order."""
+        self._bulkAction('StartAll', services)
+
+    def stopServices(self, services):
+        """Stop a list of (service, instance), in dependency order."""
+        self._bulkAction('StopAll', services)
+
+    def restartServices(self, services):
+        """Restart a list of (service, instance), in dependency order."""
+        self._bulkAction('RestartAll', services)
+
     def getServiceStatus(self, service, instance=None):
         servicePath = self.getServicePath(service, instance)
         try:
@@ -206,6 +259,15 @@ class Client(object):
         except xmlrpc.Fault as f:
             raise ClientError(f.faultCode, f.faultString)
 
+    def getAllServiceStatus(self):
+        try:
+            with self._lock:
+                states = self._proxy.GetAllStatus()
+        except xmlrpc.Fault as f:
+            raise ClientError(f.faultCode, f.faultString)
+        return dict((self.splitServicePath(name), state[0])
+                    for (name, state) in iteritems(states))
+
     def getServiceOutput(self, service, instance=None):
         servicePath = self.getServicePath(service, instance)
         try:
@@ -324,18 +324,36 @@ class MultiJobButtons(QWidget):
         self._buttons = buttons
         self.setMinimumSize(QSize(30, 40))
 
+    def _bulkAction(self, method):
+        # Newer daemons can handle all instances at once, respecting the
+        # dependencies between them.
+        client = self._buttons[0]._client
+        for button in self._buttons:
+            button._item.setText(3, '')
+        try:
+            getattr(client, method)([(button._service, button._instance)
+                                     for button in self._buttons])
+        except ClientError as err:
+            self._buttons[0]._item.setText(3, str(err))
+
     @qtsig('')
     def on_startBtn_clicked(self):
+        if self._buttons and self._buttons[0]._client.version >= 4:
+            return self._bulkAction('startServices')
         for button in self._buttons:
             button.on_startBtn_clicked()
 
     @qtsig('')
     def on_stopBtn_clicked(self):
+        if self._buttons and self._buttons[0]._client.version >= 4:
+            return self._bulkAction('stopServices')
         for button in self._buttons:
             button.on_stopBtn_clicked()
 
     @qtsig('')
     def on_restartBtn_clicked(self):
+        if self._buttons and self._buttons[0]._client.version >= 4:
+            return self._bulkAction('restartServices')
         for button in self._buttons:
             button.on_restartBtn_clicked()
 
@@ -26,13 +26,21 @@
 """Job control dispatcher."""
 
 import uuid
+import threading
+from os import path
+from collections import OrderedDict
 
 from marche.six import iteritems
 
-from marche.protocol import ServiceListEvent, ControlOutputEvent, \
-    ConffileEvent, LogfileEvent, StatusEvent, FoundHostEvent
-from marche.jobs import Busy, Fault
+from marche.protocol import ServiceListEvent, ServiceDiffEvent, \
+    ControlOutputEvent, ConffileEvent, LogfileEvent, LogUpdateEvent, \
+    StatusEvent, FoundHostEvent, ProgressEvent
+from marche.jobs import Busy, Fault, INITIALIZING
 from marche.scan import scan_async
+from marche.polling import Scheduler, scheduler
+from marche.executor import executor
+from marche.utils import extract_loglines_since
+from marche.eventqueue import Subscriber
 from marche.permission import ClientInfo, DISPLAY, CONTROL, ADMIN
 
 
@@ -65,52 +73,220 @@ def command(silent=False):
 
 class JobHandler(object):
 
-    def __init__(self, config, log):
+    # Number of service list generations to keep for computing diffs.
+    max_generations = 16
+    # Seconds to wait for jobs to initialize before carrying on without them.
+    init_timeout = 60
+
+    def __init__(self, config, log, wait=True):
         self.config = config
         self.log = log
         self.uid = uuid.uuid4().hex
         self.jobs = {}
         self.service2job = {}
         self.interfaces = []
+        self._subscribers = []
+        self._reload_hooks = []
         self.unauth_level = config.unauth_level
-        self._add_jobs()
+        self.generation = 0
+        self._snapshots = OrderedDict()
+        self._generation_lock = threading.Lock()
+        # Jobs that are created, but not yet initialized, with the services
+        # known before init().
+        self._initializing = []
+        self._init_token = None
+        self._init_done = threading.Event()
+        self._init_pool = Scheduler(max(1, config.init_workers))
+        # Runs the actions of start_all etc.; more of them than commands that
+        # can run at the same time would only wait for the executor.
+        self._bulk_pool = Scheduler(max(1, config.max_commands))
+        # Serializes replacing the jobs and service2job dicts; they are never
+        # changed in place, so readers can iterate over them without a lock.
+        self._jobs_lock = threading.Lock()
+        scheduler.set_workers(config.poll_workers)
+        executor.set_max_running(config.max_commands)
+        self._add_jobs(wait=wait)
 
     def add_interface(self, iface):
         self.interfaces.append(iface)
+        self._subscribers.append(Subscriber(iface.emit_event, self.log))
+
+    def add_reload_hook(self, hook):
+        """Register a function to be called after every reload of the jobs,
+        regardless of the interface that triggered it.
+        """
+        self._reload_hooks.append(hook)
 
-    def _add_jobs(self):
+    def _add_jobs(self, names=None, wait=True):
+        """Add all configured jobs, or only those in *names*.
+
+        The jobs are checked and initialized concurrently, on a pool of
+        ``initworkers`` threads.  If *wait* is false, this returns immediately
+        and the jobs are added when they are initialized.  Otherwise, this
+        waits at most `init_timeout` seconds; jobs that take longer are added
+        in the background.
+        """
         self.log.info('adding jobs...')
-        for (name, config) in iteritems(self.config.job_config):
-            if 'type' not in config:
-                self.log.warning('job %r has no type assigned, '
-                                 'ignoring' % name)
-                continue
-            jobtype = config['type']
-            try:
-                mod = __import__('marche.jobs.%s' % jobtype, {}, {}, 'Job')
-            except Exception as err:
-                self.log.exception('could not import module %r for job %s: %s'
-                                   % (jobtype, name, err))
-                continue
-            try:
-                job = mod.Job(jobtype, name, config, self.log, self.emit_event)
-                if not job.check():
-                    job.log.error('feasibility check failed')
+        jobs = []
+        initializing = []
+        for (name, config) in sorted(iteritems(self.config.job_config)):
+            if names is None or name in names:
+                job = self._create_job(name, config)
+                if job is not None:
+                    jobs.append(job)
+                    # Only services known before init() can be shown, so
+                    # get_services() is not called during init().
+                    initializing.append((job, self._early_services(job)))
+        token = object()
+        with self._jobs_lock:
+            self._init_token = token
+            self._initializing = initializing
+            self._init_done.clear()
+
+        results = {}
+        state = {'remaining': len(jobs), 'waiting': wait}
+        lock = threading.Lock()
+        done = threading.Event()
+
+        def finish():
+            self._register_jobs(jobs, results, token)
+            done.set()
+            with lock:
+                if state['waiting']:
+                    return
+            self.emit_event(self.request_service_list(ClientInfo(ADMIN)))
+
+        def init(job):
+            self._init_job(job, results)
+            with lock:
+                state['remaining'] -= 1
+                if state['remaining']:
+                    return
+            finish()
+
+        if not jobs:
+            finish()
+        self._init_pool.set_workers(self.config.init_workers)
+        for job in jobs:
+            self._init_pool.call_soon(lambda job=job: init(job))
+        if wait and not done.wait(self.init_timeout):
+            with lock:
+                state['waiting'] = False
+            self.log.warning('not all jobs initialized after %s seconds, '
+                             'adding them in the background' %
+                             self.init_timeout)
+
+    def _early_services(self, job):
+        try:
+            return list(job.get_services())
+        except Exception:
+            return []
+
+    def _create_job(self, name, config):
+        if 'type' not in config:
+            self.log.warning('job %r has no type assigned, '
+                             'ignoring' % name)
+            return
+        jobtype = config['type']
+        try:
+            mod = __import__('marche.jobs.%s' % jobtype, {}, {}, 'Job')
+        except Exception as err:
+            self.log.exception('could not import module %r for job %s: %s'
+                               % (jobtype, name, err))
+            return
+        try:
+            return mod.Job(jobtype, name, config, self.log, self.emit_event)
+        except Exception as err:
+            self.log.exception('could not initialize job %s: %s' %
+                               (name, err))
+
+    def _init_job(self, job, results):
+        try:
+            if not job.check():
+                job.log.error('feasibility check failed')
+                return
+            job.init()
+            self.log.info('job %s initialized' % job.name)
+            results[job.name] = True
+        except Exception as err:
+            self.log.exception('could not initialize job %s: %s' %
+                               (job.name, err))
+
+    def _register_jobs(self, jobs, results, token):
+        """Register initialized jobs and their services.
+
+        *jobs* is sorted by name, so that on duplicate services, always the
+        same job wins.  If the initialization identified by *token* was
+        abandoned in the meantime, the jobs are shut down instead.
+        """
+        with self._jobs_lock:
+            if token is not self._init_token:
+                for job in jobs:
+                    if results.get(job.name):
+                        self.log.warning('job %s initialized too late, '
+                                         'shutting down' % job.name)
+                        job.shutdown()
+                return
+            new_jobs = dict(self.jobs)
+            service2job = dict(self.service2job)
+            for job in jobs:
+                if not results.get(job.name):
+                    continue
+                services = job.get_services()
+                try:
+                    for service, _ in services:
+                        other = service2job.get(service)
+                        if other and other is not job:
+                            raise RuntimeError('duplicate service %r, '
+                                               'provided by jobs %s and %s' %
+                                               (service, job.name,
+                                                other.name))
+                except Exception as err:
+                    self.log.exception('could not initialize job %s: %s' %
+                                       (job.name, err))
+                    job.shutdown()
                     continue
-                job.init()
-                self.log.info('job %s initialized' % name)
+                for service, instance in services:
+                    service2job[service] = job
+                    self.log.info('found service: %s.%s' %
+                                  (service, instance))
+                new_jobs[job.name] = job
+            self.service2job = service2job
+            self.jobs = new_jobs
+            self._initializing = []
+        self._update_generation()
+        self._init_done.set()
+
+    def _update_generation(self):
+        """Record the current service list, and increase the generation
+        if it changed.
+        """
+        snapshot = {}
+        for job in self.jobs.values():
+            with job.lock.read():
                 for service, instance in job.get_services():
-                    other = self.service2job.get(service)
-                    if other and other is not job:
-                        raise RuntimeError('duplicate service %r, '
-                                           'provided by jobs %s and %s' %
-                                           (service, name, other.name))
-                    self.service2job[service] = job
-                    self.log.info('found service: %s.%s' % (service, instance))
-                self.jobs[name] = job
-            except Exception as err:
-                self.log.exception('could not initialize job %s: %s' %
-                                   (name, err))
+                    if service not in snapshot:
+                        snapshot[service] = (job.jobtype,
+                                             dict(job._permissions), {})
+                    snapshot[service][2][instance] = \
+                        job.service_description(service, instance)
+        with self._generation_lock:
+            if self._snapshots and \
+               snapshot == self._snapshots[self.generation]:
+                return
+            # Store the snapshot before publishing the new generation, so
+            # that it can always be found by request_service_diff.
+            generation = self.generation + 1
+            self._snapshots[generation] = snapshot
+            self.generation = generation
+            while len(self._snapshots) > self.max_generations:
+                self._snapshots.popitem(last=False)
+
+    def _initializing_job(self, service):
+        """Return the initializing job the service belongs to, or None."""
+        for job, services in self._initializing:
+            if service in [svc for (svc, _) in services]:
+                return job
 
     def _get_job(self, service):
         """Return the job the service belongs to."""
@@ -120,19 +296,52 @@ class JobHandler(object):
             raise Fault('no such service: %s' % service)
 
     def emit_event(self, event):
-        """Emit an event to all connected clients."""
-        for iface in self.interfaces:
-            iface.emit_event(event)
+        """Emit an event to all connected clients.
+
+        The events are queued for each interface, so this never blocks.
+        """
+        for subscriber in self._subscribers:
+            subscriber.put(event)
 
     @command()
     def trigger_reload(self):
-        """Trigger a reload of the jobs and list of their services."""
-        for job in list(self.jobs.values()):
-            job.shutdown()
+        """Trigger a reload of the jobs and list of their services.
+
+        Only jobs whose configuration changed are shut down and recreated;
+        unchanged jobs keep running with their polled status.
+        """
+        if not self._init_done.wait(self.init_timeout):
+            self.log.warning('jobs still initializing after %s seconds, '
+                             'reloading anyway' % self.init_timeout)
+        old_config = self.config.job_config
         self.config.reload()
-        self.jobs = {}
-        self.service2job = {}
-        self._add_jobs()
+        for warning in self.config.warnings:
+            self.log.warning(warning)
+        new_config = self.config.job_config
+        jobs = {}
+        service2job = {}
+        with self._jobs_lock:
+            # Jobs of an unfinished initialization are shut down when they
+            # are done, and created again below.
+            self._init_token = None
+            for name, job in iteritems(self.jobs):
+                if new_config.get(name) != old_config.get(name):
+                    self.log.info('job %s changed or removed, shutting down'
+                                  % name)
+                    job.shutdown()
+                    continue
+                jobs[name] = job
+                for service, _ in job.get_services():
+                    service2job[service] = job
+            self.service2job = service2job
+            self.jobs = jobs
+        # This also retries jobs that could not be initialized before.
+        self._add_jobs([name for name in new_config if name not in jobs])
+        for hook in self._reload_hooks:
+            try:
+                hook()
+            except Exception:
+                self.log.exception('error in reload hook')
         # This will contain all services.  It's up to the interface to filter
         # the list when distributing to individual connected clients.
         self.emit_event(self.request_service_list(ClientInfo(ADMIN)))
@@ -151,23 +360,83 @@ class JobHandler(object):
         The service list is sent back as a single ServiceListEvent."""
         svcs = {}
         for job in self.jobs.values():
-            with job.lock:
-                for service, instance in job.get_services():
-                    if not job.has_permission(DISPLAY, client):
-                        continue
-                    if service not in svcs:
-                        svcs[service] = {
-                            'instances': {},
-                            'permissions': job.determine_permissions(client),
-                            'jobtype': job.jobtype,
-                        }
-                    state, ext = job.polled_service_status(service, instance)
-                    svcs[service]['instances'][instance] = {
-                        'desc': job.service_description(service, instance),
-                        'state': state,
-                        'ext_status': ext,
+            if not job.has_permission(DISPLAY, client):
+                continue
+            with job.lock.read():
+                services = [(service, instance,
+                             job.service_description(service, instance))
+                            for (service, instance) in job.get_services()]
+            # The status comes from the poller cache, without the lock.
+            for service, instance, desc in services:
+                if service not in svcs:
+                    svcs[service] = {
+                        'instances': {},
+                        'permissions': job.determine_permissions(client),
+                        'jobtype': job.jobtype,
                     }
-        return ServiceListEvent(services=svcs)
+                state, ext = job.polled_service_status(service, instance)
+                svcs[service]['instances'][instance] = {
+                    'desc': desc,
+                    'state': state,
+                    'ext_status': ext,
+                }
+        for job, services in self._initializing:
+            if not job.has_permission(DISPLAY, client):
+                continue
+            for service, instance in services:
+                svcs.setdefault(service, {
+                    'instances': {},
+                    'permissions': job.determine_permissions(client),
+                    'jobtype': job.jobtype,
+                })['instances'].setdefault(instance, {
+                    'desc': '',
+                    'state': INITIALIZING,
+                    'ext_status': 'job is initializing',
+                })
+        return ServiceListEvent(services=svcs, generation=self.generation)
+
+    @command(silent=True)
+    def request_service_diff(self, client, since):
+        """Request the changes to the service list since the generation
+        *since*.
+
+        Returns a ServiceDiffEvent, or a full ServiceListEvent if that
+        generation is too old.
+        """
+        generation = self.generation
+        old = self._snapshots.get(since)
+        current = self._snapshots.get(generation)
+        if old is None or current is None:
+            return self.request_service_list(client)
+
+        def visible(snapshot, service):
+            entry = snapshot.get(service)
+            return entry is not None and client.level >= entry[1][DISPLAY]
+
+        removed = [service for service in old if visible(old, service)
+                   and not visible(current, service)]
+        changed = {}
+        for service, entry in iteritems(current):
+            if not visible(current, service) or \
+               (visible(old, service) and old[service] == entry):
+                continue
+            job = self.service2job.get(service)
+            if job is None:
+                continue
+            # Only the status of changed services is looked up.
+            info = changed[service] = {
+                'instances': {},
+                'permissions': job.determine_permissions(client),
+                'jobtype': entry[0],
+            }
+            for instance, desc in iteritems(entry[2]):
+                state, ext = job.polled_service_status(service, instance)
+                info['instances'][instance] = {
+                    'desc': desc,
+                    'state': state,
+                    'ext_status': ext,
+                }
+        return ServiceDiffEvent(generation, since, changed, sorted(removed))
 
     def filter_services(self, client, event):
         """Filter a service list event to only jobs that the client can see."""
@@ -175,19 +444,24 @@ class JobHandler(object):
             return event
         new_svcs = {}
         for service in event.services:
-            if self._get_job(service).has_permission(DISPLAY, client):
+            # Services can be removed before the event is delivered.
+            job = self.service2job.get(service) or \
+                self._initializing_job(service)
+            if job is not None and job.has_permission(DISPLAY, client):
                 new_svcs[service] = event.services[service]
-        return ServiceListEvent(services=new_svcs)
+        return ServiceListEvent(services=new_svcs,
+                                generation=event.generation)
 
     def can_see_status(self, client, event):
         """Check if the client can see this status event."""
-        return self._get_job(event.service).has_permission(DISPLAY, client)
+        job = self.service2job.get(event.service)
+        return job is not None and job.has_permission(DISPLAY, client)
 
     # Not a command, but needed for XMLRPC.
     def get_service_description(self, client, service, instance):
         job = self._get_job(service)
         job.check_permission(DISPLAY, client)
-        with job.lock:
+        with job.lock.read():
             return job.service_description(service, instance)
 
     @command()
@@ -220,13 +494,163 @@ class JobHandler(object):
             job.restart_service(service, instance)
             job.poll_now()
 
+    def _bulk_waves(self, services):
+        """Sort the (service, instance) pairs into waves, so that each wave
+        only depends on services in the previous waves.
+
+        Returns the list of waves and the dependencies of each service.
+        """
+        keys = set(tuple(key) for key in services)
+        depends = {}
+        for key in keys:
+            job = self._get_job(key[0])
+            with job.lock.read():
+                depends[key] = set(dep for dep in job.get_dependencies(*key)
+                                   if dep in keys and dep != key)
+        all_depends = dict((key, set(deps)) for (key, deps)
+                           in iteritems(depends))
+        waves = []
+        while depends:
+            wave = sorted(key for (key, deps) in iteritems(depends)
+                          if not deps)
+            if not wave:
+                wave = sorted(depends)
+                self.log.warning('dependency cycle between %s, handling '
+                                 'them together' %
+                                 ', '.join('%s.%s' % key for key in wave))
+            waves.append(wave)
+            for key in wave:
+                del depends[key]
+            for deps in depends.values():
+                deps.difference_update(wave)
+        return waves, all_depends
+
+    def _bulk_action(self, client, services, actions, wait):
+        waves, depends = self._bulk_waves(services)
+        for wave in waves:
+            for service, _ in wave:
+                self._get_job(service).check_permission(CONTROL, client)
+        plan = []
+        for action in actions:
+            if action == 'stop':
+                # Dependent services are stopped first.
+                plan.extend((action, wave) for wave in reversed(waves))
+            else:
+                plan.extend((action, wave) for wave in waves)
+        if wait:
+            self._run_waves(plan, depends)
+        else:
+            thread = threading.Thread(target=self._run_waves,
+                                      args=(plan, depends))
+            thread.setDaemon(True)
+            thread.start()
+        return waves
+
+    def _run_waves(self, plan, depends):
+        # Failures of each action, so that e.g. a failed stop during a
+        # restart does not keep dependent services from being started.
+        failed = dict((action, set()) for (action, _) in plan)
+        for action, wave in plan:
+            # Services that share a command slot of their job are handled
+            # one after another.
+            groups = OrderedDict()
+            for key in wave:
+                if action == 'start' and depends[key] & failed[action]:
+                    failed[action].add(key)
+                    self.emit_event(ProgressEvent(
+                        key[0], key[1], action, 'failed',
+                        'dependency failed to start'))
+                    continue
+                job = self.service2job.get(key[0])
+                slot = job, job and job.control_key(*key)
+                groups.setdefault(slot, []).append(key)
+            if not groups:
+                continue
+            state = {'remaining': len(groups)}
+            lock = threading.Lock()
+            done = threading.Event()
+
+            def run(keys):
+                for key in keys:
+                    self._run_action(action, key, failed[action])
+                with lock:
+                    state['remaining'] -= 1
+                    if state['remaining']:
+                        return
+                done.set()
+
+            for keys in groups.values():
+                self._bulk_pool.call_soon(lambda keys=keys: run(keys))
+            done.wait()
+
+    def _run_action(self, action, key, failed):
+        """Run a start or stop action for a single service and wait until
+        the commands it started are finished.
+        """
+        service, instance = key
+        self.emit_event(ProgressEvent(service, instance, action, 'running'))
+        try:
+            job = self._get_job(service)
+            with job.lock:
+                before = job.control_commands()
+                job.invalidate(service, instance)
+                getattr(job, action + '_service')(service, instance)
+                commands = [cmd for cmd in job.control_commands()
+                            if not any(cmd is old for old in before)]
+                job.poll_now()
+            for cmd in commands:
+                cmd.join()
+            if any(cmd.retcode for cmd in commands):
+                raise Fault('command failed')
+        except Exception as err:
+            self.log.error('%s %s.%s failed: %s' %
+                           (action, service, instance, err))
+            failed.add(key)
+            self.emit_event(ProgressEvent(service, instance, action,
+                                          'failed', str(err)))
+        else:
+            self.emit_event(ProgressEvent(service, instance, action, 'done'))
+
+    @command()
+    def start_all(self, client, services, wait=False):
+        """Start a list of (service, instance) pairs.
+
+        Services are started in waves, after the services they depend on.
+        All services in a wave are started in parallel, except for services
+        that share a command slot of their job (see `Job.control_key`), which
+        are started one after another.  Progress is reported with
+        ProgressEvents; the list of waves is returned.
+        """
+        return self._bulk_action(client, services, ['start'], wait)
+
+    @command()
+    def stop_all(self, client, services, wait=False):
+        """Stop a list of (service, instance) pairs, in the reverse order
+        of `start_all`.
+        """
+        return self._bulk_action(client, services, ['stop'], wait)
+
+    @command()
+    def restart_all(self, client, services, wait=False):
+        """Restart a list of (service, instance) pairs by stopping them all
+        and starting them again, in the order of their dependencies.
+        """
+        return self._bulk_action(client, services, ['stop', 'start'], wait)
+
     @command(silent=True)
     def request_service_status(self, client, service, instance):
         """Return the status of a single service."""
+        if service not in self.service2job:
+            job = self._initializing_job(service)
+            if job is not None:
+                job.check_permission(DISPLAY, client)
+                return StatusEvent(service=service, instance=instance,
+                                   state=INITIALIZING,
+                                   ext_status='job is initializing')
         job = self._get_job(service)
         job.check_permission(DISPLAY, client)
-        with job.lock:
-            state, ext = job.polled_service_status(service, instance)
+        # Normally a lookup in the poller cache, which needs no lock.
+        state, ext = job.polled_service_status(service, instance)
         return StatusEvent(service=service, instance=instance,
                            state=state, ext_status=ext)
 
@@ -235,7 +659,7 @@ class JobHandler(object):
         """Return the last lines of output from starting/stopping."""
         job = self._get_job(service)
         job.check_permission(DISPLAY, client)
-        with job.lock:
+        with job.lock.read():
             output = job.service_output(service, instance)
         return ControlOutputEvent(service=service, instance=instance,
                                   content=output)
@@ -245,10 +669,40 @@ class JobHandler(object):
         """Return the most recent lines of the service's logfile."""
         job = self._get_job(service)
         job.check_permission(DISPLAY, client)
-        with job.lock:
+        with job.lock.read():
             logfiles = job.service_logs(service, instance)
         return LogfileEvent(service=service, instance=instance, files=logfiles)
 
+    @command(silent=True)
+    def request_logs_since(self, client, service, instance, cursors):
+        """Return the lines added to the service's logfiles since the
+        given cursors.
+        """
+        job = self._get_job(service)
+        job.check_permission(DISPLAY, client)
+        if not isinstance(cursors, dict):
+            raise Fault('invalid cursors: %r' % (cursors,))
+        with job.lock.read():
+            logfiles = job.service_logfiles(service, instance)
+        files = {}
+        new_cursors = {}
+        reset = []
+        for filename in logfiles:
+            filename = path.realpath(filename)
+            try:
+                text, cursor, is_reset = extract_loglines_since(
+                    filename, cursors.get(filename))
+            except (IOError, OSError):
+                continue
+            except ValueError as err:
+                raise Fault('%s: %s' % (filename, err))
+            files[filename] = text
+            new_cursors[filename] = cursor
+            if is_reset:
+                reset.append(filename)
+        return LogUpdateEvent(service=service, instance=instance, files=files,
+                              cursors=new_cursors, reset=sorted(reset))
+
     @command()
     def request_conffiles(self, client, service, instance):
         """Retrieve the relevant configuration file(s) for this service.
@@ -257,7 +711,7 @@ class JobHandler(object):
         """
         job = self._get_job(service)
         job.check_permission(ADMIN, client)
-        with job.lock:
+        with job.lock.read():
             confs = job.receive_config(service, instance)
         return ConffileEvent(service=service, instance=instance, files=confs)
 
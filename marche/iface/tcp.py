@@ -0,0 +1,345 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# Marche - A server control daemon
+# Copyright (c) 2015-2016 by the authors, see LICENSE
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <g.brandl@fz-juelich.de>
+#
+# *****************************************************************************
+
+""".. index:: tcp; interface
+
+TCP event interface
+-------------------
+
+This interface implements the new Marche protocol over plain TCP.  Unlike the
+XMLRPC interface, it pushes events to clients as they happen, so that clients
+do not need to poll for service status.
+
+Each message is a JSON object (as defined in :mod:`marche.protocol`),
+prefixed by its length in bytes as a 4-byte big-endian integer.  After
+connecting, the client receives a ``connected`` event and can authenticate
+with an ``auth`` command.  Afterwards, it receives ``status``, ``services`` and
+``host`` events for all services it is allowed to see, and can send all other
+commands.
+
+The ``startall``, ``stopall`` and ``restartall`` commands control many
+services at once, in the order of their dependencies.  The progress for each
+service is reported with ``progress`` events.
+
+To follow logfiles, clients can repeatedly send ``logupdate`` commands with
+the cursors from the last ``logupdate`` event, and only get the new lines.
+
+The ``connected`` event lists the supported message encodings.  Clients can
+switch the encoding of the messages they receive with an ``encoding`` command,
+which can also enable zlib compression of messages above a given size.
+Messages from clients can be sent in any supported encoding.
+
+Service lists carry a generation number.  Clients can request only the
+changes since a known generation, and after a client has received a service
+list, it is only sent the changes when the service list changes.
+
+.. describe:: [interfaces.tcp]
+
+   The configuration settings that can be set within the **interfaces.tcp**
+   section are:
+
+   .. describe:: port
+
+      **Default:** 8125
+
+      The port to listen for connections.
+
+   .. describe:: host
+
+      **Default:** 0.0.0.0
+
+      The host to bind to.
+"""
+
+import struct
+import threading
+
+from marche import __version__
+from marche.six.moves import socketserver
+
+from marche.jobs import Busy, Fault
+from marche.auth import AuthFailed
+from marche.eventqueue import Subscriber
+from marche.iface.base import Interface as BaseInterface
+from marche.permission import ClientInfo
+from marche.protocol import PROTO_VERSION, ENC_JSON, ENCODINGS, Commands, \
+    Errors, Command, ConnectedEvent, AuthEvent, ErrorEvent, ServiceEvent, \
+    ServiceListEvent, FoundHostEvent
+
+TCP_PORT = 8125
+
+# Frames larger than this are not accepted from clients.
+MAX_FRAME = 16 * 1024 * 1024
+
+HEADER = struct.Struct('>I')
+
+
+def recv_exactly(sock, size):
+    """Read exactly *size* bytes from *sock*, or return None on EOF."""
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def recv_frame(sock):
+    header = recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    size = HEADER.unpack(header)[0]
+    if size > MAX_FRAME:
+        raise ValueError('frame too large: %d bytes' % size)
+    return recv_exactly(sock, size)
+
+
+def make_frame(data):
+    return HEADER.pack(len(data)) + data
+
+
+class ClientHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.iface = self.server.iface
+        self.jobhandler = self.iface.jobhandler
+        self.log = self.iface.log
+        self.client_info = ClientInfo(self.jobhandler.unauth_level)
+        self.encoding = ENC_JSON
+        # Generation of the service list the client knows.
+        self.generation = None
+        self.compress_threshold = None
+        self._send_lock = threading.Lock()
+        self.send(ConnectedEvent(PROTO_VERSION, __version__,
+                                 self.jobhandler.unauth_level, ENCODINGS))
+        # Pushed events are queued so that a slow client does not hold up
+        # the others.
+        self.subscriber = Subscriber(self.push, self.log)
+        self.iface.add_client(self)
+
+    def finish(self):
+        self.iface.remove_client(self)
+        self.subscriber.stop()
+
+    def handle(self):
+        while True:
+            try:
+                data = recv_frame(self.request)
+            except Exception as err:
+                self.log.warning('[%s] connection error: %s' %
+                                 (self.client_address[0], err))
+                return
+            if data is None:
+                return
+            try:
+                cmd = Command.unserialize(data)
+            except Exception as err:
+                self.log.warning('[%s] invalid message: %s' %
+                                 (self.client_address[0], err))
+                return
+            if cmd is None:
+                continue
+            self.handle_command(cmd)
+
+    def handle_command(self, cmd):
+        service = getattr(cmd, 'service', '')
+        instance = getattr(cmd, 'instance', '')
+        try:
+            if cmd.type == Commands.AUTHENTICATE:
+                self.authenticate(cmd.user, cmd.passwd)
+                return
+            handler = getattr(self, 'cmd_' + cmd.type.strip('?'))
+            event = handler(cmd)
+        except Busy as err:
+            event = ErrorEvent(service, instance, Errors.BUSY, str(err))
+        except Fault as err:
+            event = ErrorEvent(service, instance, Errors.FAULT, str(err))
+        except Exception as err:
+            event = ErrorEvent(service, instance, Errors.EXCEPTION,
+                               'Unexpected exception: %s' % err)
+        if event is not None:
+            self.send(event)
+
+    def authenticate(self, user, passwd):
+        try:
+            self.client_info = self.iface.authhandler.authenticate(user,
+                                                                   passwd)
+        except AuthFailed:
+            self.send(AuthEvent(False))
+        else:
+            self.send(AuthEvent(True))
+
+    def send(self, event):
+        """Send an event to the client; can be called from any thread."""
+        with self._send_lock:
+            frame = make_frame(event.serialize(self.encoding,
+                                               self.compress_threshold))
+            self.request.sendall(frame)
+
+    def push(self, event):
+        """Send an event to the client, if it is allowed to see it."""
+        if isinstance(event, ServiceEvent):
+            if not self.jobhandler.can_see_status(self.client_info, event):
+                return
+        elif isinstance(event, ServiceListEvent):
+            if self.generation is None:
+                event = self.jobhandler.filter_services(self.client_info,
+                                                        event)
+            elif event.generation == self.generation:
+                return
+            else:
+                event = self.jobhandler.request_service_diff(
+                    self.client_info, self.generation)
+            self.generation = event.generation
+        elif not isinstance(event, FoundHostEvent):
+            return
+        try:
+            self.send(event)
+        except Exception as err:
+            self.log.warning('[%s] could not send event: %s' %
+                             (self.client_address[0], err))
+
+    # -- command handlers, return an event to send or None --
+
+    def cmd_encoding(self, cmd):
+        if cmd.encoding not in ENCODINGS:
+            raise Fault('unsupported encoding: %s' % cmd.encoding)
+        threshold = cmd.compress_threshold
+        if threshold is not None:
+            try:
+                threshold = int(threshold)
+            except (TypeError, ValueError):
+                raise Fault('invalid compression threshold: %r' % threshold)
+        with self._send_lock:
+            self.encoding = cmd.encoding
+            self.compress_threshold = threshold
+
+    def cmd_reload(self, cmd):
+        self.jobhandler.trigger_reload()
+
+    def cmd_scan(self, cmd):
+        self.jobhandler.scan_network()
+
+    def cmd_services(self, cmd):
+        if cmd.since is not None:
+            event = self.jobhandler.request_service_diff(self.client_info,
+                                                         cmd.since)
+        else:
+            event = self.jobhandler.request_service_list(self.client_info)
+        self.generation = event.generation
+        return event
+
+    def cmd_start(self, cmd):
+        self.jobhandler.start_service(self.client_info, cmd.service,
+                                      cmd.instance)
+
+    def cmd_stop(self, cmd):
+        self.jobhandler.stop_service(self.client_info, cmd.service,
+                                     cmd.instance)
+
+    def cmd_restart(self, cmd):
+        self.jobhandler.restart_service(self.client_info, cmd.service,
+                                        cmd.instance)
+
+    def cmd_startall(self, cmd):
+        self.jobhandler.start_all(self.client_info, cmd.services)
+
+    def cmd_stopall(self, cmd):
+        self.jobhandler.stop_all(self.client_info, cmd.services)
+
+    def cmd_restartall(self, cmd):
+        self.jobhandler.restart_all(self.client_info, cmd.services)
+
+    def cmd_status(self, cmd):
+        return self.jobhandler.request_service_status(
+            self.client_info, cmd.service, cmd.instance)
+
+    def cmd_output(self, cmd):
+        return self.jobhandler.request_control_output(
+            self.client_info, cmd.service, cmd.instance)
+
+    def cmd_logfiles(self, cmd):
+        return self.jobhandler.request_logfiles(
+            self.client_info, cmd.service, cmd.instance)
+
+    def cmd_logupdate(self, cmd):
+        return self.jobhandler.request_logs_since(
+            self.client_info, cmd.service, cmd.instance, cmd.cursors)
+
+    def cmd_conffiles(self, cmd):
+        return self.jobhandler.request_conffiles(
+            self.client_info, cmd.service, cmd.instance)
+
+    def cmd_sendconfig(self, cmd):
+        self.jobhandler.send_conffile(self.client_info, cmd.service,
+                                      cmd.instance, cmd.filename,
+                                      cmd.contents)
+
+
+class Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class Interface(BaseInterface):
+
+    iface_name = 'tcp'
+    poll_interval = 0.5
+
+    def init(self):
+        self._clients = set()
+        self._clients_lock = threading.Lock()
+
+    def add_client(self, client):
+        with self._clients_lock:
+            self._clients.add(client)
+
+    def remove_client(self, client):
+        with self._clients_lock:
+            self._clients.discard(client)
+
+    def emit_event(self, event):
+        with self._clients_lock:
+            clients = list(self._clients)
+        for client in clients:
+            client.subscriber.put(event)
+
+    def run(self):
+        port = int(self.config.get('port', TCP_PORT))
+        host = self.config.get('host', '0.0.0.0')
+
+        self.server = Server((host, port), ClientHandler)
+        self.server.iface = self
+
+        thd = threading.Thread(target=self._thread)
+        thd.setDaemon(True)
+        thd.start()
+        self.log.info('listening on %s:%s' % (host, port))
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    def _thread(self):
+        self.server.serve_forever(poll_interval=self.poll_interval)
@@ -48,13 +48,59 @@ always be enabled.
       **Default:** 0.0.0.0
 
       The host to bind to.
+
+   .. describe:: workers
+
+      **Default:** 8
+
+      The number of threads that handle requests concurrently.  Clients can
+      keep their connection open between requests (HTTP keep-alive); while a
+      connection is open, it occupies one of the threads.  Idle connections
+      are closed after a second, or as soon as other clients are waiting.
+
+   .. describe:: tokenlifetime
+
+      **Default:** 3600
+
+      The lifetime in seconds of session tokens returned by ``Authenticate``.
+      0 disables session tokens.
+
+   .. describe:: revokeonreload
+
+      **Default:** yes
+
+      If ``yes``, all session tokens become invalid when the jobs are
+      reloaded, via any interface.
+
+Instead of sending user and password with every request, clients can call
+``Authenticate`` once and send the returned token in an ``X-Marche-Token``
+header with subsequent requests.  The token carries the permission level of
+the client and is checked without asking the authenticators.
+
+Clients can query the state of all services in one request with
+``GetAllStatus`` and ``GetAllDescriptions`` (protocol version 3 and later), and
+bundle several calls into one request with ``system.multicall``.
+
+``StartAll``, ``StopAll`` and ``RestartAll`` (protocol version 4 and later)
+take a list of service names and control them in the background, in the order
+of their dependencies.
+
+``GetLogsSince`` (protocol version 5 and later) takes a service name and a
+struct of cursors as returned by the last call (empty at first), and returns a
+struct with the new lines (``files``), the new ``cursors``, and the names of
+files whose content was ``reset`` (i.e. the new lines replace the old ones).
 """
 
+import os
+import hmac
+import time
 import base64
+import select
+import hashlib
 import threading
 
 from marche.six import iteritems
-from marche.six.moves import xmlrpc_client, xmlrpc_server
+from marche.six.moves import queue, xmlrpc_client, xmlrpc_server
 
 from marche.jobs import Busy, Fault
 from marche.iface.base import Interface as BaseInterface
@@ -67,13 +113,52 @@ class AuthRequestHandler(xmlrpc_server.SimpleXMLRPCRequestHandler):
     rpc_paths = ('/xmlrpc',)
     needs_auth = False
     unauth_level = DISPLAY
+    # Allow keep-alive connections, but close them when idle.  The socket
+    # timeout applies while reading a request, the idle timeout between them.
+    protocol_version = 'HTTP/1.1'
+    timeout = 10
+    idle_timeout = 1
+    idle_poll = 0.05
 
     def log_message(self, fmt, *args):
         self.log.debug('[%s] %s' % (self.client_address[0], fmt % args))
 
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self._wait_for_request():
+            self.handle_one_request()
+
+    def _wait_for_request(self):
+        """Wait for the next request on a kept-alive connection.
+
+        Return False if the connection was idle for too long, or if other
+        clients are waiting for a thread in the meantime.
+        """
+        for _ in range(int(self.idle_timeout / self.idle_poll)):
+            if self.server.has_waiting_requests():
+                return False
+            if select.select([self.connection], [], [], self.idle_poll)[0]:
+                return True
+        return False
+
+    def end_headers(self):
+        # Give the thread to other clients if they are waiting.
+        if self.server.has_waiting_requests():
+            self.send_header('Connection', 'close')
+        xmlrpc_server.SimpleXMLRPCRequestHandler.end_headers(self)
+
     def do_POST(self):
         self.client_info = ClientInfo(self.unauth_level)
 
+        if 'X-Marche-Token' in self.headers:
+            level = self.tokens.check(self.headers['X-Marche-Token'])
+            if level is None:
+                self.send_error(401)
+                return
+            self.client_info = ClientInfo(level)
+            return xmlrpc_server.SimpleXMLRPCRequestHandler.do_POST(self)
+
         # Backwards compatibility: if we *can* auth, we make it required.
         if self.needs_auth and 'Authorization' not in self.headers:
             self.send_error(401)
@@ -91,12 +176,94 @@ class AuthRequestHandler(xmlrpc_server.SimpleXMLRPCRequestHandler):
         return xmlrpc_server.SimpleXMLRPCRequestHandler.do_POST(self)
 
     def _dispatch(self, method, params):
+        if method == 'system.multicall':
+            return self._multicall(*params)
         try:
             func = getattr(self.server.instance, method)
         except AttributeError:
             raise Exception('method "%s" is not supported' % method)
         return func(self.client_info, *params)
 
+    def _multicall(self, calls):
+        # Same semantics as SimpleXMLRPCDispatcher.system_multicall, but
+        # dispatching with the client info of this request.
+        results = []
+        for call in calls:
+            try:
+                result = self._dispatch(call['methodName'], call['params'])
+                results.append([result])
+            except xmlrpc_client.Fault as err:
+                results.append({'faultCode': err.faultCode,
+                                'faultString': err.faultString})
+            except Exception as err:
+                results.append({'faultCode': Errors.EXCEPTION,
+                                'faultString': 'Unexpected exception: %s'
+                                % err})
+        return results
+
+
+class PooledXMLRPCServer(xmlrpc_server.SimpleXMLRPCServer):
+    """XMLRPC server that handles requests in a fixed pool of threads."""
+
+    def __init__(self, addr, workers, **kwds):
+        xmlrpc_server.SimpleXMLRPCServer.__init__(self, addr, **kwds)
+        self._requests = queue.Queue()
+        for _ in range(workers):
+            thread = threading.Thread(target=self._worker)
+            thread.setDaemon(True)
+            thread.start()
+
+    def has_waiting_requests(self):
+        return not self._requests.empty()
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def _worker(self):
+        while True:
+            request, client_address = self._requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+class SessionTokens(object):
+    """Issues and checks signed tokens carrying a permission level."""
+
+    def __init__(self, lifetime):
+        self.lifetime = lifetime
+        self._secret = os.urandom(32)
+
+    def _sign(self, payload):
+        return hmac.new(self._secret, payload.encode(),
+                        hashlib.sha256).hexdigest()
+
+    def issue(self, level):
+        if self.lifetime <= 0:
+            raise Fault('session tokens are disabled')
+        payload = '%d:%d' % (level, time.time() + self.lifetime)
+        return payload + ':' + self._sign(payload)
+
+    def check(self, token):
+        """Return the level of a valid token, or None."""
+        try:
+            payload, signature = token.strip().rsplit(':', 1)
+            level, expiry = map(int, payload.split(':'))
+        except ValueError:
+            return None
+        if not hmac.compare_digest(self._sign(payload).encode(),
+                                   signature.encode()):
+            return None
+        if time.time() > expiry:
+            return None
+        return level
+
+    def revoke_all(self):
+        self._secret = os.urandom(32)
+
 
 def command(method):
     def new_method(self, *args):
@@ -116,9 +283,10 @@ def command(method):
 
 class RPCFunctions(object):
 
-    def __init__(self, jobhandler, log):
+    def __init__(self, jobhandler, log, tokens):
         self.jobhandler = jobhandler
         self.log = log
+        self.tokens = tokens
 
     def _split_name(self, name):
         if '.' in name:
@@ -126,6 +294,10 @@ class RPCFunctions(object):
         else:
             return name, ''
 
+    @command
+    def Authenticate(self, client_info):
+        return self.tokens.issue(client_info.level)
+
     @command
     def ReloadJobs(self, client_info):
         self.jobhandler.trigger_reload()
@@ -146,6 +318,26 @@ class RPCFunctions(object):
                     result.append(svcname + '.' + instance)
         return result
 
+    @command
+    def GetAllStatus(self, client_info):
+        list_event = self.jobhandler.request_service_list(client_info)
+        result = {}
+        for svcname, info in iteritems(list_event.services):
+            for instance, inst_info in iteritems(info['instances']):
+                name = svcname + '.' + instance if instance else svcname
+                result[name] = [inst_info['state'], inst_info['ext_status']]
+        return result
+
+    @command
+    def GetAllDescriptions(self, client_info):
+        list_event = self.jobhandler.request_service_list(client_info)
+        result = {}
+        for svcname, info in iteritems(list_event.services):
+            for instance, inst_info in iteritems(info['instances']):
+                name = svcname + '.' + instance if instance else svcname
+                result[name] = inst_info['desc']
+        return result
+
     @command
     def GetDescription(self, client_info, name):
         return self.jobhandler.get_service_description(
@@ -173,6 +365,26 @@ class RPCFunctions(object):
                 ret.append(name + ':' + line)
         return ret
 
+    @command
+    def GetLogsSince(self, client_info, name, cursors):
+        # XMLRPC integers are only 32 bits wide, so cursors are sent as
+        # "inode:offset:checksum" strings.
+        try:
+            cursors = dict((filename, cursor.split(':'))
+                           for (filename, cursor) in iteritems(cursors))
+        except AttributeError:
+            raise Fault('invalid cursors: %r' % (cursors,))
+        service, instance = self._split_name(name)
+        log_event = self.jobhandler.request_logs_since(
+            client_info, service, instance, cursors)
+        return {
+            'files': log_event.files,
+            'cursors': dict((filename, ':'.join(map(str, cursor)))
+                            for (filename, cursor)
+                            in iteritems(log_event.cursors)),
+            'reset': log_event.reset,
+        }
+
     @command
     def ReceiveConfig(self, client_info, name):
         config_event = self.jobhandler.request_conffiles(
@@ -201,6 +413,21 @@ class RPCFunctions(object):
     def Restart(self, client_info, name):
         self.jobhandler.restart_service(client_info, *self._split_name(name))
 
+    @command
+    def StartAll(self, client_info, names):
+        self.jobhandler.start_all(client_info,
+                                  [self._split_name(n) for n in names])
+
+    @command
+    def StopAll(self, client_info, names):
+        self.jobhandler.stop_all(client_info,
+                                 [self._split_name(n) for n in names])
+
+    @command
+    def RestartAll(self, client_info, names):
+        self.jobhandler.restart_all(client_info,
+                                    [self._split_name(n) for n in names])
+
 
 class Interface(BaseInterface):
 
@@ -215,14 +442,23 @@ class Interface(BaseInterface):
     def run(self):
         port = int(self.config.get('port', 8124))
         host = self.config.get('host', '0.0.0.0')
+        workers = int(self.config.get('workers', 8))
+        lifetime = float(self.config.get('tokenlifetime', 3600))
+        revoke = self.config.get('revokeonreload', 'yes').lower() in \
+            ('yes', 'true')
+        tokens = SessionTokens(lifetime)
 
         AuthRequestHandler.authhandler = self.authhandler
+        AuthRequestHandler.tokens = tokens
         AuthRequestHandler.unauth_level = self.jobhandler.unauth_level
         AuthRequestHandler.needs_auth = self.authhandler.needs_authentication()
 
-        self.server = xmlrpc_server.SimpleXMLRPCServer(
-            (host, port), requestHandler=AuthRequestHandler)
-        self.server.register_instance(RPCFunctions(self.jobhandler, self.log))
+        self.server = PooledXMLRPCServer(
+            (host, port), workers, requestHandler=AuthRequestHandler)
+        self.server.register_instance(
+            RPCFunctions(self.jobhandler, self.log, tokens))
+        if revoke:
+            self.jobhandler.add_reload_hook(tokens.revoke_all)
 
         thd = threading.Thread(target=self._thread)
         thd.setDaemon(True)
@@ -23,15 +23,21 @@
 #
 # *****************************************************************************
 
+import os
+import sys
+import json
+import shlex
 import collections
-import threading
 from os import path
 
+from marche.six.moves import shlex_quote
+
 from marche.jobs import Busy, Fault, Unauthorized, STARTING, STOPPING, \
     RUNNING, DEAD
 from marche.permission import DISPLAY, CONTROL, ADMIN, parse_permissions
 from marche.polling import Poller
-from marche.utils import AsyncProcess, read_file, write_file, extract_loglines
+from marche.executor import Command
+from marche.utils import RWLock, read_file, write_file, extract_loglines
 
 
 class Job(object):
@@ -49,6 +55,9 @@ class Job(object):
     .. automethod:: __init__
     """
 
+    #: Where to look for running processes.
+    PROC_DIR = '/proc'
+
     def __init__(self, jobtype, name, config, log, event_callback):
         """The constructor should not be overridden, rather implement the
         configure() method.
@@ -66,7 +75,7 @@ class Job(object):
         self.name = name
         self.config = config
         self.log = log.getChild(name)
-        self.lock = threading.Lock()
+        self.lock = RWLock()
         self._processes = {}
         self._output = {}
 
@@ -80,55 +89,157 @@ class Job(object):
             except ValueError:
                 self.log.error('could not parse permission string: %r' %
                                config['permissions'])
-        self.pollinterval = 3.0
-        if 'pollinterval' in config:
-            try:
-                self.pollinterval = float(config['pollinterval'])
-            except ValueError:
-                self.log.error('could not parse pollinterval: %r' %
-                               config['pollinterval'])
-        self.poller = Poller(self, self.pollinterval, event_callback)
+        self.pollinterval = self._parse_number(config, 'pollinterval',
+                                               3.0, float)
+        self.pollconcurrency = self._parse_number(config, 'pollconcurrency',
+                                                  1, int)
+        self.adaptivepoll = config.get('adaptivepoll', '').lower() in \
+            ('yes', 'true')
+        self.pollfastinterval = self._parse_number(config, 'pollfastinterval',
+                                                   0.5, float)
+        self.pollmaxinterval = self._parse_number(config, 'pollmaxinterval',
+                                                  10 * self.pollinterval,
+                                                  float)
+        self.servestale = config.get('servestale', '').lower() in \
+            ('yes', 'true')
+        self.cmdtimeout = self._parse_number(config, 'commandtimeout',
+                                             120.0, float)
+        self.pidfile = config.get('pidfile', '')
+        try:
+            self.pidfile.format(service='', instance='')
+        except (KeyError, ValueError, IndexError):
+            self.log.error('invalid pidfile pattern: %r' % self.pidfile)
+            self.pidfile = ''
+        self.pidexe = config.get('pidexe', '')
+        self.poller = Poller(self, self.pollinterval, event_callback,
+                             self.pollconcurrency, self.adaptivepoll,
+                             self.pollfastinterval, self.pollmaxinterval,
+                             self.servestale)
 
         self.configure(config)
 
     # Utilities
 
-    def _async_call(self, status, cmd, sh=True, output=None):
+    def _parse_number(self, config, key, default, convert):
+        if key not in config:
+            return default
+        try:
+            return convert(config[key])
+        except ValueError:
+            self.log.error('could not parse %s: %r' % (key, config[key]))
+            return default
+
+    def _command(self, base, *args):
+        """Return the argument list to run *base*, which may contain further
+        arguments separated by spaces, with *args*.
+        """
+        return shlex.split(base) + list(args)
+
+    def _capture_env(self, script):
+        """Return the environment that results from sourcing the shell
+        *script*, so that commands needing it can be run without a shell.
+
+        Returns None (i.e. the daemon's environment) if this fails.
+        """
+        code = 'import os, json; print(json.dumps(dict(os.environ)))'
+        proc = self._sync_call('. %s && exec %s -c %s' % (
+            shlex_quote(script), shlex_quote(sys.executable),
+            shlex_quote(code)))
+        try:
+            return dict(json.loads(proc.stdout[-1]))
+        except (IndexError, ValueError):
+            self.log.warning('could not get environment from %s' % script)
+            return None
+
+    def _async_call(self, status, cmd, sh=None, output=None, callback=None):
+        # Command lists are run directly, strings by the shell.
+        if sh is None:
+            sh = not isinstance(cmd, list)
         if output is not None:
-            output.append('$ %s\n' % cmd)
-        proc = AsyncProcess(status, self.log, cmd, sh, output, output)
+            output.append('$ %s\n' % (cmd if sh else ' '.join(cmd)))
+        proc = Command(status, self.log, cmd, sh, output, output,
+                       self.cmdtimeout, callback)
         proc.start()
         return proc
 
-    def _sync_call(self, cmd, sh=True):
-        proc = AsyncProcess(0, self.log, cmd, sh)
+    def _sync_call(self, cmd, sh=None, env=None):
+        if sh is None:
+            sh = not isinstance(cmd, list)
+        proc = Command(0, self.log, cmd, sh, timeout=self.cmdtimeout, env=env)
         proc.start()
         proc.join()
         return proc
 
+    def _async_done(self, proc):
+        # Update the status as soon as a start/stop command is done.
+        self.poll_now()
+
     def _async_start(self, sub, cmd):
         if sub in self._processes and not self._processes[sub].done:
             raise Busy
         output = self._output.setdefault(sub, collections.deque(maxlen=50))
-        self._processes[sub] = self._async_call(STARTING, cmd, output=output)
+        self._processes[sub] = self._async_call(STARTING, cmd, output=output,
+                                                callback=self._async_done)
 
     def _async_stop(self, sub, cmd):
         if sub in self._processes and not self._processes[sub].done:
             raise Busy
         output = self._output.setdefault(sub, collections.deque(maxlen=50))
-        self._processes[sub] = self._async_call(STOPPING, cmd, output=output)
+        self._processes[sub] = self._async_call(STOPPING, cmd, output=output,
+                                                callback=self._async_done)
 
     def _async_status_only(self, sub):
         if sub in self._processes and not self._processes[sub].done:
             return self._processes[sub].status
 
-    def _async_status(self, sub, cmd):
+    def _async_status(self, sub, cmd, service=None, instance=None):
         if sub in self._processes and not self._processes[sub].done:
             return self._processes[sub].status
+        if service is not None:
+            state = self._pidfile_status(service, instance)
+            if state is not None:
+                return state
         if self._sync_call(cmd).retcode == 0:
             return RUNNING
         return DEAD
 
+    def _pidfile_status(self, service, instance):
+        """Determine the status from the configured pidfile and the process
+        table, without running a command.
+
+        Returns None if the status cannot be determined this way.
+        """
+        if not self.pidfile or not path.isdir(self.PROC_DIR):
+            return None
+        pidfile = self.pidfile.format(service=service, instance=instance)
+        try:
+            with open(pidfile) as fp:
+                pid = int(fp.read().split()[0])
+        except (IOError, OSError, ValueError, IndexError):
+            return None
+        procdir = path.join(self.PROC_DIR, str(pid))
+        if not path.isdir(procdir):
+            # stale pidfile
+            return DEAD
+        if not self.pidexe:
+            return RUNNING
+        names = []
+        try:
+            names.append(os.readlink(path.join(procdir, 'exe')))
+        except OSError:
+            pass
+        try:
+            with open(path.join(procdir, 'cmdline'), 'rb') as fp:
+                cmdline = fp.read().decode('utf-8', 'replace')
+            names.extend(cmdline.split('\0')[:2])
+        except (IOError, OSError):
+            pass
+        for name in names:
+            if path.basename(name.replace(' (deleted)', '')) == self.pidexe:
+                return RUNNING
+        # the PID may have been reused by another process
+        return None
+
     # Public interface
 
     def has_permission(self, level, client):
@@ -156,14 +267,31 @@ class Job(object):
 
     def poll_now(self):
         """Let the poller poll now, if possible."""
-        self.poller.queue.put(True)
+        self.poller.poll_now()
+
+    def control_key(self, service, instance):
+        """Return the key under which the commands controlling the service
+        are run (see `_async_start`).
+
+        Bulk actions handle services with the same key one after another,
+        since only one command per key can run at a time.
+        """
+        return service, instance
+
+    def control_commands(self):
+        """Return the commands last run to start, stop or restart services.
+
+        Used to wait for the completion of bulk actions.
+        """
+        return list(self._processes.values())
 
     def polled_service_status(self, service, instance):
-        """Return the service status, if possible from the poller cache."""
-        result = self.poller.get(service, instance)
-        if result is not None:
-            return result
-        return self.service_status(service, instance)
+        """Return the service status, if possible from the poller cache.
+
+        The job's lock must not be held by the caller; it is only acquired
+        (for reading) if the status has to be queried.
+        """
+        return self.poller.query(service, instance)
 
     # Public interface to be implemented by subclasses
 
@@ -191,8 +319,8 @@ class Job(object):
 
         This can further configure the job after the feasibility check has run.
 
-        The default is to start the poller, so the base class method should be
-        normally called by subclasses.
+        The default is to register the poller with the daemon's poll scheduler,
+        so the base class method should be normally called by subclasses.
         """
         if self.pollinterval > 0:
             self.poller.start()
@@ -200,8 +328,9 @@ class Job(object):
     def shutdown(self):
         """Shut the job down.
 
-        The default is to stop the poller, so the base class method should be
-        normally called by subclasses.
+        The default is to deregister the poller from the daemon's poll
+        scheduler, so the base class method should be normally called by
+        subclasses.
         """
         self.poller.stop()
 
@@ -278,6 +407,15 @@ class Job(object):
         raise NotImplementedError('%s.service_status not implemented'
                                   % self.__class__.__name__)
 
+    def get_dependencies(self, service, instance):
+        """Return a list of ``(service, instance)`` names that must be running
+        for the given service to work.
+
+        Bulk actions start these before the service, and stop them after it.
+        The default is to return no dependencies.
+        """
+        return []
+
     def service_description(self, service, instance):
         """Return a string description of the service with the given name."""
         return ''
@@ -299,6 +437,15 @@ class Job(object):
         """
         return {}
 
+    def service_logfiles(self, service, instance):
+        """Return a list of the paths of the logfile(s) of the service, if
+        possible.
+
+        This is used to send only new lines of the logfiles to clients that
+        follow them.  The default is to return no logfiles.
+        """
+        return []
+
     def receive_config(self, service, instance):
         """Return the contents of the config file(s) of the service, if
         possible.
@@ -344,6 +491,9 @@ class LogfileMixin(object):
             ret.update(extract_loglines(log_file))
         return ret
 
+    def service_logfiles(self, service, instance):
+        return list(self.log_files)
+
 
 class ConfigMixin(object):
     """Mixin for receiving and sending a number of config files, stored as
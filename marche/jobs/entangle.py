@@ -42,6 +42,10 @@ This job has the following configuration parameters:
 
    .. describe:: permissions
                  pollinterval
+                 pollconcurrency
+                 adaptivepoll
+                 pidfile
+                 pidexe
 
       The :ref:`standard parameters <standard-params>` present for all jobs.
 
@@ -93,26 +97,36 @@ class Job(BaseJob):
     def get_services(self):
         return self._services
 
+    def control_key(self, service, instance):
+        return instance
+
     def start_service(self, service, instance):
-        self._async_start(instance, '%s start %s' % (self.INITSCR, instance))
+        self._async_start(instance,
+                          self._command(self.INITSCR, 'start', instance))
 
     def stop_service(self, service, instance):
-        self._async_stop(instance, '%s stop %s' % (self.INITSCR, instance))
+        self._async_stop(instance,
+                         self._command(self.INITSCR, 'stop', instance))
 
     def restart_service(self, service, instance):
-        self._async_start(instance, '%s restart %s' % (self.INITSCR, instance))
+        self._async_start(instance,
+                          self._command(self.INITSCR, 'restart', instance))
 
     def service_status(self, service, instance):
         # XXX check devices with Tango clients
-        return self._async_status(instance, '%s status %s' %
-                                  (self.INITSCR, instance)), ''
+        return self._async_status(instance,
+                                  self._command(self.INITSCR, 'status',
+                                                instance),
+                                  service, instance), ''
 
     def service_output(self, service, instance):
         return list(self._output.get(instance, []))
 
     def service_logs(self, service, instance):
-        logname = path.join(self._logdir, instance, 'current')
-        return extract_loglines(logname)
+        return extract_loglines(self.service_logfiles(service, instance)[0])
+
+    def service_logfiles(self, service, instance):
+        return [path.join(self._logdir, instance, 'current')]
 
     def receive_config(self, service, instance):
         cfgname = path.join(self._resdir, instance + '.res')
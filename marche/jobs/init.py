@@ -69,6 +69,10 @@ This job has the following configuration parameters:
 
    .. describe:: permissions
                  pollinterval
+                 pollconcurrency
+                 adaptivepoll
+                 pidfile
+                 pidexe
 
       The :ref:`standard parameters <standard-params>` present for all jobs.
 
@@ -109,16 +113,18 @@ class Job(LogfileMixin, ConfigMixin, BaseJob):
         return self.description
 
     def start_service(self, service, instance):
-        self._async_start(service, self.script + ' start')
+        self._async_start(service, self._command(self.script, 'start'))
 
     def stop_service(self, service, instance):
-        self._async_stop(service, self.script + ' stop')
+        self._async_stop(service, self._command(self.script, 'stop'))
 
     def restart_service(self, service, instance):
-        self._async_start(service, self.script + ' restart')
+        self._async_start(service, self._command(self.script, 'restart'))
 
     def service_status(self, service, instance):
-        return self._async_status(service, self.script + ' status'), ''
+        return self._async_status(service, self._command(self.script,
+                                                         'status'),
+                                  service, instance), ''
 
     def service_output(self, service, instance):
         return list(self._output.get(service, []))
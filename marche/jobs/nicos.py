@@ -48,6 +48,8 @@ This job has the following configuration parameters:
 
    .. describe:: permissions
                  pollinterval
+                 pollconcurrency
+                 adaptivepoll
 
       The :ref:`standard parameters <standard-params>` present for all jobs.
 
@@ -91,37 +93,49 @@ class Job(BaseJob):
 
     def init(self):
         self._services = [('nicos-system', '')]
-        lines = self._sync_call('%s 2>&1' % self._script).stdout
+        proc = self._sync_call(self._command(self._script))
         prefix = 'Possible services are '
-        if len(lines) >= 2 and lines[-1].startswith(prefix):
-            self._services.extend(('nicos', entry.strip()) for entry in
-                                  lines[-1][len(prefix):].split(','))
+        for line in proc.stdout + proc.stderr:
+            if line.startswith(prefix):
+                self._services.extend(('nicos', entry.strip()) for entry in
+                                      line[len(prefix):].split(','))
+                break
         BaseJob.init(self)
 
     def get_services(self):
         return self._services
 
+    def control_key(self, service, instance):
+        # All services are controlled via the same script.
+        return None
+
     def start_service(self, service, instance):
         if service == 'nicos-system':
-            return self._async_start(None, self._script + ' start')
-        return self._async_start(None, self._script + ' start %s' % instance)
+            return self._async_start(None, self._command(self._script,
+                                                         'start'))
+        return self._async_start(None, self._command(self._script, 'start',
+                                                     instance))
 
     def stop_service(self, service, instance):
         if service == 'nicos-system':
-            return self._async_stop(None, self._script + ' stop')
-        return self._async_stop(None, self._script + ' stop %s' % instance)
+            return self._async_stop(None, self._command(self._script, 'stop'))
+        return self._async_stop(None, self._command(self._script, 'stop',
+                                                    instance))
 
     def restart_service(self, service, instance):
         if service == 'nicos-system':
-            return self._async_start(None, self._script + ' restart')
-        return self._async_start(None, self._script + ' restart %s' % instance)
+            return self._async_start(None, self._command(self._script,
+                                                         'restart'))
+        return self._async_start(None, self._command(self._script, 'restart',
+                                                     instance))
 
     def service_status(self, service, instance):
         async_st = self._async_status_only(None)
         if async_st is not None:
             return async_st, ''
         if service == 'nicos-system':
-            output = self._sync_call('%s status' % self._script).stdout
+            output = self._sync_call(self._command(self._script,
+                                                   'status')).stdout
             something_dead = something_running = False
             for line in output:
                 if 'dead' in line:
@@ -134,15 +148,22 @@ class Job(BaseJob):
                 return RUNNING, ''
             return DEAD, ''
         else:
-            proc = self._sync_call(self._script + ' status %s' % instance)
+            proc = self._sync_call(self._command(self._script, 'status',
+                                                 instance))
             return RUNNING if proc.retcode == 0 else DEAD, ''
 
     def service_output(self, service, instance):
         return list(self._output.get(None, []))
 
     def service_logs(self, service, instance):
+        result = {}
+        for logfile in self.service_logfiles(service, instance):
+            result.update(extract_loglines(logfile))
+        return result
+
+    def service_logfiles(self, service, instance):
         if service == 'nicos-system':
-            return {}
+            return []
         if self._logpath is None:
             # extract nicos log directory
             cfg = configparser.RawConfigParser()
@@ -151,4 +172,4 @@ class Job(BaseJob):
                 self._logpath = cfg.get('nicos', 'logging_path')
             else:
                 self._logpath = path.join(self._root, 'log')
-        return extract_loglines(path.join(self._logpath, instance, 'current'))
+        return [path.join(self._logpath, instance, 'current')]
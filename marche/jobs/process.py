@@ -94,6 +94,8 @@ This job has the following configuration parameters:
 
    .. describe:: permissions
                  pollinterval
+                 pollconcurrency
+                 adaptivepoll
 
       The :ref:`standard parameters <standard-params>` present for all jobs.
 
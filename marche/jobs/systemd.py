@@ -33,6 +33,15 @@ This is a job for controlling services using systemd_.
 
 This is a simple job, because it defers most of its action to systemd.
 
+The status of all units configured in systemd jobs is queried with a single
+``systemctl show`` call per poll cycle, and shared between the jobs.  The
+extended status shows the unit's sub-state and main PID.
+
+Optionally, the job can subscribe to the unit's property changes on the D-Bus
+instead, which requires the ``dbus`` (dbus-python) and ``gi`` modules.  Status
+changes are then sent to clients immediately, and polling is only done as a
+safety net with a long interval.
+
 This job has the following configuration parameters:
 
 .. describe:: [job.xxx]
@@ -65,8 +74,21 @@ This job has the following configuration parameters:
       A nicer description for the job, to be displayed in the GUI.  Default is
       no description, and the job name will be displayed.
 
+   .. describe:: dbus
+
+      If ``yes``, watch the unit's status via D-Bus signals from systemd.  If
+      the D-Bus connection fails, the job falls back to normal polling.  The
+      default is ``no``.
+
+   .. describe:: dbuspollinterval
+
+      The poll interval, in seconds, to use when the status is watched via
+      D-Bus.  The default is 60 seconds.
+
    .. describe:: permissions
                  pollinterval
+                 pollconcurrency
+                 adaptivepoll
 
       The :ref:`standard parameters <standard-params>` present for all jobs.
 
@@ -77,8 +99,204 @@ A typical section looks like this::
     configfiles = /etc/dhcp/dhcpd.conf
 """
 
+import time
+import threading
+
+try:
+    import dbus
+    from dbus.mainloop.glib import DBusGMainLoop
+    from gi.repository import GLib
+except ImportError:  # pragma: no cover
+    dbus = None
+
+from marche.jobs import DEAD, STARTING, RUNNING, STOPPING
 from marche.jobs.base import Job as BaseJob, LogfileMixin, ConfigMixin
 
+ACTIVE_STATES = {
+    'active': RUNNING,
+    'reloading': RUNNING,
+    'activating': STARTING,
+    'deactivating': STOPPING,
+    'inactive': DEAD,
+    'failed': DEAD,
+}
+
+
+class UnitStatus(object):
+    """Status of all units used by systemd jobs, queried in one go."""
+
+    PROPERTIES = 'ActiveState,SubState,MainPID'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.units = set()
+        self.snapshot = {}
+        self.timestamp = 0
+        # Set if the last query failed; then no query is tried again for
+        # *maxage* seconds.
+        self.failed = False
+
+    def register(self, unit):
+        with self.lock:
+            self.units.add(unit)
+
+    def unregister(self, unit):
+        with self.lock:
+            self.units.discard(unit)
+            self.snapshot.pop(unit, None)
+
+    def invalidate(self, unit):
+        with self.lock:
+            self.snapshot.pop(unit, None)
+
+    def get(self, job, unit, maxage):
+        """Return the properties of *unit*, querying all units if the last
+        snapshot is older than *maxage* or does not contain the unit.
+
+        Returns None if the unit's properties could not be queried.
+        """
+        with self.lock:
+            if time.time() > self.timestamp + maxage:
+                self.failed = False
+            elif self.failed:
+                return None
+            if unit not in self.snapshot or \
+               time.time() > self.timestamp + maxage:
+                self._refresh(job, self.units | set([unit]))
+            return self.snapshot.get(unit)
+
+    def _refresh(self, job, units):
+        units = sorted(units)
+        proc = job._sync_call(job._command(job.SYSTEMCTL, 'show', '-p',
+                                           self.PROPERTIES, *units))
+        # systemctl shows one block of properties per unit, in the order
+        # given on the command line, separated by empty lines.
+        blocks = [{}]
+        for line in proc.stdout:
+            line = line.strip()
+            if not line:
+                if blocks[-1]:
+                    blocks.append({})
+                continue
+            key, _, value = line.partition('=')
+            blocks[-1][key] = value
+        if not blocks[-1]:
+            blocks.pop()
+        self.snapshot = {}
+        self.failed = proc.retcode != 0 or len(blocks) != len(units)
+        if not self.failed:
+            self.snapshot = dict(zip(units, blocks))
+        self.timestamp = time.time()
+
+
+#: The status shared between all systemd jobs.
+unit_status = UnitStatus()
+
+
+class UnitWatcher(object):
+    """Watches units for property changes, signalled by systemd on the D-Bus.
+
+    A single connection to the bus, with its own thread running the GLib
+    main loop, is shared by all systemd jobs.
+    """
+
+    SYSTEMD_NAME = 'org.freedesktop.systemd1'
+    SYSTEMD_PATH = '/org/freedesktop/systemd1'
+    MANAGER_IFACE = 'org.freedesktop.systemd1.Manager'
+    UNIT_IFACE = 'org.freedesktop.systemd1.Unit'
+    SERVICE_IFACE = 'org.freedesktop.systemd1.Service'
+    PROPS_IFACE = 'org.freedesktop.DBus.Properties'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bus = None
+        self.manager = None
+        self.watched = {}
+        self.props = {}
+
+    def _bus(self):
+        return dbus.SystemBus()
+
+    def _connect(self):
+        DBusGMainLoop(set_as_default=True)
+        self.bus = self._bus()
+        self.manager = dbus.Interface(
+            self.bus.get_object(self.SYSTEMD_NAME, self.SYSTEMD_PATH),
+            self.MANAGER_IFACE)
+        # Without a subscriber, systemd does not emit any signals.
+        self.manager.Subscribe()
+        self.bus.add_signal_receiver(
+            self._changed, signal_name='PropertiesChanged',
+            dbus_interface=self.PROPS_IFACE, bus_name=self.SYSTEMD_NAME,
+            path_keyword='path')
+        thread = threading.Thread(target=GLib.MainLoop().run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def watch(self, unit, callback):
+        """Call *callback* with the unit's properties whenever they change."""
+        with self.lock:
+            if self.bus is None:
+                self._connect()
+            path = str(self.manager.LoadUnit(unit))
+            self.watched[path] = (unit, callback)
+            self.props[path] = self._get_props(path, ['ActiveState',
+                                                      'SubState', 'MainPID'])
+            return dict(self.props[path])
+
+    def unwatch(self, unit):
+        with self.lock:
+            for path, (wunit, _) in list(self.watched.items()):
+                if wunit == unit:
+                    del self.watched[path]
+                    del self.props[path]
+
+    def _get_props(self, path, names):
+        obj = dbus.Interface(self.bus.get_object(self.SYSTEMD_NAME, path),
+                             self.PROPS_IFACE)
+        props = {}
+        for name in names:
+            iface = self.SERVICE_IFACE if name == 'MainPID' \
+                else self.UNIT_IFACE
+            try:
+                props[name] = str(obj.Get(iface, name))
+            except dbus.DBusException:
+                # e.g. MainPID of units that are not services
+                pass
+        return props
+
+    def _changed(self, interface, changed, invalidated, path=None):
+        with self.lock:
+            if path not in self.watched:
+                return
+            props = self.props[path]
+            for name in ('ActiveState', 'SubState', 'MainPID'):
+                if name in changed:
+                    props[name] = str(changed[name])
+            refetch = [name for name in invalidated
+                       if name in ('ActiveState', 'SubState', 'MainPID')]
+            if refetch:
+                props.update(self._get_props(path, refetch))
+            callback = self.watched[path][1]
+            props = dict(props)
+        callback(props)
+
+
+#: The D-Bus watcher shared between all systemd jobs.
+unit_watcher = UnitWatcher()
+
+
+def props_status(props):
+    """Return the status tuple for a unit with properties *props*, or None
+    if the properties don't allow to determine it.
+    """
+    if props is None or props.get('ActiveState') not in ACTIVE_STATES:
+        return None
+    ext_status = props.get('SubState', '')
+    if props.get('MainPID', '0') != '0':
+        ext_status += ' (PID %s)' % props['MainPID']
+    return ACTIVE_STATES[props['ActiveState']], ext_status
+
 
 class Job(LogfileMixin, ConfigMixin, BaseJob):
 
@@ -88,40 +306,94 @@ class Job(LogfileMixin, ConfigMixin, BaseJob):
     def configure(self, config):
         self.unit = config.get('unit', self.name)
         self.description = config.get('description', self.name)
+        self.use_dbus = config.get('dbus', '').lower() in ('yes', 'true')
+        self.dbus_pollinterval = self._parse_number(
+            config, 'dbuspollinterval', 60.0, float)
+        self._watching = False
         self.configure_logfile_mixin(config)
         self.configure_config_mixin(config)
 
     def check(self):
-        proc = self._sync_call(self.SYSTEMCTL + ' is-enabled %s' % self.unit)
+        proc = self._sync_call(self._command(self.SYSTEMCTL, 'is-enabled',
+                                             self.unit))
         if not proc.stdout and proc.stderr:
             self.log.warning('unit file for %s does not exist' % self.unit)
             return False
         return True
 
+    def init(self):
+        unit_status.register(self.unit)
+        if self.use_dbus:
+            self._watch()
+        BaseJob.init(self)
+
+    def shutdown(self):
+        BaseJob.shutdown(self)
+        unit_status.unregister(self.unit)
+        if self._watching:
+            unit_watcher.unwatch(self.unit)
+            self._watching = False
+
+    def _watch(self):
+        if dbus is None:
+            self.log.warning('dbus module not available, polling status')
+            return
+        try:
+            props = unit_watcher.watch(self.unit, self._props_changed)
+        except Exception as err:
+            self.log.warning('could not watch unit via D-Bus, polling '
+                             'status: %s' % err)
+            return
+        self._watching = True
+        # The poller is only a safety net now.
+        self.poller.set_interval(self.dbus_pollinterval)
+        self._props_changed(props)
+
+    def _props_changed(self, props):
+        result = props_status(props)
+        if result is not None:
+            self.poller.update(self.unit, '', result)
+
     def get_services(self):
         return [(self.unit, '')]
 
+    def invalidate(self, service, instance):
+        unit_status.invalidate(self.unit)
+        BaseJob.invalidate(self, service, instance)
+
     def service_description(self, service, instance):
         return self.description
 
     def start_service(self, service, instance):
-        self._async_start(service, self.SYSTEMCTL + ' start %s' % self.unit)
+        self._async_start(service, self._command(self.SYSTEMCTL, 'start',
+                                                 self.unit))
 
     def stop_service(self, service, instance):
-        self._async_stop(service, self.SYSTEMCTL + ' stop %s' % self.unit)
+        self._async_stop(service, self._command(self.SYSTEMCTL, 'stop',
+                                                self.unit))
 
     def restart_service(self, service, instance):
-        self._async_start(service, self.SYSTEMCTL + ' restart %s' % self.unit)
+        self._async_start(service, self._command(self.SYSTEMCTL, 'restart',
+                                                 self.unit))
 
     def service_status(self, service, instance):
-        return self._async_status(service, self.SYSTEMCTL + ' is-active %s'
-                                  % self.unit), ''
+        async_st = self._async_status_only(service)
+        if async_st is not None:
+            return async_st, ''
+        result = props_status(unit_status.get(self, self.unit,
+                                              0.5 * self.pollinterval))
+        if result is None:
+            # fall back to querying only this unit
+            return self._async_status(service, self._command(
+                self.SYSTEMCTL, 'is-active', self.unit)), ''
+        return result
 
     def service_output(self, service, instance):
         return list(self._output.get(service, []))
 
     def service_logs(self, service, instance):
         if not self.log_files:
-            proc = self._sync_call(self.JOURNALCTL + ' -n 500 -u %s')
+            proc = self._sync_call(self._command(self.JOURNALCTL, '-n', '500',
+                                                 '-u', self.unit))
             return {'journal': ''.join(proc.stdout)}
         return LogfileMixin.service_logs(self, service, instance)
@@ -43,14 +43,29 @@ This job has the following configuration parameters:
 
    .. describe:: permissions
                  pollinterval
+                 pollconcurrency
+                 adaptivepoll
+                 pidfile
+                 pidexe
 
       The :ref:`standard parameters <standard-params>` present for all jobs.
 
+   .. describe:: depcache
+
+      The file in which the device dependencies read from the TACO database
+      are cached.  The cache is used as long as the list of devices and
+      servers is unchanged; if dependencies between devices change without
+      that, the file must be removed.  Default is
+      :file:`/var/cache/marche/taco-{jobname}.json`; if empty, no cache is
+      used.
+
    No further configuration is necessary; the job will read the TACO
    database and derive parameters like available servers from there.
 """
 
 import os
+import json
+import hashlib
 from os import path
 
 from marche.six import iteritems
@@ -63,12 +78,20 @@ class Job(BaseJob):
 
     INIT_DIR = '/etc/init.d'
     LOG_DIR = '/var/log/taco'
-    DB_DEVLIST = '. /etc/tacoenv.sh; db_devicelist'
-    DB_DEVRES = '. /etc/tacoenv.sh; db_devres'
+    TACO_ENV = '/etc/tacoenv.sh'
+    DB_DEVLIST = 'db_devicelist'
+    DB_DEVRES = 'db_devres'
+    CACHE_DIR = '/var/cache/marche'
+    # Number of devices to query with one process.
+    DEVRES_BATCH = 100
 
     def configure(self, config):
+        self.depcache = config.get('depcache', path.join(
+            self.CACHE_DIR, 'taco-%s.json' % self.name))
+        self._env = None
         self._initscripts = {}
         self._depends = set()
+        self._direct_depends = {}
         self._services = []
 
     def check(self):
@@ -85,21 +108,43 @@ class Job(BaseJob):
         for fn in os.listdir(self.INIT_DIR):
             if fn.startswith('taco-server-'):
                 servers.add(fn[len('taco-server-'):])
-        # read device info for servers
-        serverinfo, alldevs, dev2server = self._read_devices(servers)
-        # collect device dependency info for servers
+        # the database tools need the TACO environment; source it only once
+        if path.exists(self.TACO_ENV):
+            self._env = self._capture_env(self.TACO_ENV)
+        devlist = self._sync_call(self._command(self.DB_DEVLIST),
+                                  env=self._env).stdout
+        fingerprint = hashlib.sha1(json.dumps(
+            [sorted(servers), devlist]).encode('utf-8')).hexdigest()
+        cached = self._load_cache(fingerprint)
+        if cached:
+            serverinfo, direct_deps = cached
+        else:
+            # read device info for servers
+            serverinfo, alldevs, dev2server = self._read_devices(servers,
+                                                                 devlist)
+            # collect device dependency info for servers
+            resources = self._read_resources(
+                [dev for instances in serverinfo.values()
+                 for devs in instances.values() for dev in devs])
+            direct_deps = {}
+            for server, instances in iteritems(serverinfo):
+                for instance, devs in iteritems(instances):
+                    direct_deps[server, instance] = self._get_dependencies(
+                        devs, resources, alldevs, dev2server)
+            self._save_cache(fingerprint, serverinfo, direct_deps)
         all_depends = {}
-        direct_deps = {}
-        for server, instances in iteritems(serverinfo):
-            for instance, devs in iteritems(instances):
-                direct_deps[server, instance] = \
-                    self._get_dependencies(devs, alldevs, dev2server)
-                all_depends[server, instance] = set()
+        for key in direct_deps:
+            all_depends[key] = set()
         for key, depends in iteritems(direct_deps):
             all_depends[key].update(depends)
             for revkey in depends:
                 all_depends[revkey].add(key)
         self._depends = all_depends
+        self._direct_depends = dict(
+            (('taco-' + srv, inst),
+             sorted(('taco-' + dsrv, dinst) for (dsrv, dinst) in deps
+                    if (dsrv, dinst) != (srv, inst)))
+            for ((srv, inst), deps) in iteritems(direct_deps))
         # construct services
         services = []
         for server, instances in iteritems(serverinfo):
@@ -116,54 +161,58 @@ class Job(BaseJob):
     def start_service(self, service, instance):
         key = service, instance
         initscript = self._initscripts[service]
-        self._async_start(key, initscript + ' start ' + instance)
+        self._async_start(key, self._command(initscript, 'start', instance))
 
     def stop_service(self, service, instance):
         key = service, instance
         initscript = self._initscripts[service]
-        self._async_stop(key, initscript + ' stop ' + instance)
+        self._async_stop(key, self._command(initscript, 'stop', instance))
 
     def restart_service(self, service, instance):
         key = service, instance
         initscript = self._initscripts[service]
-        self._async_start(key, initscript + ' restart ' + instance)
+        self._async_start(key, self._command(initscript, 'restart',
+                                             instance))
+
+    def get_dependencies(self, service, instance):
+        return self._direct_depends.get((service, instance), [])
 
     def service_status(self, service, instance):
         key = service, instance
         initscript = self._initscripts[service]
-        command = initscript + ' status ' + instance
-        return self._async_status(key, command), ''
+        command = self._command(initscript, 'status', instance)
+        return self._async_status(key, command, service, instance), ''
 
     def service_output(self, service, instance):
         key = service, instance
         return list(self._output.get(key, []))
 
     def service_logs(self, service, instance):
-        if not path.isdir(self.LOG_DIR):
-            return {}
-        srvname = service[5:]  # strip "taco-"
-        candidates = os.listdir(self.LOG_DIR)
         output = {}
-        for filename in candidates:
-            fullname = path.join(self.LOG_DIR, filename)
-            # check for srvname_instance
-            if filename.lower() == ('%s_%s.log' % (srvname, instance)).lower():
-                output.update(extract_loglines(fullname))
-            # check for srvname only
-            if filename.lower() == ('%s.log' % srvname).lower():
-                output.update(extract_loglines(fullname))
+        for fullname in self.service_logfiles(service, instance):
+            output.update(extract_loglines(fullname))
         return output
 
+    def service_logfiles(self, service, instance):
+        if not path.isdir(self.LOG_DIR):
+            return []
+        srvname = service[5:]  # strip "taco-"
+        # check for srvname_instance or srvname only
+        candidates = [('%s_%s.log' % (srvname, instance)).lower(),
+                      ('%s.log' % srvname).lower()]
+        return [path.join(self.LOG_DIR, filename)
+                for filename in os.listdir(self.LOG_DIR)
+                if filename.lower() in candidates]
+
     # -- internal APIs --
 
-    def _read_devices(self, restrict_servers):
+    def _read_devices(self, restrict_servers, devlist):
         servers = {}
         alldevices = set()
         dev2server = {}
         curserver = None
         curinstance = None
-        proc = self._sync_call(self.DB_DEVLIST)
-        for line in proc.stdout:
+        for line in devlist:
             if not line.strip():
                 continue
             if line.startswith('\t'):
@@ -183,17 +232,62 @@ class Job(BaseJob):
                 servers.setdefault(curserver, {}).setdefault(curinstance, [])
         return servers, alldevices, dev2server
 
-    def _get_dependencies(self, devs, alldevices, dev2server):
-        depends = set()
-        for dev in devs:
-            proc = self._sync_call(self.DB_DEVRES + ' ' + dev)
+    def _read_resources(self, devs):
+        """Return a dictionary of all resource values for each device."""
+        resources = dict((dev, []) for dev in devs)
+        # query many devices with one shell, which runs db_devres for each
+        script = 'cmd=$1; shift; for dev; do $cmd "$dev"; done'
+        for i in range(0, len(devs), self.DEVRES_BATCH):
+            batch = devs[i:i + self.DEVRES_BATCH]
+            proc = self._sync_call(['sh', '-c', script, 'sh', self.DB_DEVRES] +
+                                   batch, env=self._env)
             for line in proc.stdout:
                 if ':' not in line.strip():
                     continue
                 key, value = line.strip().split(':', 1)
-                value = value.strip()
-                kdev, _kres = key.rsplit('/', 1)
-                assert kdev == dev
+                kdev = key.rsplit('/', 1)[0]
+                if kdev in resources:
+                    resources[kdev].append(value.strip())
+        return resources
+
+    def _get_dependencies(self, devs, resources, alldevices, dev2server):
+        depends = set()
+        for dev in devs:
+            for value in resources[dev]:
                 if value in alldevices:
                     depends.add(dev2server[value])
         return depends
+
+    def _load_cache(self, fingerprint):
+        if not self.depcache or not path.isfile(self.depcache):
+            return None
+        try:
+            with open(self.depcache) as fp:
+                data = json.load(fp)
+            if data['fingerprint'] != fingerprint:
+                return None
+            direct_deps = dict(((srv, inst), set(tuple(dep) for dep in deps))
+                               for (srv, inst, deps) in data['depends'])
+            self.log.info('using cached device dependencies')
+            return data['serverinfo'], direct_deps
+        except Exception as err:
+            self.log.warning('could not read dependency cache: %s' % err)
+            return None
+
+    def _save_cache(self, fingerprint, serverinfo, direct_deps):
+        if not self.depcache:
+            return
+        data = {
+            'fingerprint': fingerprint,
+            'serverinfo': serverinfo,
+            'depends': [[srv, inst, sorted(deps)] for ((srv, inst), deps)
+                        in iteritems(direct_deps)],
+        }
+        try:
+            if not path.isdir(path.dirname(self.depcache)):
+                os.makedirs(path.dirname(self.depcache))
+            with open(self.depcache + '.tmp', 'w') as fp:
+                json.dump(data, fp)
+            os.rename(self.depcache + '.tmp', self.depcache)
+        except Exception as err:
+            self.log.warning('could not write dependency cache: %s' % err)
@@ -22,71 +22,435 @@
 #
 # *****************************************************************************
 
-"""Polling loop for jobs."""
+"""Polling loop for jobs.
+
+All pollers of the daemon share a single :class:`Scheduler`, which keeps the
+pending poll cycles in a heap keyed by their next due time and runs them on a
+small, bounded pool of worker threads.
+"""
 
 import time
+import heapq
+import random
+import functools
+import itertools
 import threading
+import collections
 
-from marche.six.moves import queue
-
+from marche.jobs import STARTING, STOPPING, INITIALIZING
 from marche.protocol import StatusEvent
 
+#: States in which a service is polled at the fast interval in adaptive mode.
+TRANSITIONAL_STATES = (STARTING, STOPPING, INITIALIZING)
+
+
+class Scheduler(object):
+    """Central scheduler that runs timed and immediate calls on a bounded pool
+    of worker threads.
+    """
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        self._cond = threading.Condition()
+        self._timed = []
+        self._urgent = collections.deque()
+        self._ready = collections.deque()
+        self._counter = itertools.count()
+        self._threads = []
+
+    def set_workers(self, workers):
+        """Set the maximum number of worker threads.
+
+        Already running workers are not stopped if the number is decreased.
+        """
+        with self._cond:
+            self.workers = max(1, workers)
+
+    def call_later(self, delay, func):
+        """Call *func* after *delay* seconds.  Returns a handle that can be
+        given to `cancel`.
+        """
+        entry = [time.time() + delay, next(self._counter), func]
+        with self._cond:
+            heapq.heappush(self._timed, entry)
+            self._wakeup()
+        return entry
+
+    def call_soon(self, func, urgent=False):
+        """Call *func* as soon as a worker is free.
+
+        Urgent calls are run before all other pending calls.
+        """
+        with self._cond:
+            if urgent:
+                self._urgent.append(func)
+            else:
+                self._ready.append(func)
+            self._wakeup()
+
+    def cancel(self, entry):
+        """Cancel a call scheduled with `call_later`."""
+        # The entry stays in the heap and is skipped when it is due.
+        entry[2] = None
+
+    def _wakeup(self):
+        # Called with the condition held.
+        self._threads = [t for t in self._threads if t.is_alive()]
+        if len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+        self._cond.notify()
+
+    def _next_call(self):
+        # Called with the condition held.
+        while True:
+            if self._urgent:
+                return self._urgent.popleft()
+            now = time.time()
+            while self._timed and self._timed[0][0] <= now:
+                func = heapq.heappop(self._timed)[2]
+                if func is not None:
+                    self._ready.append(func)
+            if self._ready:
+                return self._ready.popleft()
+            timeout = None
+            if self._timed:
+                timeout = self._timed[0][0] - now
+            self._cond.wait(timeout)
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                func = self._next_call()
+            try:
+                func()
+            except Exception:  # pragma: no cover
+                # Calls are expected to handle their own errors.
+                pass
+
+
+#: The scheduler shared by all pollers.
+scheduler = Scheduler()
+
 
 class Poller(object):
-    """The poller object; each job instantiates a poller and can start it."""
+    """The poller object; each job instantiates a poller and can start it.
+
+    The poller does not have its own thread; it registers its poll cycles with
+    the daemon-wide `scheduler`.
+
+    If *concurrency* is greater than one, the status of up to that many
+    services of the job is queried in parallel.  Otherwise, all services are
+    queried one after the other.  In both cases, the job's lock is held for
+    reading during the queries.
+
+    In *adaptive* mode, each service has its own poll interval: services in
+    a transitional state are polled every *fast_interval* seconds, while the
+    interval of services whose status does not change is doubled on every
+    poll, up to *max_interval*.  Any change of status resets it to the base
+    *interval*.
+
+    If the cached status of a service is outdated, `query` runs a status
+    query on demand.  Concurrent queries for the same service share one
+    query.  With *serve_stale*, the outdated status is returned at once
+    instead, and refreshed in the background.
+    """
 
-    def __init__(self, job, interval, event_callback):
+    def __init__(self, job, interval, event_callback, concurrency=1,
+                 adaptive=False, fast_interval=0.5, max_interval=None,
+                 serve_stale=False):
         self.job = job
         self.interval = interval
-        self.queue = queue.Queue()
+        self.concurrency = concurrency
+        self.adaptive = adaptive
+        self.fast_interval = fast_interval
+        self.max_interval = max_interval or 10 * interval
+        self.serve_stale = serve_stale
         self.event_callback = event_callback
-        self._thread = None
-        self._stoprequest = False
+        self.scheduler = scheduler
+        self._cond = threading.Condition()
+        self._active = False
+        self._running = False
+        self._again = False
+        self._queued = False
+        self._force = False
+        self._entry = None
+        self._pending = collections.deque()
+        self._inflight = 0
+        # Threads currently running a query of the cycle.
+        self._cycle_threads = set()
+        # Incremented on every stop, so that outstanding calls of an earlier
+        # run of the poller are ignored.
+        self._generation = 0
         self._cache = {}
+        # Per-service intervals and next due times for the adaptive mode.
+        self._intervals = {}
+        self._due = {}
+        # On-demand status queries in progress, by service.
+        self._flights = {}
 
     def start(self):
-        self._stoprequest = False
-        self._thread = threading.Thread(target=self._entry)
-        self._thread.setDaemon(True)
-        self._thread.start()
+        with self._cond:
+            if self._active:
+                return
+            self._active = True
+            # Spread the first cycles of all jobs over one interval, so that
+            # they don't all fork their status commands at the same time.
+            self._entry = self.scheduler.call_later(
+                random.random() * self.interval, self._make_call())
 
     def stop(self):
-        if self._thread and self._thread.isAlive():
-            self._stoprequest = True
-            self.queue.put(None)
-            self._thread.join()
+        with self._cond:
+            self._active = False
+            self._again = False
+            self._queued = False
+            self._generation += 1
+            if self._entry is not None:
+                self.scheduler.cancel(self._entry)
+                self._entry = None
+            # Wait for a running cycle to finish, unless called from it
+            # (e.g. by a job that shuts down when its status query fails).
+            if threading.current_thread() not in self._cycle_threads:
+                while self._running:
+                    self._cond.wait()
+
+    def set_interval(self, interval):
+        """Change the base poll interval.
+
+        The adaptive intervals are limited to at most *interval* as well, so
+        that backing off does not override it.
+        """
+        with self._cond:
+            self.interval = interval
+            self.max_interval = interval
+            self.fast_interval = min(self.fast_interval, interval)
+            self._intervals.clear()
+            self._due.clear()
+
+    def poll_now(self):
+        """Schedule a poll cycle of all services with priority over the
+        regular ones.
+        """
+        with self._cond:
+            if not self._active:
+                return
+            self._force = True
+            if self._running:
+                self._again = True
+                return
+            if self._queued:
+                return
+            if self._entry is not None:
+                self.scheduler.cancel(self._entry)
+                self._entry = None
+            self._queued = True
+            self.scheduler.call_soon(self._make_call(), urgent=True)
 
     def get(self, service, instance):
-        cached = self._cache.get((service, instance), [0, None])
-        if time.time() > cached[0] + 1.5 * self.interval:
+        key = service, instance
+        cached = self._cache.get(key, [0, None])
+        interval = self.interval
+        if self.adaptive:
+            interval = self._intervals.get(key, interval)
+        if time.time() > cached[0] + 1.5 * interval:
             return None
         return cached[1]
 
-    def invalidate(self, service, instance):
-        self._cache.pop((service, instance), None)
+    def query(self, service, instance):
+        """Return the cached status, or query it if the cache is outdated."""
+        result = self.get(service, instance)
+        if result is not None:
+            return result
+        key = service, instance
+        if self.serve_stale:
+            # Invalidated entries are removed, so this is never the status
+            # from before a control action.
+            cached = self._cache.get(key)
+            if cached is not None:
+                with self._cond:
+                    refresh = key not in self._flights
+                if refresh:
+                    self.scheduler.call_soon(
+                        functools.partial(self._refresh, key))
+                return cached[1]
+        return self._shared_query(key)
 
-    def _entry(self):
-        while not self._stoprequest:
+    def _shared_query(self, key):
+        with self._cond:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if leader:
             try:
-                # Wait interval or until something arrives in the queue.
-                req = self.queue.get(True, self.interval)
-                if req is None:
-                    continue
-            except queue.Empty:
-                pass
-            with self.job.lock:
-                for key in self.job.get_services():
-                    try:
-                        result = self.job.service_status(*key)
-                    except Exception:
-                        continue
-                    if result != self._cache.get(key, [0, None])[1]:
-                        self._cache[key] = [time.time(), result]
-                        self.event_callback(StatusEvent(
-                            service=key[0],
-                            instance=key[1],
-                            state=result[0],
-                            ext_status=result[1],
-                        ))
-                    else:
-                        self._cache[key][0] = time.time()
+                with self.job.lock.read():
+                    flight.result = self.job.service_status(*key)
+            except Exception as err:
+                flight.error = err
+            finally:
+                with self._cond:
+                    del self._flights[key]
+                flight.done.set()
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def _refresh(self, key):
+        try:
+            result = self._shared_query(key)
+        except Exception:
+            return
+        self.update(key[0], key[1], result)
+
+    def invalidate(self, service, instance):
+        key = service, instance
+        with self._cond:
+            self._cache.pop(key, None)
+            self._intervals.pop(key, None)
+            self._due.pop(key, None)
+
+    def _keys_to_poll(self):
+        # Called with the condition held.
+        keys = self.job.get_services()
+        if self._force or not self.adaptive:
+            self._force = False
+            return list(keys)
+        # Include services that are due very soon, to poll them together.
+        limit = time.time() + 0.1 * self.fast_interval
+        return [key for key in keys if self._due.get(key, 0) <= limit]
+
+    def _next_delay(self):
+        # Called with the condition held.
+        if not self.adaptive:
+            return self.interval
+        keys = self.job.get_services()
+        if not keys:
+            return self.interval
+        due = min(self._due.get(key, 0) for key in keys)
+        return max(0, due - time.time())
+
+    def _adapt(self, key, result, changed):
+        if result is None or changed:
+            interval = self.interval
+        else:
+            interval = min(2 * self._intervals.get(key, self.interval),
+                           self.max_interval)
+        if result is not None and result[0] in TRANSITIONAL_STATES:
+            interval = self.fast_interval
+        self._intervals[key] = interval
+        self._due[key] = time.time() + interval
+
+    def _make_call(self):
+        return functools.partial(self._cycle, self._generation)
+
+    def _cycle(self, generation):
+        with self._cond:
+            if generation != self._generation:
+                return
+            self._entry = None
+            self._queued = False
+            self._running = True
+            if self.concurrency > 1:
+                # Fan out the status queries; the last one to finish ends
+                # the cycle.
+                self._pending = collections.deque(self._keys_to_poll())
+                for _ in range(min(self.concurrency, len(self._pending))):
+                    self._dispatch()
+                if not self._inflight:
+                    self._finish()
+                return
+            keys = self._keys_to_poll()
+            self._cycle_threads.add(threading.current_thread())
+        try:
+            # Probes only read the job's state; control actions wait for
+            # the cycle to finish.
+            with self.job.lock.read():
+                for key in keys:
+                    self._probe(key)
+        finally:
+            with self._cond:
+                self._cycle_threads.discard(threading.current_thread())
+                self._finish()
+
+    def _dispatch(self):
+        # Called with the condition held.
+        key = self._pending.popleft()
+        self._inflight += 1
+        self.scheduler.call_soon(functools.partial(self._parallel_probe, key))
+
+    def _parallel_probe(self, key):
+        with self._cond:
+            self._cycle_threads.add(threading.current_thread())
+        try:
+            with self.job.lock.read():
+                self._probe(key)
+        finally:
+            with self._cond:
+                self._cycle_threads.discard(threading.current_thread())
+                self._inflight -= 1
+                if not self._active:
+                    self._pending.clear()
+                if self._pending:
+                    self._dispatch()
+                elif not self._inflight:
+                    self._finish()
+
+    def _finish(self):
+        # Called with the condition held.
+        self._running = False
+        if self._active:
+            if self._again:
+                self._again = False
+                self._queued = True
+                self.scheduler.call_soon(self._make_call(), urgent=True)
+            else:
+                self._entry = self.scheduler.call_later(
+                    self._next_delay(), self._make_call())
+        self._cond.notify_all()
+
+    def update(self, service, instance, result):
+        """Update the cached status of a service with a *result* that was
+        obtained by other means than polling, e.g. from a notification.
+
+        Emits a status event if the status changed, and returns whether it
+        changed.
+        """
+        key = service, instance
+        # This is called from the poll workers and other threads (e.g. the
+        # D-Bus main loop), concurrently with invalidate().
+        with self._cond:
+            cached = self._cache.get(key)
+            self._cache[key] = [time.time(), result]
+        if cached is not None and cached[1] == result:
+            return False
+        self.event_callback(StatusEvent(
+            service=service,
+            instance=instance,
+            state=result[0],
+            ext_status=result[1],
+        ))
+        return True
+
+    def _probe(self, key):
+        try:
+            result = self.job.service_status(*key)
+        except Exception:
+            if self.adaptive:
+                self._adapt(key, None, True)
+            return
+        changed = self.update(key[0], key[1], result)
+        if self.adaptive:
+            self._adapt(key, result, changed)
+
+
+class _Flight(object):
+    """A status query that other callers can wait for."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
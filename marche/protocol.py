@@ -25,11 +25,13 @@
 """Constants for use with the new Marche protocol."""
 
 import json
+import zlib
 
 from marche.six import add_metaclass
+from marche import codec
 
 # Increment this when making changes to the protocol.
-PROTO_VERSION = 2
+PROTO_VERSION = 5
 
 
 class Commands(object):
@@ -43,20 +45,28 @@ class Commands(object):
     REQUEST_SERVICE_STATUS = 'status?'
     REQUEST_CONTROL_OUTPUT = 'output?'
     REQUEST_LOG_FILES = 'logfiles?'
+    REQUEST_LOGS_SINCE = 'logupdate?'
     REQUEST_CONF_FILES = 'conffiles?'
     SEND_CONF_FILE = 'sendconfig'
+    SET_ENCODING = 'encoding'
+    START_ALL = 'startall'
+    STOP_ALL = 'stopall'
+    RESTART_ALL = 'restartall'
 
 
 class Events(object):
     CONNECTED = 'connected'
     AUTH_RESULT = 'authresult'
     SERVICE_LIST = 'services'
+    SERVICE_DIFF = 'servicediff'
     ERROR = 'error'
     STATUS = 'status'
     CONTROL_OUTPUT = 'output'
     CONF_FILES = 'conffiles'
     LOG_FILES = 'logfiles'
+    LOG_UPDATE = 'logupdate'
     FOUND_HOST = 'host'
+    PROGRESS = 'progress'
 
 
 class Errors(object):
@@ -66,6 +76,20 @@ class Errors(object):
     EXCEPTION = 9
 
 
+# Wire encodings for messages.  JSON is the default; the compact binary
+# encoding (see marche.codec) can be negotiated after connecting.
+ENC_JSON = 'json'
+ENC_COMPACT = 'compact'
+ENCODINGS = [ENC_JSON, ENC_COMPACT]
+
+# Serialized messages start with one of these bytes, unless they are JSON.
+COMPACT_MARKER = b'\x01'
+ZLIB_MARKER = b'\x02'
+
+# Compressed messages must not decompress to more than this.
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+
 class RegistryMeta(type):
     def __new__(mcs, name, bases, attrs):
         newtype = type.__new__(mcs, name, bases, attrs)
@@ -81,16 +105,36 @@ class SerializableMessage(object):
     #: Designation of the type of message.
     type = None
 
-    def serialize(self):
+    def serialize(self, encoding=ENC_JSON, compress_threshold=None):
+        """Serialize the message to bytes.
+
+        If *compress_threshold* is given, messages larger than this are
+        compressed with zlib.
+        """
         if not self.type:
             raise RuntimeError('base class cannot be serialized')
         ret = {'type': self.type}
         ret.update(vars(self))
-        return json.dumps(ret).encode('utf-8')
+        if encoding == ENC_COMPACT:
+            data = COMPACT_MARKER + codec.encode(ret)
+        else:
+            data = json.dumps(ret).encode('utf-8')
+        if compress_threshold is not None and len(data) > compress_threshold:
+            data = ZLIB_MARKER + zlib.compress(data)
+        return data
 
     @classmethod
     def unserialize(cls, data):
-        data = json.loads(data.decode('utf-8'))
+        """Unserialize a message from bytes, in any supported encoding."""
+        if data[:1] == ZLIB_MARKER:
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(data[1:], MAX_MESSAGE_SIZE)
+            if decompressor.unconsumed_tail:
+                raise ValueError('decompressed message too large')
+        if data[:1] == COMPACT_MARKER:
+            data = codec.decode(data[1:])
+        else:
+            data = json.loads(data.decode('utf-8'))
         if 'type' not in data:
             raise RuntimeError('type not given in data')
         if data['type'] not in cls.registry:
@@ -132,6 +176,10 @@ class TriggerReloadCommand(Command):
 class RequestServiceListCommand(Command):
     type = Commands.REQUEST_SERVICE_LIST
 
+    def __init__(self, since=None):
+        # If given, only the changes since this generation are requested.
+        self.since = since
+
 
 class ServiceCommand(Command):
     def __init__(self, service, instance):
@@ -163,10 +211,46 @@ class RequestLogFilesCommand(ServiceCommand):
     type = Commands.REQUEST_LOG_FILES
 
 
+class RequestLogsSinceCommand(ServiceCommand):
+    type = Commands.REQUEST_LOGS_SINCE
+
+    def __init__(self, service, instance, cursors=None):
+        ServiceCommand.__init__(self, service, instance)
+        # Dictionary of filename -> [inode, offset, checksum] from the last
+        # update.
+        self.cursors = cursors or {}
+
+
 class RequestConfFilesCommand(ServiceCommand):
     type = Commands.REQUEST_CONF_FILES
 
 
+class SetEncodingCommand(Command):
+    type = Commands.SET_ENCODING
+
+    def __init__(self, encoding, compress_threshold=None):
+        self.encoding = encoding
+        self.compress_threshold = compress_threshold
+
+
+class BulkCommand(Command):
+    def __init__(self, services):
+        # List of [service, instance] pairs.
+        self.services = services
+
+
+class StartAllCommand(BulkCommand):
+    type = Commands.START_ALL
+
+
+class StopAllCommand(BulkCommand):
+    type = Commands.STOP_ALL
+
+
+class RestartAllCommand(BulkCommand):
+    type = Commands.RESTART_ALL
+
+
 class SendConfFileCommand(ServiceCommand):
     type = Commands.SEND_CONF_FILE
 
@@ -185,17 +269,36 @@ class Event(SerializableMessage):
 class ConnectedEvent(Event):
     type = Events.CONNECTED
 
-    def __init__(self, proto_version, daemon_version, unauth_level):
+    def __init__(self, proto_version, daemon_version, unauth_level,
+                 encodings=None):
         self.proto_version = proto_version
         self.daemon_version = daemon_version
         self.unauth_level = unauth_level
+        # Supported wire encodings; old daemons only support JSON.
+        self.encodings = encodings or [ENC_JSON]
 
 
 class ServiceListEvent(Event):
     type = Events.SERVICE_LIST
 
-    def __init__(self, services):
+    def __init__(self, services, generation=None):
+        self.services = services
+        self.generation = generation
+
+
+class ServiceDiffEvent(Event):
+    """Changes to the service list between two generations.
+
+    *services* contains the full entries of added and changed services,
+    *removed* the names of removed services.
+    """
+    type = Events.SERVICE_DIFF
+
+    def __init__(self, generation, base_generation, services, removed):
+        self.generation = generation
+        self.base_generation = base_generation
         self.services = services
+        self.removed = removed
 
 
 class AuthEvent(Event):
@@ -229,6 +332,21 @@ class ErrorEvent(ServiceEvent):
         self.desc = desc
 
 
+class ProgressEvent(ServiceEvent):
+    """Progress of a service during a bulk start/stop/restart.
+
+    *action* is ``start`` or ``stop``, *state* is ``running``, ``done`` or
+    ``failed``.
+    """
+    type = Events.PROGRESS
+
+    def __init__(self, service, instance, action, state, desc=''):
+        ServiceEvent.__init__(self, service, instance)
+        self.action = action
+        self.state = state
+        self.desc = desc
+
+
 class ControlOutputEvent(ServiceEvent):
     type = Events.CONTROL_OUTPUT
 
@@ -251,6 +369,22 @@ class LogfileEvent(FileEvent):
     type = Events.LOG_FILES
 
 
+class LogUpdateEvent(FileEvent):
+    """New lines of the logfiles since the cursors given in the request.
+
+    *cursors* contains the new cursor for each file.  For files listed in
+    *reset*, the lines replace any previously received content (because the
+    file is new to the client, was rotated or truncated, or had more new lines
+    than are sent).
+    """
+    type = Events.LOG_UPDATE
+
+    def __init__(self, service, instance, files, cursors, reset):
+        FileEvent.__init__(self, service, instance, files)
+        self.cursors = cursors
+        self.reset = reset
+
+
 class FoundHostEvent(Event):
     type = Events.FOUND_HOST
 
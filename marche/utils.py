@@ -30,11 +30,13 @@ from __future__ import print_function
 import os
 import re
 import sys
+import time
+import signal
+import zlib
 import socket
 import select
-import collections
 from os import path
-from threading import Thread
+from threading import Thread, Condition
 from subprocess import Popen, PIPE
 
 try:
@@ -145,6 +147,69 @@ class lazy_property(object):
         return obj.__dict__[self.__name__]
 
 
+class RWLock(object):
+    """A lock that can be held by many readers, or by a single writer.
+
+    Use ``with lock.read():`` for shared and ``with lock.write():`` (or just
+    ``with lock:``) for exclusive access.  Waiting writers have priority over
+    new readers, so that they are not starved.  The lock is not reentrant.
+    """
+
+    def __init__(self):
+        self._cond = Condition()
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writing or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+
+    def release(self):
+        with self._cond:
+            self._writing = False
+            self._cond.notify_all()
+
+    __enter__ = acquire
+
+    def __exit__(self, *args):
+        self.release()
+
+    def read(self):
+        return _LockContext(self.acquire_read, self.release_read)
+
+    def write(self):
+        return _LockContext(self.acquire, self.release)
+
+
+class _LockContext(object):
+    def __init__(self, acquire, release):
+        self._acquire = acquire
+        self._release = release
+
+    def __enter__(self):
+        self._acquire()
+
+    def __exit__(self, *args):
+        self._release()
+
+
 if os.name == 'nt':  # pragma: no cover
     class Poller(object):
         """A poor imitation of polling for Windows."""
@@ -152,10 +217,13 @@ if os.name == 'nt':  # pragma: no cover
         def __init__(self):
             self.fds = []
 
-        def register(self, fp, opt):
-            self.fds.append(fp.fileno())
+        def register(self, fd, opt):
+            self.fds.append(fd)
 
-        def poll(self):
+        def unregister(self, fd):
+            self.fds.remove(fd)
+
+        def poll(self, timeout=None):
             return [(fd, None) for fd in self.fds]
     POLLIN = None
 
@@ -164,8 +232,88 @@ else:
     POLLIN = select.POLLIN
 
 
+def add_output_line(lines, logfunc, line):
+    """Decode a line of command output, log it and append it to *lines*."""
+    if not line:
+        return
+    line = line.translate(None, b'\r')
+    line = line.decode('utf-8', 'replace')
+    logfunc(line.rstrip())
+    lines.append(line)
+
+
+def output_pipes(proc, log, stdout, stderr):
+    """Return the state for collecting the output of *proc* with
+    `read_output`: fd -> [list to store lines, log function, incomplete line].
+    """
+    return {
+        proc.stdout.fileno(): [stdout, log.debug, b''],
+        proc.stderr.fileno(): [stderr, log.warning, b''],
+    }
+
+
+def read_output(pipes, fd):
+    """Read from the pipe *fd*, and log and store the complete lines.
+
+    Returns False if the pipe was closed; it is then removed from *pipes*.
+    """
+    entry = pipes[fd]
+    data = os.read(fd, 4096)
+    if not data:
+        close_output(pipes, fd)
+        return False
+    lines = (entry[2] + data).split(b'\n')
+    entry[2] = lines.pop()
+    for line in lines:
+        add_output_line(entry[0], entry[1], line + b'\n')
+    return True
+
+
+def close_output(pipes, fd):
+    """Store the incomplete last line of the pipe *fd*, and remove it from
+    *pipes*.
+    """
+    entry = pipes.pop(fd)
+    add_output_line(entry[0], entry[1], entry[2])
+
+
+def signal_process(proc, signum):
+    """Send *signum* to the process group of *proc*."""
+    try:
+        if os.name == 'nt':  # pragma: no cover
+            proc.terminate()
+        else:
+            os.killpg(proc.pid, signum)
+    except OSError:
+        pass
+
+
+def stop_timed_out(log, cmd, proc, kill=False):
+    """Terminate a command that did not finish in time, or kill it if
+    *kill* is true (because it did not react to being terminated).
+    """
+    if kill:
+        log.warning('command did not terminate, killing: %s' % cmd)
+        signal_process(proc, getattr(signal, 'SIGKILL', signal.SIGTERM))
+    else:
+        log.warning('command timed out, terminating: %s' % cmd)
+        signal_process(proc, signal.SIGTERM)
+
+
 class AsyncProcess(Thread):
-    def __init__(self, status, log, cmd, sh=True, stdout=None, stderr=None):
+    """Runs a command in a thread, collecting its output line by line.
+
+    If a *timeout* (in seconds) is given and the command does not finish in
+    time, it is terminated, and killed if it does not react.
+    """
+
+    #: Seconds to wait for output before checking the process again.
+    POLL_INTERVAL = 0.5
+    #: Seconds between terminating and killing a command that timed out.
+    KILL_DELAY = 5.0
+
+    def __init__(self, status, log, cmd, sh=True, stdout=None, stderr=None,
+                 timeout=None, env=None):
         Thread.__init__(self)
         self.setDaemon(True)
 
@@ -173,86 +321,193 @@ class AsyncProcess(Thread):
         self.log = log
         self.cmd = cmd
         self.use_sh = sh
+        self.timeout = timeout
+        self.env = env
 
         self.done = False
+        self.timed_out = False
         self.retcode = None
         self.stdout = stdout if stdout is not None else []
         self.stderr = stderr if stderr is not None else []
 
     def run(self):
         self.log.debug('call [sh:%s]: %s' % (self.use_sh, self.cmd))
-        proc = None
-        poller = None
-
-        def poll_output():
-            """
-            Read, log and store output (if any) from processes pipes.
-            """
-            # collect fds with new output
-            fds = [entry[0] for entry in poller.poll()]
-
-            if proc.stdout.fileno() in fds:
-                for line in iter(proc.stdout.readline, b''):
-                    line = line.translate(None, b'\r')
-                    line = line.decode('utf-8', 'replace')
-                    self.log.debug(line.rstrip())
-                    self.stdout.append(line)
-            if proc.stderr.fileno() in fds:
-                for line in iter(proc.stderr.readline, b''):
-                    line = line.translate(None, b'\r')
-                    line = line.decode('utf-8', 'replace')
-                    self.log.warning(line.rstrip())
-                    self.stderr.append(line)
-
+        kwds = {}
+        if os.name != 'nt':
+            # Start a new process group, so that we can kill the command
+            # together with its children (e.g. when run via the shell).
+            kwds['preexec_fn'] = os.setsid
+        proc = Popen(self.cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                     shell=self.use_sh, env=self.env, **kwds)
+        proc.stdin.close()
+
+        pipes = output_pipes(proc, self.log, self.stdout, self.stderr)
+        poller = Poller()
+        for fd in pipes:
+            poller.register(fd, POLLIN)
+
+        started = time.time()
+        kill_time = None
+        delay = 0.001
         while True:
-            if proc is None:
-                # create and start process
-                proc = Popen(self.cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE,
-                             shell=self.use_sh)
-
-                # create poller
-                poller = Poller()
-
-                # register pipes to polling
-                poller.register(proc.stdout, POLLIN)
-                poller.register(proc.stderr, POLLIN)
-
-            poll_output()
-
-            if proc.poll() is not None:  # proc finished
+            if pipes:
+                self._read_output(poller, pipes, self.POLL_INTERVAL)
+            else:
+                # Output is closed, but the process has not exited yet.
+                time.sleep(delay)
+                delay = min(2 * delay, 0.05)
+            if proc.poll() is not None:
                 break
-
-        # poll once after the process ended to collect all the missing output
-        poll_output()
+            if self.timeout and kill_time is None and \
+               time.time() > started + self.timeout:
+                self.timed_out = True
+                stop_timed_out(self.log, self.cmd, proc)
+                kill_time = time.time() + self.KILL_DELAY
+            elif kill_time is not None and time.time() > kill_time:
+                stop_timed_out(self.log, self.cmd, proc, kill=True)
+                kill_time = float('inf')
+
+        # Collect the remaining output, but don't wait for pipes that are kept
+        # open by children that were started in the background.
+        while pipes and self._read_output(poller, pipes, 0):
+            pass
+        for fd in list(pipes):
+            close_output(pipes, fd)
+        proc.stdout.close()
+        proc.stderr.close()
 
         # check return code
         self.retcode = proc.returncode
         self.done = True
 
+    def _read_output(self, poller, pipes, timeout):
+        """Read, log and store output (if any) from the process' pipes.
+
+        Returns True if something was read or a pipe was closed.
+        """
+        events = poller.poll(timeout * 1000)
+        for (fd, _) in events:
+            if not read_output(pipes, fd):
+                # EOF: the pipe is not polled anymore
+                poller.unregister(fd)
+        return bool(events)
+
 
 nontext_re = re.compile(r'[^\n\t\x20-\x7e]')
 
 
-def extract_loglines(filename, n=500):
+def _tail(fp, end, n, blocksize):
+    # Return the last n lines before position end of the open file fp.
+    if n <= 0:
+        return []
+    blocks = []
+    newlines = 0
+    pos = end
+    # One newline more than lines is needed to know that the first line
+    # is complete.
+    while pos > 0 and newlines <= n:
+        size = min(blocksize, pos)
+        pos -= size
+        fp.seek(pos)
+        block = fp.read(size)
+        newlines += block.count(b'\n')
+        blocks.append(block)
+    lines = b''.join(reversed(blocks)).split(b'\n')
+    last = lines.pop()
+    lines = [line + b'\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines[-n:]
+
+
+def tail_lines(filename, n, blocksize=8192):
+    """Return the last *n* lines of a file as a list of bytes.
+
+    The file is read backwards in blocks of *blocksize*, until enough lines
+    are found, so that this is fast also for very large files.
+    """
+    with open(filename, 'rb') as fp:
+        fp.seek(0, os.SEEK_END)
+        return _tail(fp, fp.tell(), n, blocksize)
+
+
+def _clean_lines(lines):
+    return ''.join(nontext_re.sub('', line.translate(None, b'\r')
+                                  .decode('utf-8', 'replace'))
+                   for line in lines)
+
+
+def extract_loglines(filename, n=500, generations=5):
+    """Return a dictionary of the last *n* lines of the logfile *filename*
+    and of up to *generations* rotated logfiles (``filename.1`` etc.).
+    """
     def extract(filename):
-        lines = collections.deque(maxlen=n)
-        with open(filename, 'rb') as fp:
-            for line in fp:
-                line = line.translate(None, b'\r').decode('utf-8', 'replace')
-                lines.append(nontext_re.sub('', line))
-        return ''.join(lines)
+        return _clean_lines(tail_lines(filename, n))
     if not path.exists(filename):
         return {}
     filename = path.realpath(filename)
     result = {filename: extract(filename)}
     # also add rotated logs
     i = 1
-    while path.exists(filename + '.%d' % i):
+    while i <= generations and path.exists(filename + '.%d' % i):
         result[filename + '.%d' % i] = extract(filename + '.%d' % i)
         i += 1
     return result
 
 
+# Number of bytes before the offset of a logfile cursor that are checksummed,
+# to detect files that were truncated and have grown again since.
+CURSOR_CHECK_BYTES = 64
+
+
+def _cursor_check(fp, offset):
+    start = max(0, offset - CURSOR_CHECK_BYTES)
+    fp.seek(start)
+    return zlib.crc32(fp.read(offset - start)) & 0xffffffff
+
+
+def extract_loglines_since(filename, cursor=None, n=500, maxbytes=1 << 20):
+    """Return the lines of the logfile *filename* that were added after
+    *cursor*, which is an ``(inode, offset, checksum)`` triple returned by a
+    previous call.
+
+    Returns a tuple ``(text, cursor, reset)``.  If *cursor* is None, the file
+    was rotated or truncated, or more than *maxbytes* were added, *reset* is
+    true and the text is the last *n* lines of the file.  *reset* is also
+    true if more than *n* lines were added, of which only the last *n* are
+    returned.  Incomplete lines at the end of the file are left for the next
+    call.
+
+    Raises ValueError if *cursor* is malformed.
+    """
+    if cursor is not None:
+        try:
+            inode, offset, check = [int(v) for v in cursor]
+        except (TypeError, ValueError):
+            raise ValueError('invalid cursor: %r' % (cursor,))
+    with open(filename, 'rb') as fp:
+        st = os.fstat(fp.fileno())
+        size = st.st_size
+        if cursor is not None and inode == st.st_ino and \
+           0 <= offset <= size <= offset + maxbytes and \
+           _cursor_check(fp, offset) == check:
+            fp.seek(offset)
+            data = fp.read(size - offset)
+            data = data[:data.rfind(b'\n') + 1]
+            offset += len(data)
+            lines = [line + b'\n' for line in data.split(b'\n')[:-1]]
+            reset = len(lines) > n
+        else:
+            lines = _tail(fp, size, n + 1, 8192)
+            offset = size
+            if lines and not lines[-1].endswith(b'\n'):
+                offset -= len(lines.pop())
+            reset = True
+        lines = lines[max(0, len(lines) - n):]
+        check = _cursor_check(fp, offset)
+    return _clean_lines(lines), [st.st_ino, offset, check], reset
+
+
 def normalize_addr(addr, defport):
     if ':' not in addr:
         addr += ':' + str(defport)
@@ -34,7 +34,8 @@ from pytest import raises, mark
 from marche.config import Config
 from marche.auth.base import Authenticator as BaseAuthenticator
 from marche.auth import AuthFailed, AuthHandler
-from marche.permission import DISPLAY, CONTROL, ADMIN, parse_permissions
+from marche.permission import ClientInfo, DISPLAY, CONTROL, ADMIN, \
+    parse_permissions
 
 from test.utils import LogHandler
 
@@ -104,6 +105,58 @@ def test_pam():
         assert raises(AuthFailed, handler.authenticate, 'user', 'wrong')
 
 
+def test_cache():
+    calls = []
+
+    class CountingAuthenticator(BaseAuthenticator):
+        def authenticate(self, user, password):
+            calls.append(user)
+            if password == 'pass':
+                return ClientInfo(CONTROL)
+
+    auth = CountingAuthenticator({'cachettl': '60', 'failttl': '60',
+                                  'cachesize': '2', 'maxfailures': '2'},
+                                 logger)
+    # Successful results are cached.
+    assert auth.check('user', 'pass').level == CONTROL
+    assert auth.check('user', 'pass').level == CONTROL
+    assert calls == ['user']
+    # Credentials are only stored as hashes.
+    assert 'pass' not in repr(auth.cache._results)
+    # Failures are cached as well.
+    assert auth.check('other', 'wrong') is None
+    assert auth.check('other', 'wrong') is None
+    assert calls == ['user', 'other']
+    # After too many failures, the user is blocked.
+    assert auth.check('other', 'wrong2') is None
+    assert auth.check('other', 'pass') is None
+    assert calls == ['user', 'other', 'other']
+    # The cache size is bounded; the oldest entry was dropped.
+    assert len(auth.cache._results) == 2
+    assert auth.check('user', 'pass').level == CONTROL
+    assert calls == ['user', 'other', 'other', 'user']
+    # Entries expire.
+    with patch('time.time', lambda: 1e12):
+        assert auth.check('other', 'pass').level == CONTROL
+    auth.cache.clear()
+    assert not auth.cache._results
+
+    # Failures are tracked for a bounded number of users.
+    for user in ('a', 'b', 'c'):
+        assert auth.check(user, 'wrong') is None
+    assert list(auth.cache._failures) == ['b', 'c']
+
+    # No cache by default.
+    auth = CountingAuthenticator({}, logger)
+    assert auth.cache is None
+
+    # Invalid settings fall back to the defaults.
+    auth = CountingAuthenticator({'cachettl': 'x', 'failttl': '60',
+                                  'cachesize': 'many'}, logger)
+    assert auth.cache.ttl == 0
+    assert auth.cache.size == 256
+
+
 def test_parse_permissions():
     pdict = {DISPLAY: DISPLAY, CONTROL: CONTROL, ADMIN: ADMIN}
     parse_permissions(pdict, 'display=control, control=admin, admin=display')
@@ -38,6 +38,10 @@ def test_defaults():
     assert config.piddir == '/var/run'
     assert config.logdir == '/var/log'
     assert config.unauth_level == DISPLAY
+    assert config.poll_workers == 4
+    assert config.max_commands == 16
+    assert config.init_workers == 8
+    assert config.warnings == []
 
 
 def test_config():
@@ -48,9 +52,23 @@ def test_config():
     assert config.piddir == '/tmp/pid'
     assert config.logdir == '/tmp/log'
     assert config.unauth_level == ADMIN
+    assert config.poll_workers == 2
+    assert config.max_commands == 8
+    assert config.init_workers == 3
+    assert config.warnings == []
 
     assert config.job_config == {'myjob': {'type': 'init'}}
     assert config.auth_config == {'simple': {'user': 'simple',
                                              'passwd': 'simple'}}
     assert config.iface_config == {'xmlrpc': {'user': 'legacy',
                                               'passwd': 'legacy'}}
+
+
+def test_invalid_numbers(tmpdir):
+    tmpdir.join('general.conf').write('[general]\npollworkers = two\n'
+                                      'maxcommands = 8\n')
+    config = Config(str(tmpdir))
+    # Invalid values fall back to the default, with a warning.
+    assert config.poll_workers == 4
+    assert config.max_commands == 8
+    assert config.warnings == ["could not parse pollworkers: 'two', using 4"]
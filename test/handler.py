@@ -25,18 +25,21 @@
 """Test for the central job handler class."""
 
 import sys
+import time
 import socket
 import logging
+import threading
 
 from mock import patch
 from pytest import fixture, raises
 
-from marche.jobs import Fault, Busy
+from marche.jobs import Fault, Busy, INITIALIZING
 from marche.jobs.base import DEAD, RUNNING
 from marche.config import Config
 from marche.handler import JobHandler
-from marche.protocol import ServiceListEvent, ControlOutputEvent, \
-    ConffileEvent, LogfileEvent, StatusEvent, ErrorEvent
+from marche.protocol import ServiceListEvent, ServiceDiffEvent, \
+    ControlOutputEvent, ConffileEvent, LogfileEvent, LogUpdateEvent, \
+    StatusEvent, ErrorEvent, ProgressEvent
 from marche.permission import ClientInfo, DISPLAY, CONTROL, ADMIN
 
 from test.utils import LogHandler, MockIface, MockJob, wait
@@ -81,6 +84,8 @@ def test_exceptions():
 def test_event(handler):
     ev = ErrorEvent('svc', 'inst', 42, 'string')
     handler.emit_event(ev)
+    # Events are delivered asynchronously.
+    wait(100, lambda: handler.test_events)
     assert handler.test_events[-1] == ev
 
 
@@ -94,9 +99,94 @@ def test_joblist(handler):
 
 
 def test_reload(handler):
+    reloads = []
+    handler.add_reload_hook(lambda: reloads.append(1))
     handler.trigger_reload()
     # Now that we did config.reload(), the injected config is gone
     assert not handler.jobs
+    assert reloads == [1]
+
+
+def test_incremental_reload(tmpdir):
+    tmpdir.join('jobs.conf').write('[job.one]\ntype = test\n'
+                                   '[job.two]\ntype = test\n'
+                                   'services = other\n')
+    handler = JobHandler(Config(str(tmpdir)), logger)
+    one, two = handler.jobs['one'], handler.jobs['two']
+    assert handler._get_job('svc1') is one
+    assert handler._get_job('other') is two
+
+    # Keep job two unchanged, remove job one, add job three.
+    tmpdir.join('jobs.conf').write('[job.two]\ntype = test\n'
+                                   'services = other\n'
+                                   '[job.three]\ntype = test\n')
+    handler.trigger_reload()
+    # Unchanged jobs are kept.
+    assert handler.jobs['two'] is two
+    assert set(handler.jobs) == set(['two', 'three'])
+    assert handler._get_job('svc1') is handler.jobs['three']
+    assert handler._get_job('other') is two
+
+    # Change job two, remove job three.
+    tmpdir.join('jobs.conf').write('[job.two]\ntype = test\n'
+                                   'services = changed\n')
+    handler.trigger_reload()
+    assert handler.jobs['two'] is not two
+    assert list(handler.jobs) == ['two']
+    assert handler._get_job('changed') is handler.jobs['two']
+    assert raises(Fault, handler._get_job, 'svc1')
+
+
+def test_parallel_init():
+    config = Config()
+    config.job_config = {
+        'a': {'type': 'test', 'services': 'x', 'initdelay': '0.3'},
+        'b': {'type': 'test', 'services': 'y', 'initdelay': '0.3'},
+        # Duplicate service of job a.
+        'c': {'type': 'test', 'services': 'x'},
+    }
+    started = time.time()
+    nerrors = len(testhandler.errors)
+    handler = JobHandler(config, logger, wait=False)
+    assert time.time() - started < 0.2
+    # Services of jobs still being initialized are reported as such.
+    ev = handler.request_service_list(ClientInfo(ADMIN))
+    assert ev.services['y']['instances']['']['state'] == INITIALIZING
+    assert raises(Fault, handler._get_job, 'y')
+    assert handler.request_service_status(ClientInfo(DISPLAY), 'y', '') \
+        .state == INITIALIZING
+    # Filtering works for initializing and already removed services.
+    ev.services['gone'] = {}
+    filtered = handler.filter_services(ClientInfo(DISPLAY), ev)
+    assert sorted(filtered.services) == ['x', 'y']
+
+    handler._init_done.wait()
+    # The jobs were initialized in parallel.
+    assert time.time() - started < 0.5
+    # The first job by name wins, regardless of initialization order.
+    assert sorted(handler.jobs) == ['a', 'b']
+    assert handler._get_job('x') is handler.jobs['a']
+    assert len(testhandler.errors) == nerrors + 1
+    ev = handler.request_service_list(ClientInfo(ADMIN))
+    assert ev.services['y']['instances']['']['state'] == RUNNING
+
+
+def test_init_timeout(tmpdir):
+    tmpdir.join('jobs.conf').write('[job.slow]\ntype = test\n'
+                                   'services = x\ninitdelay = 0.5\n')
+    handler = JobHandler(Config(str(tmpdir)), logger, wait=False)
+    shutdown = []
+    slow = handler._initializing[0][0]
+    slow.shutdown = lambda: shutdown.append(slow)
+    # Reloading does not wait for the slow job forever.
+    handler.init_timeout = 0.05
+    tmpdir.join('jobs.conf').write('[job.fast]\ntype = test\n'
+                                   'services = y\n')
+    handler.trigger_reload()
+    assert list(handler.jobs) == ['fast']
+    # The abandoned job is shut down once it is initialized.
+    wait(100, lambda: shutdown)
+    assert list(handler.jobs) == ['fast']
 
 
 def test_service_list(handler):
@@ -130,7 +220,50 @@ def test_service_list(handler):
     assert ev.services == {}
 
 
-def test_requests(handler):
+def test_service_diff(handler):
+    client = ClientInfo(CONTROL)
+    assert handler.generation == 1
+    assert handler.request_service_list(client).generation == 1
+    # Nothing changed.
+    handler._update_generation()
+    assert handler.generation == 1
+    ev = handler.request_service_diff(client, 1)
+    assert isinstance(ev, ServiceDiffEvent)
+    assert ev.services == {} and ev.removed == []
+
+    # Remove a service and add an instance to another.
+    job = handler.jobs['mytest']
+    job.get_services = lambda: [('svc1', ''), ('svc3', ''), ('svc3', 'inst2'),
+                                ('svc3', 'inst3')]
+    handler._update_generation()
+    assert handler.generation == 2
+    polled = []
+    polled_status = job.polled_service_status
+    job.polled_service_status = \
+        lambda svc, inst: polled.append(svc) or polled_status(svc, inst)
+    ev = handler.request_service_diff(client, 1)
+    assert ev.generation == 2 and ev.base_generation == 1
+    assert ev.removed == ['svc2']
+    assert list(ev.services) == ['svc3']
+    # Only the status of changed services is looked up.
+    assert set(polled) == set(['svc3'])
+    assert set(ev.services['svc3']['instances']) == set(['', 'inst2', 'inst3'])
+    # Clients that cannot see the services get an empty diff.
+    ev = handler.request_service_diff(ClientInfo(DISPLAY), 1)
+    assert ev.services == {} and ev.removed == []
+
+    # Unknown or too old generations get the full list.
+    ev = handler.request_service_diff(client, 0)
+    assert isinstance(ev, ServiceListEvent)
+    assert ev.generation == 2
+    for _ in range(handler.max_generations):
+        job.get_services = lambda: [('svc%d' % handler.generation, '')]
+        handler._update_generation()
+    assert isinstance(handler.request_service_diff(client, 2),
+                      ServiceListEvent)
+
+
+def test_requests(handler, tmpdir):
     client = ClientInfo(CONTROL)
 
     desc = handler.get_service_description(client, 'svc2', 'inst1')
@@ -151,6 +284,24 @@ def test_requests(handler):
     assert isinstance(ev, LogfileEvent)
     assert ev.files == {'log:inst1': 'svc2'}
 
+    logfile = str(tmpdir.join('log').realpath())
+    tmpdir.join('log').write('line1\n')
+    job = handler.jobs['mytest']
+    job.service_logfiles = lambda svc, inst: [logfile, logfile + '.none']
+    ev = handler.request_logs_since(client, 'svc2', 'inst1', {})
+    assert isinstance(ev, LogUpdateEvent)
+    assert ev.files == {logfile: 'line1\n'}
+    assert ev.reset == [logfile]
+    tmpdir.join('log').write('line2\n', 'a')
+    ev = handler.request_logs_since(client, 'svc2', 'inst1', ev.cursors)
+    assert ev.files == {logfile: 'line2\n'}
+    assert ev.reset == []
+    # Malformed cursors are rejected.
+    assert raises(Fault, handler.request_logs_since, client, 'svc2', 'inst1',
+                  {logfile: 'garbage'})
+    assert raises(Fault, handler.request_logs_since, client, 'svc2', 'inst1',
+                  [logfile])
+
     client = ClientInfo(ADMIN)
     ev = handler.request_conffiles(client, 'svc2', 'inst1')
     assert isinstance(ev, ConffileEvent)
@@ -182,6 +333,99 @@ def test_commands(handler):
     assert job.test_configs['file'] == 'contents'
 
 
+def test_bulk_actions(handler):
+    job = handler.jobs['mytest']
+    client = ClientInfo(CONTROL)
+    depends = {('svc3', ''): [('svc3', 'inst2'), ('svc2', 'inst1')]}
+    job.get_dependencies = lambda svc, inst: depends.get((svc, inst), [])
+
+    services = [('svc3', ''), ('svc3', 'inst2')]
+    waves = handler.start_all(client, services, True)
+    assert waves == [[('svc3', 'inst2')], [('svc3', '')]]
+    assert job.test_started == [('svc3', 'inst2'), ('svc3', '')]
+    handler.stop_all(client, services, True)
+    assert job.test_stopped == [('svc3', ''), ('svc3', 'inst2')]
+    wait(100, lambda: len(handler.test_events) >= 8)
+    assert handler.test_events[:2] == [
+        ProgressEvent('svc3', 'inst2', 'start', 'running'),
+        ProgressEvent('svc3', 'inst2', 'start', 'done')]
+
+    # A failed dependency is not started, and its dependents neither.
+    del handler.test_events[:]
+    handler.start_all(client, [('svc3', ''), ('svc2', 'inst1')], True)
+    wait(100, lambda: len(handler.test_events) >= 3)
+    assert handler.test_events[1].state == 'failed'
+    assert handler.test_events[2] == ProgressEvent(
+        'svc3', '', 'start', 'failed', 'dependency failed to start')
+
+    assert raises(Fault, handler.start_all, ClientInfo(DISPLAY), services)
+    assert raises(Fault, handler.stop_all, client, [('unknown', '')])
+
+
+def test_bulk_parallel():
+    config = Config()
+    config.job_config = {'a': {'type': 'test', 'services': 'x'},
+                         'b': {'type': 'test', 'services': 'y'}}
+    handler = JobHandler(config, logger)
+    events = []
+    handler.add_interface(MockIface(events))
+    started = dict((name, threading.Event()) for name in 'xy')
+
+    def start_service(service, instance):
+        started[service].set()
+        # Only finishes if the service of the other job is started as well.
+        other = 'y' if service == 'x' else 'x'
+        if not started[other].wait(5):
+            raise Fault('not started in parallel')
+
+    for job in handler.jobs.values():
+        job.start_service = start_service
+    waves = handler.start_all(ClientInfo(ADMIN), [('x', ''), ('y', '')], True)
+    # Services of different jobs are started together.
+    assert len(waves) == 1
+    wait(100, lambda: len(events) >= 4)
+    assert [ev.state for ev in events] == ['running', 'running',
+                                           'done', 'done']
+
+
+def test_bulk_same_job(handler, tmpdir):
+    job = handler.jobs['mytest']
+    # The instances of svc3 share a command slot; a second command for the
+    # same slot would be rejected as busy.
+    job.control_key = lambda service, instance: service
+
+    def start_service(service, instance):
+        # Only succeeds if the command of the other slot runs as well.
+        other = 'svc3' if service == 'svc2' else 'svc2'
+        job._async_start(job.control_key(service, instance),
+                         'touch %s; for i in $(seq 50); do test -e %s && '
+                         'exit 0; sleep 0.1; done; exit 1' %
+                         (tmpdir.join(service), tmpdir.join(other)))
+
+    job.start_service = start_service
+    services = [('svc3', ''), ('svc3', 'inst2'), ('svc2', 'inst1')]
+    waves = handler.start_all(ClientInfo(CONTROL), services, True)
+    assert len(waves) == 1
+    wait(100, lambda: len(handler.test_events) >= 6)
+    assert sorted(ev.state for ev in handler.test_events) == \
+        ['done'] * 3 + ['running'] * 3
+
+
+def test_bulk_restart(handler):
+    job = handler.jobs['mytest']
+    client = ClientInfo(CONTROL)
+    depends = {('svc3', ''): [('svc3', 'inst2')]}
+    job.get_dependencies = lambda svc, inst: depends.get((svc, inst), [])
+
+    def stop_service(service, instance):
+        if instance == 'inst2':
+            raise Fault('cannot stop')
+    job.stop_service = stop_service
+    # A failed stop does not keep the dependent service from starting.
+    handler.restart_all(client, [('svc3', ''), ('svc3', 'inst2')], True)
+    assert job.test_started == [('svc3', 'inst2'), ('svc3', '')]
+
+
 def test_filtering(handler):
     event = handler.request_service_list(ClientInfo(ADMIN))
     new_event = handler.filter_services(ClientInfo(ADMIN), event)
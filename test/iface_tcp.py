@@ -0,0 +1,182 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# Marche - A server control daemon
+# Copyright (c) 2015-2016 by the authors, see LICENSE
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <g.brandl@fz-juelich.de>
+#
+# *****************************************************************************
+
+"""Test for the TCP event interface."""
+
+import time
+import socket
+import logging
+
+from pytest import yield_fixture
+
+from marche.jobs import DEAD
+from marche.config import Config
+from marche.protocol import PROTO_VERSION, Errors, Event, ConnectedEvent, \
+    AuthEvent, StatusEvent, ServiceListEvent, FoundHostEvent, ErrorEvent, \
+    ControlOutputEvent, AuthenticateCommand, RequestServiceStatusCommand, \
+    RequestControlOutputCommand, StopCommand, SetEncodingCommand, \
+    ENC_JSON, ENC_COMPACT, COMPACT_MARKER, ZLIB_MARKER, ServiceDiffEvent, \
+    RequestServiceListCommand
+from marche.iface.tcp import Interface, recv_frame, make_frame
+
+from test.utils import MockJobHandler, MockAuthHandler, LogHandler
+
+jobhandler = MockJobHandler()
+authhandler = MockAuthHandler()
+logger = logging.getLogger('testtcp')
+logger.addHandler(LogHandler())
+
+# Make waiting for shutdown faster.
+Interface.poll_interval = 0.05
+
+
+@yield_fixture(scope='module')
+def tcp_iface(request):
+    """Create a Marche TCP interface."""
+    config = Config()
+    config.iface_config['tcp'] = {'host': '127.0.0.1', 'port': '0'}
+    iface = Interface(config, jobhandler, authhandler, logger)
+    iface.run()
+    yield iface
+    iface.shutdown()
+
+
+class Client(object):
+    def __init__(self, iface):
+        port = iface.server.server_address[1]
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.settimeout(2)
+
+    def send(self, cmd):
+        self.sock.sendall(make_frame(cmd.serialize()))
+
+    def recv(self):
+        return Event.unserialize(self.recv_raw())
+
+    def recv_raw(self):
+        return recv_frame(self.sock)
+
+
+def connected(iface):
+    return [c.client_address for c in list(iface._clients)]
+
+
+def test_connection(tcp_iface):
+    client = Client(tcp_iface)
+    event = client.recv()
+    assert isinstance(event, ConnectedEvent)
+    assert event.proto_version == PROTO_VERSION
+
+    client.send(AuthenticateCommand('wrong', 'creds'))
+    assert client.recv() == AuthEvent(False)
+    client.send(AuthenticateCommand('test', 'test'))
+    assert client.recv() == AuthEvent(True)
+
+    client.send(RequestServiceStatusCommand('svc', 'inst'))
+    assert client.recv() == StatusEvent('svc', 'inst', DEAD, 'ext_status')
+    client.send(RequestControlOutputCommand('svc', 'inst'))
+    assert client.recv() == ControlOutputEvent('svc', 'inst',
+                                               ['line1', 'line2'])
+    client.send(StopCommand('svc', 'inst'))
+    event = client.recv()
+    assert isinstance(event, ErrorEvent)
+    assert event.code == Errors.BUSY
+    client.sock.close()
+
+
+def test_push(tcp_iface):
+    client = Client(tcp_iface)
+    assert isinstance(client.recv(), ConnectedEvent)
+    # Wait until the client is registered.
+    address = client.sock.getsockname()
+    while address not in connected(tcp_iface):
+        time.sleep(0.01)
+
+    event = StatusEvent('svc', 'inst', DEAD, '')
+    tcp_iface.emit_event(event)
+    assert client.recv() == event
+    tcp_iface.emit_event(FoundHostEvent('host', 2))
+    assert client.recv() == FoundHostEvent('host', 2)
+    # Service list is filtered by the job handler.
+    tcp_iface.emit_event(ServiceListEvent({'svc': {}}))
+    assert client.recv() == ServiceListEvent({})
+
+    # Disconnected clients are removed.
+    client.sock.close()
+    for _ in range(100):
+        if address not in connected(tcp_iface):
+            break
+        time.sleep(0.01)
+    assert address not in connected(tcp_iface)
+
+
+def test_encoding(tcp_iface):
+    client = Client(tcp_iface)
+    event = client.recv()
+    assert event.encodings == [ENC_JSON, ENC_COMPACT]
+
+    client.send(SetEncodingCommand('invalid'))
+    assert isinstance(client.recv(), ErrorEvent)
+    client.send(SetEncodingCommand(ENC_COMPACT, 'invalid'))
+    assert isinstance(client.recv(), ErrorEvent)
+
+    client.send(SetEncodingCommand(ENC_COMPACT))
+    client.send(RequestServiceStatusCommand('svc', 'inst'))
+    data = client.recv_raw()
+    assert data[:1] == COMPACT_MARKER
+    assert Event.unserialize(data) == \
+        StatusEvent('svc', 'inst', DEAD, 'ext_status')
+
+    # Commands can be sent in any encoding.
+    client.send(SetEncodingCommand(ENC_COMPACT, 10))
+    client.sock.sendall(make_frame(
+        RequestServiceStatusCommand('svc', 'inst').serialize(ENC_COMPACT)))
+    data = client.recv_raw()
+    assert data[:1] == ZLIB_MARKER
+    assert Event.unserialize(data) == \
+        StatusEvent('svc', 'inst', DEAD, 'ext_status')
+    client.sock.close()
+
+
+def test_service_diff(tcp_iface):
+    client = Client(tcp_iface)
+    assert isinstance(client.recv(), ConnectedEvent)
+    address = client.sock.getsockname()
+    while address not in connected(tcp_iface):
+        time.sleep(0.01)
+
+    client.send(RequestServiceListCommand(since=1))
+    assert client.recv() == ServiceDiffEvent(2, 1, {}, ['old'])
+    # The client already knows this generation.
+    tcp_iface.emit_event(ServiceListEvent({'svc': {}}, generation=2))
+    tcp_iface.emit_event(FoundHostEvent('host', 2))
+    assert client.recv() == FoundHostEvent('host', 2)
+    # For a new generation, the client gets the changes since generation 2
+    # (the mock handler only has a diff from generation 1, so this is the
+    # full list).
+    tcp_iface.emit_event(ServiceListEvent({'svc': {}}, generation=3))
+    event = client.recv()
+    assert isinstance(event, ServiceListEvent)
+    assert event.generation == 2
+    client.sock.close()
@@ -24,17 +24,20 @@
 
 """Basic test for jobs and polling."""
 
+import time
 import logging
+import threading
 
 from mock import patch
 from pytest import raises
 
 from marche.jobs import Fault, Busy, DEAD, RUNNING, STARTING, STOPPING
 from marche.jobs.base import Job as BaseJob
+from marche.polling import Scheduler, Poller
 from marche.protocol import StatusEvent
 from marche.permission import ClientInfo, ADMIN, CONTROL, DISPLAY
 
-from test.utils import wait, LogHandler, MockAsyncProcess
+from test.utils import wait, LogHandler, MockCommand
 
 logger = logging.getLogger('testjob')
 testhandler = LogHandler()
@@ -88,7 +91,7 @@ def test_job_helpers():
     job = EmptyJob('test', 'test', {'pollinterval': '0'},
                    logger, lambda event: None)
     out = []
-    with patch('marche.jobs.base.AsyncProcess', MockAsyncProcess):
+    with patch('marche.jobs.base.Command', MockCommand):
 
         # Check async and sync calls.
         proc = job._async_call(0, 'cmd', output=out)
@@ -164,6 +167,9 @@ def test_job_poller():
     job.poll_now()
     wait(100, lambda: events)
     assert job.polled_service_status('svc', 'inst') == (RUNNING, 'ext')
+    # Cached status is returned even while a control action holds the lock.
+    with job.lock:
+        assert job.polled_service_status('svc', 'inst') == (RUNNING, 'ext')
 
     job.poller.stop()
     job.test_raise = True
@@ -173,3 +179,230 @@ def test_job_poller():
     assert raises(RuntimeError, job.polled_service_status, 'svc', 'inst')
 
     job.shutdown()
+
+
+def test_scheduler():
+    sched = Scheduler(workers=2)
+    events = []
+    jobs = []
+    for i in range(10):
+        job = Job('test', 'test%d' % i, {'pollinterval': '0.001'},
+                  logger, events.append)
+        job.poller.scheduler = sched
+        job.init()
+        jobs.append(job)
+
+    wait(100, lambda: len(events) >= 10)
+    # All pollers share the two worker threads.
+    assert len(sched._threads) == 2
+
+    for job in jobs:
+        job.shutdown()
+    del events[:]
+    jobs[0].poll_now()
+    assert not sched._urgent
+    assert not events
+
+    # Calls scheduled with a delay run in order of their due time.
+    sched = Scheduler(workers=1)
+    order = []
+    sched.call_later(0.02, lambda: order.append(2))
+    entry = sched.call_later(0.01, lambda: order.append(3))
+    sched.call_later(0.01, lambda: order.append(1))
+    sched.cancel(entry)
+    wait(100, lambda: len(order) == 2)
+    assert order == [1, 2]
+
+
+class SlowJob(Job):
+    """Job whose status queries only return when all four are running."""
+
+    def configure(self, config):
+        self.test_lock = threading.Lock()
+        self.test_running = 0
+        self.test_all_running = threading.Event()
+        self.test_parallel = []
+
+    def get_services(self):
+        return [('svc', 'inst%d' % i) for i in range(4)]
+
+    def service_status(self, service, instance):
+        with self.test_lock:
+            self.test_running += 1
+            if self.test_running == 4:
+                self.test_all_running.set()
+        self.test_parallel.append(self.test_all_running.wait(5))
+        return Job.service_status(self, service, instance)
+
+
+def test_parallel_poller():
+    sched = Scheduler(workers=4)
+    events = []
+    job = SlowJob('test', 'test', {'pollinterval': '100',
+                                   'pollconcurrency': '4'},
+                  logger, events.append)
+    assert job.poller.concurrency == 4
+    job.poller.scheduler = sched
+    job.init()
+
+    job.poll_now()
+    wait(100, lambda: len(events) == 4)
+    # The four queries ran in parallel, not one after the other.
+    assert job.test_parallel == [True] * 4
+    assert set(ev.instance for ev in events) == \
+        set('inst%d' % i for i in range(4))
+    job.shutdown()
+
+    # Stopping the poller from within a cycle does not deadlock.
+    for concurrency in (1, 4):
+        job = Job('test', 'test', {'pollinterval': '100',
+                                   'pollconcurrency': str(concurrency)},
+                  logger, lambda event: None)
+        job.poller.scheduler = sched
+        job.service_status = lambda *key: job.poller.stop() or (DEAD, '')
+        job.init()
+        job.poll_now()
+        wait(100, lambda: not job.poller._active)
+        thread = threading.Thread(target=job.poller.stop)
+        thread.start()
+        thread.join(2)
+        assert not thread.is_alive()
+
+    testhandler.assert_error(SlowJob, 'test', 'test',
+                             {'pollconcurrency': 'many'}, logger,
+                             lambda event: None)
+
+
+class CountingJob(Job):
+    def __init__(self, *args):
+        Job.__init__(self, *args)
+        self.test_polled = []
+
+    def service_status(self, service, instance):
+        self.test_polled.append(time.time())
+        return Job.service_status(self, service, instance)
+
+
+def test_poller_update():
+    events = []
+    poller = Poller(Job('test', 'test', {}, logger, events.append), 100,
+                    events.append)
+    assert poller.update('svc', 'inst', (DEAD, ''))
+    assert not poller.update('svc', 'inst', (DEAD, ''))
+    assert poller.get('svc', 'inst') == (DEAD, '')
+    poller.invalidate('svc', 'inst')
+    assert poller.get('svc', 'inst') is None
+    assert poller.update('svc', 'inst', (DEAD, ''))
+    assert len(events) == 2
+
+
+def test_adaptive_poller():
+    job = CountingJob('test', 'test', {'pollinterval': '0.02',
+                                       'adaptivepoll': 'yes',
+                                       'pollfastinterval': '0.01',
+                                       'pollmaxinterval': '0.16'},
+                      logger, lambda event: None)
+    assert isinstance(job.poller, Poller)
+    assert job.poller.adaptive
+    assert job.poller.max_interval == 0.16
+
+    # A stable service backs off up to the maximum interval.
+    job.init()
+    wait(100, lambda: len(job.test_polled) >= 6)
+    assert job.poller._intervals['svc', 'inst'] == 0.16
+    assert job.polled_service_status('svc', 'inst') == (DEAD, 'ext')
+
+    # A change of state resets the interval, and a transitional state is
+    # polled with the fast interval.
+    job.test_state = STARTING
+    job.poll_now()
+    wait(100, lambda: job.poller.get('svc', 'inst') == (STARTING, 'ext'))
+    assert job.poller._intervals['svc', 'inst'] == 0.01
+    del job.test_polled[:]
+    wait(100, lambda: len(job.test_polled) >= 5)
+    job.shutdown()
+    assert job.test_polled[-1] - job.test_polled[0] < 0.16
+
+    # Invalidation forgets the interval.
+    job.invalidate('svc', 'inst')
+    assert ('svc', 'inst') not in job.poller._intervals
+
+
+def test_shared_query():
+    sched = Scheduler(workers=2)
+    events = []
+    job = CountingJob('test', 'test', {'pollinterval': '0'},
+                      logger, events.append)
+    job.poller.scheduler = sched
+    slow_status = job.service_status
+    job.service_status = lambda *key: time.sleep(0.2) or slow_status(*key)
+
+    # Concurrent requests for the same service share one query.
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        job.polled_service_status('svc', 'inst'))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [(DEAD, 'ext')] * 5
+    assert len(job.test_polled) == 1
+
+    # Errors are raised in all callers.
+    job.test_raise = True
+    assert raises(RuntimeError, job.polled_service_status, 'svc', 'inst')
+    job.test_raise = False
+
+    # Serving stale status returns the old status and refreshes it.
+    job.poller.serve_stale = True
+    job.poller.update('svc', 'inst', (DEAD, 'ext'))
+    job.test_state = RUNNING
+    del job.test_polled[:]
+    started = time.time()
+    assert job.polled_service_status('svc', 'inst') == (DEAD, 'ext')
+    assert time.time() - started < 0.1
+    wait(100, lambda: events[-1].state == RUNNING)
+    assert len(job.test_polled) == 1
+    # ...but not after invalidation.
+    job.invalidate('svc', 'inst')
+    job.test_state = DEAD
+    assert job.polled_service_status('svc', 'inst') == (DEAD, 'ext')
+
+
+def test_pidfile_status(tmpdir):
+    procdir = tmpdir.mkdir('proc')
+    procdir.mkdir('100').join('cmdline').write_binary(b'/usr/bin/mysrv\0-d\0')
+    procdir.mkdir('200').join('cmdline').write_binary(b'python\0mysrv.py\0')
+    procdir.mkdir('300').join('cmdline').write_binary(b'/bin/other\0')
+    tmpdir.join('svc_inst.pid').write('100\n')
+
+    config = {'pollinterval': '0',
+              'pidfile': str(tmpdir.join('{service}_{instance}.pid'))}
+    job = Job('test', 'test', config, logger, lambda event: None)
+    job.PROC_DIR = str(procdir)
+    with patch('marche.jobs.base.Command', MockCommand):
+        # No command is needed if the process is running...
+        assert job._pidfile_status('svc', 'inst') == RUNNING
+        assert job._async_status('sub', 'fail', 'svc', 'inst') == RUNNING
+        # ...or if the pidfile is stale.
+        tmpdir.join('svc_inst.pid').write('999\n')
+        assert job._async_status('sub', 'cmd', 'svc', 'inst') == DEAD
+        # Missing pidfile: the command decides.
+        tmpdir.join('svc_inst.pid').remove()
+        assert job._pidfile_status('svc', 'inst') is None
+        assert job._async_status('sub', 'cmd', 'svc', 'inst') == RUNNING
+
+    # With an expected executable name, the process is verified.
+    job.pidexe = 'mysrv'
+    tmpdir.join('svc_inst.pid').write('100\n')
+    assert job._pidfile_status('svc', 'inst') == RUNNING
+    tmpdir.join('svc_inst.pid').write('300\n')
+    assert job._pidfile_status('svc', 'inst') is None
+    job.pidexe = 'mysrv.py'
+    tmpdir.join('svc_inst.pid').write('200\n')
+    assert job._pidfile_status('svc', 'inst') == RUNNING
+
+    # Invalid patterns are rejected.
+    testhandler.assert_error(Job, 'test', 'test',
+                             {'pidfile': '/run/{other}.pid'}, logger,
+                             lambda event: None)
@@ -27,12 +27,13 @@
 import sys
 import logging
 
+from mock import patch
 from pytest import raises
 
-from marche.jobs import RUNNING
-from marche.jobs.systemd import Job
+from marche.jobs import RUNNING, DEAD, STOPPING
+from marche.jobs.systemd import Job, UnitWatcher, unit_status
 
-from test.utils import job_call_check
+from test.utils import job_call_check, wait
 
 logger = logging.getLogger('testsystemd')
 
@@ -41,8 +42,18 @@ import sys
 if sys.argv[1] == 'journalctl':
     print('logline1\\nlogline2')
 elif sys.argv[1] == 'systemctl' and sys.argv[2] == 'is-enabled':
-    if sys.argv[3] != 'foo':
+    if sys.argv[3] not in ('foo', 'bar'):
         sys.stderr.write('Not found\\n')
+elif sys.argv[1] == 'systemctl' and sys.argv[2] == 'show':
+    with open(sys.argv[0] + '.calls', 'a') as fp:
+        fp.write(' '.join(sys.argv[3:]) + '\\n')
+    if 'broken' in sys.argv:
+        sys.exit(1)
+    for unit in sys.argv[5:]:
+        if unit == 'foo':
+            print('MainPID=42\\nActiveState=active\\nSubState=running\\n')
+        else:
+            print('MainPID=0\\nActiveState=failed\\nSubState=failed\\n')
 else:
     print(sys.argv[3])
     print(sys.argv[2])
@@ -65,10 +76,53 @@ def test_job(tmpdir):
 
     assert job.get_services() == [('foo', '')]
     assert job.service_description('foo', '') == 'name'
-    assert job.service_status('foo', '') == (RUNNING, '')
+    assert job.service_status('foo', '') == (RUNNING, 'running (PID 42)')
     job_call_check(job, 'foo', '', 'action foo', ['foo', 'action'])
 
     assert job.service_logs('foo', '') == {'journal': 'logline1\nlogline2\n'}
+    job.shutdown()
+
+
+def test_batched_status(tmpdir):
+    scriptfile = tmpdir.join('script.py')
+    scriptfile.write(SCRIPT)
+
+    Job.SYSTEMCTL = '%s -S %s systemctl' % (sys.executable, scriptfile)
+
+    job1 = Job('systemd', 'job1', {'unit': 'foo', 'pollinterval': '100'},
+               logger, lambda event: None)
+    job2 = Job('systemd', 'job2', {'unit': 'bar', 'pollinterval': '100'},
+               logger, lambda event: None)
+    job1.init()
+    job2.init()
+
+    assert job1.service_status('foo', '') == (RUNNING, 'running (PID 42)')
+    assert job2.service_status('bar', '') == (DEAD, 'failed')
+    # Both units were queried by the same call.
+    calls = tmpdir.join('script.py.calls').readlines()
+    assert calls == ['-p ActiveState,SubState,MainPID bar foo\n']
+
+    # Invalidation of a unit causes a new query.
+    job2.invalidate('bar', '')
+    assert job1.service_status('foo', '') == (RUNNING, 'running (PID 42)')
+    assert len(tmpdir.join('script.py.calls').readlines()) == 1
+    assert job2.service_status('bar', '') == (DEAD, 'failed')
+    assert len(tmpdir.join('script.py.calls').readlines()) == 2
+
+    # A failed query is not repeated for every unit.
+    job3 = Job('systemd', 'job3', {'unit': 'broken', 'pollinterval': '100'},
+               logger, lambda event: None)
+    job3.init()
+    job1.invalidate('foo', '')
+    job2.invalidate('bar', '')
+    assert job1.service_status('foo', '') == (RUNNING, '')
+    assert job2.service_status('bar', '') == (RUNNING, '')
+    assert len(tmpdir.join('script.py.calls').readlines()) == 3
+
+    job1.shutdown()
+    job2.shutdown()
+    job3.shutdown()
+    assert not unit_status.units
 
 
 def test_job_mixins(tmpdir):
@@ -112,3 +166,108 @@ def test_job_mixins(tmpdir):
 
     assert raises(RuntimeError, Job,
                   'systemd', 'name', config, logger, lambda event: None)
+
+
+class FakeDBus(object):
+    """Stands in for the dbus module and a system bus with systemd on it."""
+
+    class DBusException(Exception):
+        pass
+
+    def __init__(self):
+        self.receivers = []
+        self.subscribed = False
+        self.props = {'ActiveState': 'active', 'SubState': 'running',
+                      'MainPID': 42}
+
+    def SystemBus(self):
+        return self
+
+    def Interface(self, obj, iface):
+        return obj
+
+    def get_object(self, name, path):
+        assert name == 'org.freedesktop.systemd1'
+        return self
+
+    def add_signal_receiver(self, handler, **kwds):
+        assert kwds['signal_name'] == 'PropertiesChanged'
+        self.receivers.append(handler)
+
+    def Subscribe(self):
+        self.subscribed = True
+
+    def LoadUnit(self, unit):
+        return '/org/freedesktop/systemd1/unit/%s_2eservice' % unit
+
+    def Get(self, iface, name):
+        return self.props[name]
+
+    def emit(self, unit, changed, invalidated):
+        for handler in self.receivers:
+            handler('org.freedesktop.systemd1.Unit', changed, invalidated,
+                    path=self.LoadUnit(unit))
+
+
+class FakeGLib(object):
+    class MainLoop(object):
+        def run(self):
+            pass
+
+
+def test_dbus(tmpdir):
+    fakedbus = FakeDBus()
+    watcher = UnitWatcher()
+    events = []
+
+    with patch('marche.jobs.systemd.dbus', fakedbus), \
+            patch('marche.jobs.systemd.GLib', FakeGLib, create=True), \
+            patch('marche.jobs.systemd.DBusGMainLoop', lambda **kw: None,
+                  create=True), \
+            patch('marche.jobs.systemd.unit_watcher', watcher):
+        job = Job('systemd', 'job', {'unit': 'foo', 'dbus': 'yes',
+                                     'dbuspollinterval': '100',
+                                     'adaptivepoll': 'yes'},
+                  logger, events.append)
+        job.init()
+        assert fakedbus.subscribed
+        assert job.poller.interval == 100
+        # The adaptive backoff keeps to the D-Bus fallback interval.
+        for _ in range(3):
+            job.poller._adapt(('foo', ''), (RUNNING, ''), False)
+            assert job.poller._intervals[('foo', '')] == 100
+        # The initial state is known without polling.
+        wait(100, lambda: events)
+        assert events[-1].state == RUNNING
+        assert events[-1].ext_status == 'running (PID 42)'
+        assert job.polled_service_status('foo', '') == \
+            (RUNNING, 'running (PID 42)')
+
+        # Changes are pushed immediately.
+        fakedbus.emit('foo', {'ActiveState': 'deactivating',
+                              'SubState': 'stop'}, [])
+        assert events[-1].state == STOPPING
+        assert events[-1].ext_status == 'stop (PID 42)'
+
+        # Invalidated properties are queried.
+        fakedbus.props = {'ActiveState': 'inactive', 'SubState': 'dead',
+                          'MainPID': 0}
+        fakedbus.emit('foo', {}, ['ActiveState', 'SubState', 'MainPID'])
+        assert events[-1].state == DEAD
+        assert events[-1].ext_status == 'dead'
+
+        # Other units are ignored.
+        nevents = len(events)
+        fakedbus.emit('bar', {'ActiveState': 'active'}, [])
+        assert len(events) == nevents
+
+        job.shutdown()
+        assert not watcher.watched
+
+    # Without the dbus module, the job falls back to polling.
+    with patch('marche.jobs.systemd.dbus', None):
+        job = Job('systemd', 'job', {'unit': 'foo', 'dbus': 'yes'},
+                  logger, lambda event: None)
+        job.init()
+        assert job.poller.interval == 3.0
+        job.shutdown()
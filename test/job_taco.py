@@ -41,6 +41,8 @@ print(sys.argv[1])
 '''
 
 DB_DEVLIST = '''\
+import os
+assert os.environ['TACO_TEST'] == 'sourced'
 print('\\tstrange/dev/1')
 print('mysrvserver/inst :')
 print('\\tmy/dev/1')
@@ -60,11 +62,29 @@ else:
     print('my/dev/2/name: 2')
 '''
 
+DEPS_DEVLIST = '''\
+print('aserver/x :')
+print('\\ta/dev/1')
+print('bserver/y :')
+print('\\tb/dev/1')
+print('bserver/z :')
+print('\\tb/dev/2')
+'''
+
+DEPS_DEVRES = '''\
+import sys
+with open(__file__.replace('db_devres', 'devres.calls'), 'a') as fp:
+    fp.write('call\\n')
+if sys.argv[1] == 'a/dev/1':
+    print('a/dev/1/iodev: b/dev/1')
+'''
+
 
 def test_job(tmpdir):
     tmpdir.join('taco-server-mysrv').write(SCRIPT)
     tmpdir.join('db_devlist').write(DB_DEVLIST)
     tmpdir.join('db_devres').write(DB_DEVRES)
+    tmpdir.join('taco env.sh').write('export TACO_TEST=sourced\n')
     tmpdir.mkdir('log').join('Mysrv_inst.log').write('log1\nlog2\n')
     tmpdir.join('log', 'Mysrv.log').write('log3\nlog4\n')
 
@@ -73,13 +93,27 @@ def test_job(tmpdir):
     assert not job.check()
 
     Job.INIT_DIR = str(tmpdir)
+    Job.TACO_ENV = str(tmpdir.join('taco env.sh'))
     Job.LOG_DIR = str(tmpdir.join('log'))
     Job.DB_DEVLIST = '%s -S %s' % (sys.executable, tmpdir.join('db_devlist'))
     Job.DB_DEVRES = '%s -S %s' % (sys.executable, tmpdir.join('db_devres'))
 
-    job = Job('taco', 'name', {}, logger, lambda event: None)
+    depcache = str(tmpdir.join('cache', 'deps.json'))
+    job = Job('taco', 'name', {'depcache': depcache}, logger,
+              lambda event: None)
     assert job.check()
     job.init()
+    assert job._depends == {('mysrv', 'inst'): set([('mysrv', 'inst')])}
+    assert tmpdir.join('cache', 'deps.json').check()
+
+    # The second time, the dependencies are read from the cache.
+    tmpdir.join('db_devres').write('raise SystemExit(1)\n')
+    job2 = Job('taco', 'name', {'depcache': depcache}, logger,
+               lambda event: None)
+    job2.init()
+    assert job2.get_services() == [('taco-mysrv', 'inst')]
+    assert job2._depends == job._depends
+    job2.shutdown()
     job._initscripts['taco-mysrv'] = '%s -S %s' % \
         (sys.executable, job._initscripts['taco-mysrv'])
 
@@ -101,3 +135,35 @@ def test_job(tmpdir):
 
     Job.LOG_DIR = 'does/not/exist'
     assert job.service_logs('taco-mysrv', 'inst') == {}
+    job.shutdown()
+
+
+def test_dependencies(tmpdir):
+    tmpdir.join('taco-server-a').write(SCRIPT)
+    tmpdir.join('taco-server-b').write(SCRIPT)
+    tmpdir.join('db_devlist').write(DEPS_DEVLIST)
+    tmpdir.join('db_devres').write(DEPS_DEVRES)
+    Job.INIT_DIR = str(tmpdir)
+    Job.TACO_ENV = 'does/not/exist'
+    Job.DB_DEVLIST = '%s -S %s' % (sys.executable, tmpdir.join('db_devlist'))
+    Job.DB_DEVRES = '%s -S %s' % (sys.executable, tmpdir.join('db_devres'))
+    Job.DEVRES_BATCH = 2
+
+    job = Job('taco', 'name', {'depcache': ''}, logger, lambda event: None)
+    calls = []
+    sync_call = job._sync_call
+    job._sync_call = lambda cmd, **kwds: calls.append(cmd) or \
+        sync_call(cmd, **kwds)
+    job.init()
+    job.shutdown()
+    assert job._depends == {
+        ('a', 'x'): set([('b', 'y')]),
+        ('b', 'y'): set([('a', 'x')]),
+        ('b', 'z'): set(),
+    }
+    assert job.get_dependencies('taco-a', 'x') == [('taco-b', 'y')]
+    assert job.get_dependencies('taco-b', 'y') == []
+    # Three devices in batches of two: two processes besides db_devlist.
+    assert len(calls) == 3
+    assert len(tmpdir.join('devres.calls').readlines()) == 3
+    assert not tmpdir.join('cache').check()
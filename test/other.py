@@ -28,16 +28,23 @@ import os
 import sys
 import json
 import time
+import zlib
 import socket
 import logging
+import threading
 
-from pytest import raises
+from mock import patch
+from pytest import raises, mark
 from marche.six import StringIO
 
-from marche.protocol import Events, Event, AuthEvent
-from marche import utils, colors, loggers
+from marche.protocol import Events, Event, AuthEvent, StatusEvent, \
+    FoundHostEvent, Command as ProtoCommand, ServiceListEvent, LogfileEvent, \
+    ENC_JSON, ENC_COMPACT, ZLIB_MARKER, MAX_MESSAGE_SIZE
+from marche import utils, colors, loggers, codec
+from marche.executor import Command, Executor
+from marche.eventqueue import EventQueue, Subscriber
 
-from test.utils import LogHandler
+from test.utils import LogHandler, wait
 
 logger = logging.getLogger('testother')
 testhandler = LogHandler()
@@ -56,6 +63,61 @@ def test_event_class():
     assert repr(Event()) == '<Event: {}>'
 
 
+def test_codec():
+    value = {'a': [None, True, False, 0, 127, 128, -1, -300, 2**70, 1.5,
+                   u'\xe4', 'x' * 100],
+             'b': {'a': 'a', 'c': []}}
+    data = codec.encode(value)
+    assert codec.decode(data) == value
+    # Repeated short strings are only encoded once.
+    assert data.count(b'a') == 1
+    assert raises(ValueError, codec.decode, data[:-1])
+    assert raises(ValueError, codec.decode, data + b'\x00')
+    assert raises(ValueError, codec.decode, b'\xff')
+    assert raises(TypeError, codec.encode, object())
+
+
+def test_message_encodings():
+    svcs = dict(('svc%d' % i, {
+        'jobtype': 'init',
+        'permissions': [0, 10, 20],
+        'instances': {'': {'desc': 'Service %d' % i, 'state': 20,
+                           'ext_status': 'running (PID 42)'}},
+    }) for i in range(100))
+    samples = {
+        'version': 2, 'proto_version': 3, 'daemon_version': '1.0',
+        'unauth_level': 0, 'encodings': [ENC_JSON], 'services': svcs,
+        'success': True, 'service': 'svc', 'instance': 'inst',
+        'state': 20, 'ext_status': '', 'code': 2, 'desc': 'error',
+        'content': ['line'], 'files': {'file': 'line\n' * 1000},
+        'host': 'host', 'user': 'user', 'passwd': 'passwd',
+        'filename': 'file', 'contents': 'data', 'encoding': ENC_COMPACT,
+        'compress_threshold': None, 'since': 1, 'generation': 2,
+        'base_generation': 1, 'removed': ['svc'], 'action': 'start',
+        'cursors': {'file': [1, 2, 3]}, 'reset': ['file'],
+    }
+    for base in (ProtoCommand, Event):
+        for msgtype in base.registry.values():
+            init = getattr(msgtype.__init__, '__func__', msgtype.__init__)
+            code = getattr(init, '__code__', None)
+            names = code.co_varnames[1:code.co_argcount] if code else ()
+            msg = msgtype(**dict((name, samples[name]) for name in names))
+            for encoding in (ENC_JSON, ENC_COMPACT):
+                for threshold in (None, 100):
+                    data = msg.serialize(encoding, threshold)
+                    assert base.unserialize(data) == msg
+
+    # Compact encoding and compression make big messages much smaller.
+    for msg in (ServiceListEvent(svcs),
+                LogfileEvent('svc', 'inst', samples['files'])):
+        json_size = len(msg.serialize())
+        assert len(msg.serialize(ENC_COMPACT, 1000)) < json_size / 5
+
+    # Messages that decompress to too much data are rejected.
+    bomb = ZLIB_MARKER + zlib.compress(b' ' * (MAX_MESSAGE_SIZE + 1))
+    assert raises(ValueError, Event.unserialize, bomb)
+
+
 def test_utils(tmpdir):
     utils.ensure_directory(str(tmpdir.join('my', 'sub')))
     assert tmpdir.join('my', 'sub').check(dir=True)
@@ -90,6 +152,58 @@ def test_utils(tmpdir):
             assert value == 'b8\nb9\n'
         else:
             assert False, 'unexpected key'
+    # The number of rotated logfiles is limited.
+    logs = utils.extract_loglines(str(tmpdir.join('logfile')), 2, 0)
+    assert list(logs) == [str(tmpdir.join('logfile').realpath())]
+
+    # Lines are found across blocks, and an incomplete last line is kept.
+    tmpdir.join('big').write_binary((''.join(
+        'line %d\r\n' % i for i in range(1000)) + 'end').encode())
+    bigfile = str(tmpdir.join('big').realpath())
+    assert utils.tail_lines(bigfile, 3, 7) == [b'line 998\r\n',
+                                               b'line 999\r\n', b'end']
+    assert len(utils.tail_lines(bigfile, 5000, 100)) == 1001
+    assert utils.tail_lines(bigfile, 0) == []
+    assert utils.extract_loglines(bigfile, 2) == \
+        {bigfile: 'line 999\nend'}
+    tmpdir.join('empty').write('')
+    assert utils.tail_lines(str(tmpdir.join('empty')), 5) == []
+
+    # Following a logfile.
+    logfile = tmpdir.join('follow')
+    logfile.write('a\nb\nc')
+    text, cursor, reset = utils.extract_loglines_since(str(logfile), None, 1)
+    # The incomplete line is left for later.
+    assert (text, reset) == ('b\n', True)
+    assert cursor[:2] == [os.stat(str(logfile)).st_ino, 4]
+    logfile.write('\nd\r\ne', 'a')
+    text, cursor, reset = utils.extract_loglines_since(str(logfile), cursor)
+    assert (text, reset) == ('c\nd\n', False)
+    assert cursor[1] == 9
+    text, cursor, reset = utils.extract_loglines_since(str(logfile), cursor)
+    assert (text, reset) == ('', False)
+    # Truncation and rotation are detected.
+    logfile.write('x\n')
+    text, cursor, reset = utils.extract_loglines_since(str(logfile), cursor)
+    assert (text, reset) == ('x\n', True)
+    logfile.rename(str(tmpdir.join('follow.1')))
+    logfile.write('y\n')
+    text, cursor, reset = utils.extract_loglines_since(
+        str(logfile), cursor)
+    assert (text, reset) == ('y\n', True)
+    # If more lines were added than are returned, this is a reset too.
+    logfile.write('1\n2\n3\n', 'a')
+    text, cursor, reset = utils.extract_loglines_since(
+        str(logfile), cursor, 2)
+    assert (text, reset) == ('2\n3\n', True)
+    # Truncation followed by growth past the cursor is detected.
+    logfile.write('z\n' * 10)
+    text, cursor, reset = utils.extract_loglines_since(
+        str(logfile), cursor, 3)
+    assert (text, reset) == ('z\nz\nz\n', True)
+    for bad_cursor in ([1, 2], 'x', [1, 'a', 3], 5):
+        assert raises(ValueError, utils.extract_loglines_since,
+                      str(logfile), bad_cursor)
 
     fqdn = socket.getfqdn('localhost')
     assert utils.normalize_addr('localhost', 147) == (fqdn, '147')
@@ -111,6 +225,47 @@ def test_lazy_property():
     assert isinstance(Test.prop, utils.lazy_property)
 
 
+def test_rwlock():
+    lock = utils.RWLock()
+    events = []
+
+    def reader():
+        with lock.read():
+            events.append('read')
+
+    def writer():
+        with lock.write():
+            events.append('write')
+
+    # Readers share the lock.
+    with lock.read():
+        thd = threading.Thread(target=reader)
+        thd.start()
+        thd.join(1)
+        assert events == ['read']
+    # A writer excludes readers...
+    with lock:
+        thd = threading.Thread(target=reader)
+        thd.start()
+        time.sleep(0.1)
+        assert events == ['read']
+    thd.join(1)
+    assert events == ['read', 'read']
+    # ...and waits for them.
+    with lock.read():
+        thd = threading.Thread(target=writer)
+        thd.start()
+        time.sleep(0.1)
+        assert events == ['read', 'read']
+        # New readers wait behind the waiting writer.
+        thd2 = threading.Thread(target=reader)
+        thd2.start()
+        time.sleep(0.1)
+    thd.join(1)
+    thd2.join(1)
+    assert events == ['read', 'read', 'write', 'read']
+
+
 def test_async_process(tmpdir):
     code = '''if True:
     import sys
@@ -126,6 +281,160 @@ def test_async_process(tmpdir):
     assert proc.stdout == ['stdout\n']
     assert proc.retcode == 3
     assert proc.done
+    assert not proc.timed_out
+
+    # Output without trailing newline, and children in the background that
+    # keep the pipes open.
+    code = '''if True:
+    import sys, subprocess
+    subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(5)'])
+    sys.stdout.write("line1\\nline2")
+    '''
+    started = time.time()
+    proc = utils.AsyncProcess(0, logger, [sys.executable, '-S', '-c', code],
+                              sh=False)
+    proc.start()
+    proc.join()
+    assert time.time() - started < 4
+    assert proc.stdout == ['line1\n', 'line2']
+    assert proc.retcode == 0
+
+
+@mark.skipif(os.name == 'nt', reason='process groups not available')
+def test_async_process_timeout():
+    code = 'import time; time.sleep(10)'
+    proc = utils.AsyncProcess(0, logger, [sys.executable, '-S', '-c', code],
+                              sh=False, timeout=0.2)
+    proc.KILL_DELAY = 0.2
+    started = time.time()
+    proc.start()
+    proc.join()
+    assert time.time() - started < 5
+    assert proc.timed_out
+    assert proc.retcode < 0
+
+    # A command ignoring SIGTERM is killed.
+    code = '''if True:
+    import time, signal
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    time.sleep(10)
+    '''
+    proc = utils.AsyncProcess(0, logger, [sys.executable, '-S', '-c', code],
+                              sh=False, timeout=0.2)
+    proc.KILL_DELAY = 0.2
+    started = time.time()
+    proc.start()
+    proc.join()
+    assert time.time() - started < 5
+    assert proc.retcode == -9
+
+
+@mark.skipif(os.name == 'nt', reason='executor not used on Windows')
+def test_executor():
+    code = '''if True:
+    import sys, time
+    sys.stdout.write("stdout\\n")
+    sys.stderr.write("stderr\\n")
+    time.sleep(0.2)
+    sys.exit(int(sys.argv[1]))
+    '''
+    executor = Executor(max_running=2)
+    done = []
+    commands = [Command(0, logger, [sys.executable, '-S', '-c', code, str(i)],
+                        sh=False, callback=done.append) for i in range(4)]
+    started = time.time()
+    with patch('marche.executor.executor', executor):
+        for command in commands:
+            command.start()
+        for command in commands:
+            command.join()
+    # Only two commands ran at the same time.
+    assert 0.4 < time.time() - started < 3
+    assert executor._thread.is_alive()
+    assert sorted(done, key=id) == sorted(commands, key=id)
+    for i, command in enumerate(commands):
+        assert command.done
+        assert command.retcode == i
+        assert command.stdout == ['stdout\n']
+        assert command.stderr == ['stderr\n']
+
+    # Commands that cannot be started.
+    command = Command(0, logger, ['/does/not/exist'], sh=False)
+    with patch('marche.executor.executor', executor):
+        command.start()
+        command.join()
+    assert command.retcode == 127
+
+    # Timeouts.
+    command = Command(0, logger, 'sleep 10', timeout=0.2)
+    with patch('marche.executor.executor', executor):
+        command.start()
+        command.join()
+    assert command.timed_out
+    assert command.retcode < 0
+
+    # Commands that closed their output, but keep running, are checked
+    # less and less often.
+    command = Command(0, logger, 'exec >&- 2>&-; sleep 1')
+    with patch('marche.executor.executor', executor):
+        command.start()
+        command.join()
+    assert command.retcode == 0
+    assert command._exit_poll == executor.POLL_INTERVAL
+
+    # If the executor loop fails, waiting commands are aborted.
+    command = Command(0, logger, 'sleep 10')
+    with patch('marche.executor.executor', executor):
+        with patch.object(executor, '_check_processes',
+                          side_effect=RuntimeError):
+            command.start()
+            command.join(5)
+        assert command.retcode == -1
+        assert executor._thread is None
+        # Waking up the stopped loop does not touch the closed pipe.
+        assert executor._wakeup_fds is None
+        executor.set_max_running(4)
+        # The next command restarts the loop.
+        command = Command(0, logger, 'true')
+        command.start()
+        command.join(5)
+    assert command.retcode == 0
+
+
+def test_event_queue():
+    queue = EventQueue(maxsize=3)
+    queue.put(StatusEvent('svc', 'inst', 0, 'old'))
+    queue.put(FoundHostEvent('host', 2))
+    queue.put(StatusEvent('svc', 'inst', 1, 'new'))
+    queue.put(StatusEvent('svc', 'other', 1, ''))
+    # Status events are coalesced, keeping their place in the queue.
+    assert len(queue) == 3
+    assert queue.get() == StatusEvent('svc', 'inst', 1, 'new')
+    assert queue.get() == FoundHostEvent('host', 2)
+    # The oldest event is dropped on overflow.
+    for i in range(4):
+        queue.put(FoundHostEvent('host', i))
+    assert queue.dropped == 2
+    assert queue.get() == FoundHostEvent('host', 1)
+    queue.close()
+    assert queue.get() is None
+
+    # A slow subscriber does not block the producer.
+    delivered = []
+
+    def callback(event):
+        time.sleep(0.1)
+        delivered.append(event)
+
+    subscriber = Subscriber(callback, logger)
+    started = time.time()
+    for i in range(10):
+        subscriber.put(StatusEvent('svc', 'inst', i, ''))
+    assert time.time() - started < 0.1
+    wait(100, lambda: delivered and delivered[-1].state == 9)
+    # Intermediate events were skipped.
+    assert len(delivered) <= 2
+    subscriber.stop()
 
 
 def test_colors():
@@ -26,11 +26,13 @@
 
 import time
 import logging
+import threading
 
 from marche.jobs import Fault, Busy, Unauthorized, DEAD, RUNNING
 from marche.jobs.base import Job as BaseJob
 from marche.protocol import ServiceListEvent, StatusEvent, LogfileEvent, \
-    ConffileEvent, ControlOutputEvent, FoundHostEvent
+    ConffileEvent, ControlOutputEvent, FoundHostEvent, ServiceDiffEvent, \
+    LogUpdateEvent
 from marche.auth import AuthFailed
 from marche.permission import ClientInfo, DISPLAY, ADMIN, NONE
 
@@ -83,12 +85,16 @@ class LogHandler(logging.Handler):
             self.messages += 1
 
 
-class MockAsyncProcess(object):
-    def __init__(self, status, log, cmd, sh, stdout=None, stderr=None):
+class MockCommand(object):
+    def __init__(self, status, log, cmd, sh, stdout=None, stderr=None,
+                 timeout=None, callback=None, env=None):
         self.status = status
         self.log = log
         self.cmd = cmd
         self.use_sh = sh
+        self.timeout = timeout
+        self.callback = callback
+        self.env = env
         self.stdout = stdout if stdout is not None else []
         self.stderr = stderr if stderr is not None else []
         self.done = False
@@ -100,6 +106,8 @@ class MockAsyncProcess(object):
         self.stderr.append('error\n')
         self.retcode = 1 if self.cmd == 'fail' else 0
         self.done = True
+        if self.callback:
+            self.callback(self)
 
     def join(self):
         pass
@@ -110,15 +118,24 @@ class MockJobHandler(object):
     test_interface = None
     test_reloaded = False
     test_svc_list_error = False
+    test_slow_release = threading.Event()
     unauth_level = NONE
     uid = 'deadcafe'
 
+    def __init__(self):
+        self.test_reload_hooks = []
+
     def emit_event(self, event):
         if self.test_interface:
             self.test_interface.emit_event(event)
 
+    def add_reload_hook(self, hook):
+        self.test_reload_hooks.append(hook)
+
     def trigger_reload(self):
         self.test_reloaded = True
+        for hook in self.test_reload_hooks:
+            hook()
 
     def scan_network(self):
         self.emit_event(FoundHostEvent('testhost', 2))
@@ -132,7 +149,12 @@ class MockJobHandler(object):
             'instances': {
                 '': {'desc': '', 'state': DEAD, 'ext_status': ''},
                 'inst': {'desc': '', 'state': DEAD, 'ext_status': ''}}}}
-        return ServiceListEvent(services=svcs)
+        return ServiceListEvent(services=svcs, generation=2)
+
+    def request_service_diff(self, client, since):
+        if since != 1:
+            return self.request_service_list(client)
+        return ServiceDiffEvent(2, 1, {}, ['old'])
 
     def filter_services(self, client, event):
         return ServiceListEvent(services={})
@@ -141,6 +163,8 @@ class MockJobHandler(object):
         return True
 
     def get_service_description(self, client, service, instance):
+        if instance == 'slow':
+            self.test_slow_release.wait(5)
         return 'desc'
 
     def request_service_status(self, client, service, instance):
@@ -156,6 +180,15 @@ class MockJobHandler(object):
                             files={'file1': 'line1\nline2\n',
                                    'file2': 'line3\nline4\n'})
 
+    def request_logs_since(self, client, service, instance, cursors):
+        if 'file1' in cursors:
+            offset = int(cursors['file1'][1])
+            return LogUpdateEvent(service, instance, {'file1': 'line3\n'},
+                                  {'file1': [2 ** 40, offset + 6, 0]}, [])
+        return LogUpdateEvent(service, instance,
+                              {'file1': 'line1\nline2\n'},
+                              {'file1': [2 ** 40, 12, 0]}, ['file1'])
+
     def request_conffiles(self, client, service, instance):
         return ConffileEvent(service=service, instance=instance,
                              files={'file1': 'line1\nline2\n',
@@ -206,6 +239,7 @@ class MockJob(BaseJob):
     def init(self):
         # Does not call the base class init() to not start the poller thread
         # (avoids async events to conflict with expected events).
+        time.sleep(float(self.config.get('initdelay', 0)))
         self.test_started = []
         self.test_stopped = []
         self.test_restarted = []
@@ -215,6 +249,8 @@ class MockJob(BaseJob):
         return not self.config.get('fail')
 
     def get_services(self):
+        if 'services' in self.config:
+            return [(self.config['services'], '')]
         return [
             ('svc1', ''),       # A service without instances
             ('svc2', 'inst1'),  # A service with only subinstances